@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+
+'''
+Micro-benchmarks for the per-item hot paths in mturk.py.
+
+Usage: ./benchmark.py [number_of_answers [answer_size]]
+Usage: ./benchmark.py exports [path/to/results.json] [rows=N,...] [questions=N,...] [answer_sizes=N,...]
+Usage: ./benchmark.py bulk [number_of_HITs [assignments_per_HIT]] [results=path/to/results.json] [baseline=path/to/baseline.json] [tolerance=T]
+
+
+Author: Yotam Gingold <yotam@yotamgingold.com>
+Home: https://github.com/yig/mturk.py
+
+Any copyright is dedicated to the Public Domain.
+http://creativecommons.org/publicdomain/zero/1.0/
+'''
+
+import os, sys
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+import mturk
+
+def make_answer_xml( num_questions, answer_size, answer = None ):
+    '''
+    Returns a QuestionFormAnswers XML string like the ones in an Assignment's
+    'Answer' field, with 'num_questions' FreeText answers of
+    'answer_size' characters each.
+    The answers are 'answer' if given, and "xxx..." otherwise.
+    '''
+    
+    if answer is None: answer = 'x' * answer_size
+    return (
+        '<?xml version="1.0" encoding="ASCII"?><QuestionFormAnswers xmlns="http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2005-10-01/QuestionFormAnswers.xsd">'
+        + ''.join([ '<Answer><QuestionIdentifier>q%d</QuestionIdentifier><FreeText>%s</FreeText></Answer>' % ( i, answer ) for i in range( num_questions ) ])
+        + '</QuestionFormAnswers>'
+        )
+
+def parse_answer_xml_minidom( answer_xml ):
+    '''
+    The xml.dom.minidom parser that assignment2row() used to use,
+    kept for comparison.
+    '''
+    
+    import xml.dom.minidom
+    answersdom = xml.dom.minidom.parseString( answer_xml )
+    return [ ( a.childNodes[0].firstChild.data, a.childNodes[1].firstChild.data ) for a in answersdom.getElementsByTagName( 'Answer' ) ]
+
+def benchmark_answer_parsing( num_answers = 1000, num_questions = 10, answer_size = 100 ):
+    '''
+    Times mturk.parse_answer_xml() against parse_answer_xml_minidom()
+    on 'num_answers' synthetic Answer XML strings.
+    Returns a dictionary mapping parser names to seconds.
+    '''
+    
+    import time
+    
+    answer_xml = make_answer_xml( num_questions, answer_size )
+    assert mturk.parse_answer_xml( answer_xml ) == parse_answer_xml_minidom( answer_xml )
+    
+    result = {}
+    for name, parse in [ ( 'minidom', parse_answer_xml_minidom ), ( 'expat', mturk.parse_answer_xml ) ]:
+        start = time.perf_counter()
+        for i in range( num_answers ):
+            parse( answer_xml )
+        result[ name ] = time.perf_counter() - start
+    
+    return result
+
+def make_base64_answer( answer_size ):
+    '''
+    Returns 'answer_size' characters of base64-encoded random bytes,
+    like an answer holding an encoded image.
+    '''
+    
+    import base64
+    return base64.b64encode( os.urandom( answer_size ) ).decode( 'ascii' )[:answer_size]
+
+def iter_synthetic_assignments( num_rows, num_questions = 10, answer_size = 100, assignments_per_HIT = 10, num_workers = 1000 ):
+    '''
+    Yields 'num_rows' Assignment dictionaries like boto3's, each with
+    'num_questions' base64 answers of 'answer_size' characters.
+    They share one Answer string, so that making a million of them
+    one at a time costs little memory.
+    '''
+    
+    import datetime
+    
+    answer_xml = make_answer_xml( num_questions, answer_size, make_base64_answer( answer_size ) )
+    now = datetime.datetime.now( datetime.timezone.utc )
+    for i in range( num_rows ):
+        yield {
+            'AssignmentId': 'A%029d' % i,
+            'WorkerId': 'W%013d' % ( i % num_workers ),
+            'HITId': 'H%029d' % ( i // assignments_per_HIT ),
+            'AssignmentStatus': 'Submitted',
+            'AutoApprovalTime': now,
+            'AcceptTime': now,
+            'SubmitTime': now,
+            'Deadline': now,
+            'Answer': answer_xml
+            }
+
+def iter_synthetic_HITs( num_rows ):
+    '''
+    Yields 'num_rows' HIT dictionaries like boto3's get_hit() returns,
+    each with its own ExternalQuestion.
+    '''
+    
+    import datetime
+    
+    now = datetime.datetime.now( datetime.timezone.utc )
+    for i in range( num_rows ):
+        yield {
+            'HITId': 'H%029d' % i,
+            'HITTypeId': 'T' * 30,
+            'CreationTime': now,
+            'Title': 'Benchmark',
+            'Description': 'benchmark.py',
+            'Question': mturk.ExternalQuestion( 'https://example.com/task?id=%d' % i, 800 ).get_as_xml(),
+            'Keywords': 'benchmark',
+            'HITStatus': 'Assignable',
+            'MaxAssignments': 10,
+            'Reward': '0.01',
+            'AutoApprovalDelayInSeconds': 2592000,
+            'Expiration': now,
+            'AssignmentDurationInSeconds': 600,
+            'RequesterAnnotation': 'batch %d' % ( i // 100 ),
+            'HITReviewStatus': 'NotReviewed',
+            'NumberOfAssignmentsPending': 0,
+            'NumberOfAssignmentsAvailable': 10,
+            'NumberOfAssignmentsCompleted': 0
+            }
+
+def export_cases( num_rows, num_questions, answer_size, tmp ):
+    '''
+    Returns a list of ( name, function ) pairs, where calling the function
+    runs one export path on 'num_rows' synthetic items
+    (writing any files to the directory 'tmp').
+    The "synthetic_" cases only make the items, to show how much of the
+    other cases' time that takes.
+    '''
+    
+    def drain( items ):
+        for item in items: pass
+    
+    def write_to_devnull( write, items ):
+        with open( os.devnull, 'w' ) as devnull: write( items, devnull )
+    
+    assignments = lambda: iter_synthetic_assignments( num_rows, num_questions, answer_size )
+    cases = [
+        ( 'synthetic_assignments', lambda: drain( assignments() ) ),
+        ( 'assignments2CSV', lambda: mturk.assignments2CSV( assignments() ) ),
+        ( 'write_assignments_CSV', lambda: write_to_devnull( mturk.write_assignments_CSV, assignments() ) ),
+        ( 'export_assignments.jsonl', lambda: mturk.export_assignments( assignments(), os.path.join( tmp, 'assignments.jsonl' ) ) )
+        ]
+    try:
+        mturk.import_pyarrow( 'parquet' )
+        cases.append( ( 'export_assignments.parquet', lambda: mturk.export_assignments( assignments(), os.path.join( tmp, 'assignments.parquet' ) ) ) )
+    except RuntimeError:
+        pass
+    
+    return cases
+
+def HIT_export_cases( num_rows, tmp ):
+    '''
+    Like export_cases(), for HITs.
+    '''
+    
+    def drain( items ):
+        for item in items: pass
+    
+    HITs = lambda: iter_synthetic_HITs( num_rows )
+    return [
+        ( 'ExternalQuestion.get_as_xml', lambda: [ mturk.ExternalQuestion( 'https://example.com/task?id=%d' % i, 800 ).get_as_xml() for i in range( num_rows ) ] ),
+        ( 'synthetic_HITs', lambda: drain( HITs() ) ),
+        ( 'HITs2CSV', lambda: mturk.HITs2CSV( HITs() ) ),
+        ( 'export_HITs.jsonl', lambda: mturk.export_HITs( HITs(), os.path.join( tmp, 'HITs.jsonl' ) ) )
+        ]
+
+def benchmark_exports( row_counts = ( 1000, 10000, 100000 ), question_counts = ( 1, 10, 100 ), answer_sizes = ( 100, 1000, 10000 ), base = ( 1000, 10, 100 ), memory = True ):
+    '''
+    Times the export paths on synthetic assignments and HITs, varying one
+    of the number of rows, question ids, and answer size at a time,
+    with the others at their values in 'base'.
+    If 'memory' is True, each case is run again under tracemalloc
+    (which slows it down too much to time) for its peak memory.
+    
+    Yields a dictionary per measurement with the keys 'case', 'rows',
+    'questions', 'answer_size', 'seconds', 'microseconds_per_row',
+    and 'peak_bytes' (None if not measured).
+    '''
+    
+    import tempfile, time, tracemalloc
+    
+    base_rows, base_questions, base_answer_size = base
+    settings = [ ( rows, base_questions, base_answer_size ) for rows in row_counts ]
+    settings += [ ( base_rows, questions, base_answer_size ) for questions in question_counts ]
+    settings += [ ( base_rows, base_questions, answer_size ) for answer_size in answer_sizes ]
+    
+    ## The HIT paths only depend on the number of rows.
+    seen = set()
+    for rows, questions, answer_size in settings:
+        if ( rows, questions, answer_size ) in seen: continue
+        seen.add( ( rows, questions, answer_size ) )
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            cases = export_cases( rows, questions, answer_size, tmp )
+            if ( questions, answer_size ) == ( base_questions, base_answer_size ):
+                cases += HIT_export_cases( rows, tmp )
+            
+            for name, run in cases:
+                start = time.perf_counter()
+                run()
+                seconds = time.perf_counter() - start
+                
+                peak = None
+                if memory:
+                    tracemalloc.start()
+                    try:
+                        run()
+                        peak = tracemalloc.get_traced_memory()[1]
+                    finally:
+                        tracemalloc.stop()
+                
+                yield {
+                    'case': name,
+                    'rows': rows,
+                    'questions': questions,
+                    'answer_size': answer_size,
+                    'seconds': seconds,
+                    'microseconds_per_row': 1e6 * seconds / rows,
+                    'peak_bytes': peak
+                    }
+
+def benchmark_bulk( num_HITs = 10000, assignments_per_HIT = 10, concurrency = 20, latency = 0. ):
+    '''
+    Starts fake_mturk.py in another process and, against it, times
+    creating 'num_HITs' HITs with create_HITs_for_external_URLs(),
+    retrieving their 'assignments_per_HIT' assignments each with
+    get_all_assignments_for_HITIds(), and writing those as CSV.
+    Up to 'concurrency' requests are in flight at once, and the fake
+    waits 'latency' seconds before answering each one.
+    Returns a dictionary mapping phase names to ( seconds, number of items ).
+    '''
+    
+    import subprocess, tempfile, time
+    
+    fake_mturk_path = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'fake_mturk.py' )
+    server = subprocess.Popen( [ sys.executable, fake_mturk_path, 'serve', 'assignments_per_HIT=%d' % assignments_per_HIT, 'latency=%s' % latency, 'balance=1e12' ], stdout = subprocess.PIPE, text = True )
+    
+    result = {}
+    try:
+        endpoint_url = server.stdout.readline().strip()
+        
+        ## The fake doesn't check signatures, but boto3 needs something to sign with.
+        os.environ.setdefault( 'AWS_ACCESS_KEY_ID', 'fake' )
+        os.environ.setdefault( 'AWS_SECRET_ACCESS_KEY', 'fake' )
+        ## Keep the client-side rate limiting in the measurement,
+        ## but not MTurk's rates.
+        client = mturk.create_mturk( endpoint_url = endpoint_url, max_pool_connections = concurrency, rate_limit = { 'rates': { 'create_hit': 1e6, 'create_hit_with_hit_type': 1e6 }, 'default_rate': 1e6 } )
+        
+        URLs = [ 'https://example.com/task?id=%d' % i for i in range( num_HITs ) ]
+        
+        with tempfile.TemporaryDirectory() as tmp, open( os.devnull, 'w' ) as devnull:
+            ## Don't time printing a line per HIT to the terminal.
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                start = time.perf_counter()
+                HITs = mturk.create_HITs_for_external_URLs(
+                    client, URLs,
+                    frame_height = 800, Reward = '0.01', MaxAssignments = max( 1, assignments_per_HIT ),
+                    Title = 'Benchmark', Description = 'benchmark.py', AssignmentDurationInSeconds = 600, LifetimeInSeconds = 86400,
+                    concurrency = concurrency,
+                    HIT_type_cache_path = os.path.join( tmp, 'hit_types.json' )
+                    )
+                result[ 'submit' ] = ( time.perf_counter() - start, num_HITs )
+                assert None not in HITs
+                
+                start = time.perf_counter()
+                assignments = [ a for HIT_assignments in mturk.get_all_assignments_for_HITIds( client, [ HIT['HITId'] for HIT in HITs ], concurrency = concurrency ) for a in HIT_assignments ]
+                result[ 'retrieve' ] = ( time.perf_counter() - start, len( assignments ) )
+                assert len( assignments ) == num_HITs * assignments_per_HIT
+                
+                start = time.perf_counter()
+                mturk.write_assignments_CSV( assignments, devnull )
+                result[ 'write_CSV' ] = ( time.perf_counter() - start, len( assignments ) )
+            finally:
+                sys.stdout = stdout
+    finally:
+        server.terminate()
+        server.wait()
+    
+    return result
+
+def bulk_results_JSON( result, num_HITs, assignments_per_HIT ):
+    '''
+    Given the result of benchmark_bulk() and its arguments, returns
+    a JSON-serializable dictionary with the settings and, for each phase,
+    the seconds, number of items, and items per second.
+    '''
+    
+    return {
+        'num_HITs': num_HITs,
+        'assignments_per_HIT': assignments_per_HIT,
+        'phases': dict([
+            ( name, { 'seconds': seconds, 'items': count, 'items_per_second': count / seconds if seconds > 0 else 0 } )
+            for name, ( seconds, count ) in result.items()
+            ])
+        }
+
+def bulk_regressions( results, baseline, tolerance = 0.25 ):
+    '''
+    Given two dictionaries returned by bulk_results_JSON(), returns a list of
+    ( phase, items per second, baseline items per second ) for the phases
+    that are more than 'tolerance' (a fraction) slower in 'results' than in
+    'baseline'. Phases missing from either are skipped.
+    '''
+    
+    regressions = []
+    for name, phase in results['phases'].items():
+        if name not in baseline['phases']: continue
+        expected = baseline['phases'][ name ]['items_per_second']
+        if phase['items_per_second'] < expected * ( 1 - tolerance ):
+            regressions.append( ( name, phase['items_per_second'], expected ) )
+    return regressions
+
+def main():
+    def usage():
+        print( 'Usage:', sys.argv[0], '[number_of_answers [answer_size]]', file = sys.stderr )
+        print( 'Usage:', sys.argv[0], 'exports [path/to/results.json] [rows=N,...] [questions=N,...] [answer_sizes=N,...]', file = sys.stderr )
+        print( 'Usage:', sys.argv[0], 'bulk [number_of_HITs [assignments_per_HIT]] [results=path/to/results.json] [baseline=path/to/baseline.json] [tolerance=T]', file = sys.stderr )
+        print( 'Note: "exports" times and measures the peak memory of each export path on synthetic assignments and HITs, varying one of rows, questions, and answer_sizes at a time (the defaults are 1000,10000,100000 and 1,10,100 and 100,1000,10000).  The results are printed and, if a path is given, saved as JSON.', file = sys.stderr )
+        print( 'Note: "bulk" runs against fake_mturk.py, so it needs boto3 but not MTurk.  The defaults submit 10000 HITs and retrieve 100000 assignments.  With results=, the timings are also saved as JSON.  With baseline=, a results file saved earlier, any phase more than T (default 0.25) slower in items per second than in the baseline is reported and the exit status is 1, for a CI job to run.', file = sys.stderr )
+        sys.exit(-1)
+    
+    if len( sys.argv ) > 1 and sys.argv[1] == 'bulk':
+        import json
+        
+        options = dict([ arg.split( '=', 1 ) for arg in sys.argv[2:] if '=' in arg ])
+        argv = [ arg for arg in sys.argv[2:] if '=' not in arg ]
+        if len( argv ) > 2 or not set( options ).issubset( ( 'results', 'baseline', 'tolerance' ) ): usage()
+        try:
+            num_HITs = int( argv[0] ) if len( argv ) > 0 else 10000
+            assignments_per_HIT = int( argv[1] ) if len( argv ) > 1 else 10
+            tolerance = float( options.get( 'tolerance', 0.25 ) )
+        except ValueError:
+            usage()
+        
+        result = benchmark_bulk( num_HITs = num_HITs, assignments_per_HIT = assignments_per_HIT )
+        for name, ( seconds, count ) in result.items():
+            print( '%s: %.3f seconds for %d items (%.0f per second)' % ( name, seconds, count, count / seconds if seconds > 0 else 0 ) )
+        
+        results = bulk_results_JSON( result, num_HITs, assignments_per_HIT )
+        if 'results' in options:
+            with open( options['results'], 'w' ) as f:
+                json.dump( results, f, indent = 2 )
+        
+        if 'baseline' in options:
+            with open( options['baseline'] ) as f:
+                baseline = json.load( f )
+            if ( baseline['num_HITs'], baseline['assignments_per_HIT'] ) != ( num_HITs, assignments_per_HIT ):
+                print( 'Note: the baseline was run with %d HITs and %d assignments per HIT.' % ( baseline['num_HITs'], baseline['assignments_per_HIT'] ), file = sys.stderr )
+            regressions = bulk_regressions( results, baseline, tolerance )
+            for name, per_second, expected in regressions:
+                print( 'Regression: %s: %.0f per second, baseline %.0f per second' % ( name, per_second, expected ), file = sys.stderr )
+            if len( regressions ) > 0: sys.exit(1)
+        return
+    
+    if len( sys.argv ) > 1 and sys.argv[1] == 'exports':
+        import json
+        
+        argv = sys.argv[2:]
+        results_path = None
+        if len( argv ) > 0 and '=' not in argv[0]:
+            results_path = argv[0]
+            argv = argv[1:]
+        
+        kwargs = {}
+        names = { 'rows': 'row_counts', 'questions': 'question_counts', 'answer_sizes': 'answer_sizes' }
+        for arg in argv:
+            name, _, values = arg.partition( '=' )
+            if name not in names: usage()
+            try:
+                kwargs[ names[ name ] ] = [ int( value ) for value in values.split( ',' ) ]
+            except ValueError:
+                usage()
+        
+        results = []
+        for result in benchmark_exports( **kwargs ):
+            results.append( result )
+            print( '%(case)s: %(rows)d rows, %(questions)d questions, %(answer_size)d-character answers: %(seconds).3f seconds (%(microseconds_per_row).1f microseconds per row), peak memory %(peak_bytes)s bytes' % result, flush = True )
+        
+        if results_path is not None:
+            with open( results_path, 'w' ) as f:
+                json.dump( results, f, indent = 2 )
+        return
+    
+    try:
+        num_answers = int( sys.argv[1] ) if len( sys.argv ) > 1 else 1000
+        answer_size = int( sys.argv[2] ) if len( sys.argv ) > 2 else 100
+    except ValueError:
+        usage()
+    
+    result = benchmark_answer_parsing( num_answers = num_answers, answer_size = answer_size )
+    for name, seconds in result.items():
+        print( '%s: %.3f seconds for %d answers (%.1f microseconds each)' % ( name, seconds, num_answers, 1e6 * seconds / num_answers ) )
+
+if __name__ == '__main__': main()
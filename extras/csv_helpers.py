@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
 '''
-A convenience script to extract a single named column from a CSV file.
+A convenience script to extract named columns from one or more CSV files.
 
-Usage: ./csv_helpers.py path/to/file.csv column_name
+Usage: ./csv_helpers.py path/to/file.csv [path/to/file2.csv ...] column_name [column_name2 ...]
 
 
 Author: Yotam Gingold <yotam@yotamgingold.com>
@@ -17,37 +17,180 @@ import csv
 ## Up the field size limit, because sometimes I store base64-encoded PNG's in the columns.
 csv.field_size_limit( 1310720 )
 
-def get_columns_from_csv_file_object( column_names, csv_file_object ):
+## The columns CSVIndex indexes by default.
+DEFAULT_INDEX_COLUMNS = ( 'WorkerId', 'HITId', 'AssignmentId' )
+
+def iter_columns_from_csv_file_object( column_names, csv_file_object ):
     '''
     Given a sequence of column names 'column_names' and
     a file-like object 'csv_file_object' as would be returned
     from calling open() on a CSV file with a header row,
-    returns, for each row, the sequence of elements corresponding to the given column names.
+    yields, for each row, a tuple of the elements corresponding to the given column names.
+    
+    The header is looked up once, and rows are read one at a time.
+    Raises a KeyError if a column name isn't in the header.
     '''
     
-    result = [
-        [ ( line[ column_name ] if column_name in line else None ) for column_name in column_names ]
-        for line in csv.DictReader( csv_file_object )
-        ]
+    reader = csv.reader( csv_file_object )
+    header = next( reader, [] )
+    
+    indices = []
+    for column_name in column_names:
+        if column_name not in header:
+            raise KeyError( 'Column name does not exist: ' + column_name )
+        indices.append( header.index( column_name ) )
+    
+    for row in reader:
+        ## A short row is missing its last columns, like csv.DictReader's None.
+        yield tuple([ ( row[i] if i < len( row ) else None ) for i in indices ])
+
+def get_columns_from_csv_file_object( column_names, csv_file_object ):
+    '''
+    Given a sequence of column names 'column_names' and
+    a file-like object 'csv_file_object' as would be returned
+    from calling open() on a CSV file with a header row,
+    returns, for each row, the sequence of elements corresponding to the given column names.
     
-    if None in result:
-        ## If the column name isn't in one row, it shouldn't be in any rows.
-        assert all([ e is None for e in result ])
-        raise KeyError( 'Column name does not exist: ' + column_name )
+    See iter_columns_from_csv_file_object() to avoid building the whole list.
+    '''
     
-    return result
+    return [ list( row ) for row in iter_columns_from_csv_file_object( column_names, csv_file_object ) ]
 
 def get_columns_from_csv_path( column_names, csv_path ):
     '''
     The same as get_columns_from_csv_file_object(), but takes a path to a CSV file
     instead of an file-like object.
     '''
-    return get_columns_from_csv_file_object( column_names, open( csv_path, 'rU' ) )
+    with open( csv_path, newline = '' ) as f:
+        return get_columns_from_csv_file_object( column_names, f )
 
 def get_column_from_csv_path( column_name, csv_path ):
     return [ column[0] for column in get_columns_from_csv_path( [column_name], csv_path ) ]
 
-def get_lines_matching_column_values_from_csv_path( column_name2values, csv_path ):
+def iter_csv_records_with_offsets( binary_file, encoding = 'utf-8' ):
+    '''
+    Given a CSV file opened in binary mode, yields ( offset, row ) for each
+    record, where 'offset' is the byte offset at which the record starts
+    (so that seeking there and parsing reads it back)
+    and 'row' is the list of fields.
+    Records may span lines (quoted newlines).
+    '''
+    
+    position = [ binary_file.tell() ]
+    def lines():
+        for line in binary_file:
+            position[0] += len( line )
+            yield line.decode( encoding )
+    
+    ## csv.reader pulls exactly the lines of each record, so the position
+    ## before a record is the position after the previous one.
+    reader = csv.reader( lines() )
+    while True:
+        offset = position[0]
+        row = next( reader, None )
+        if row is None: break
+        yield ( offset, row )
+
+class CSVIndex:
+    '''
+    An on-disk index of a CSV file's rows by the values of some columns
+    (by default, WorkerId, HITId, and AssignmentId),
+    so that the rows with a given value can be read without scanning
+    the whole file.
+    
+    The index is a SQLite file next to the CSV file (by default,
+    'csv_path' + ".index.sqlite") mapping ( column, value ) to the byte
+    offsets of the rows. It remembers the CSV file's modification time and
+    size, and is rebuilt (with one scan) whenever either changes.
+    Columns the CSV file doesn't have are skipped.
+    '''
+    
+    def __init__( self, csv_path, index_path = None, column_names = DEFAULT_INDEX_COLUMNS ):
+        import sqlite3
+        
+        self.csv_path = csv_path
+        self.column_names = tuple( column_names )
+        if index_path is None: index_path = csv_path + '.index.sqlite'
+        
+        self.db = sqlite3.connect( index_path )
+        with self.db:
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS meta ( key TEXT PRIMARY KEY, value TEXT )' )
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS offsets ( column_name TEXT, value TEXT, offset INTEGER )' )
+            self.db.execute( 'CREATE INDEX IF NOT EXISTS offsets_value ON offsets ( column_name, value )' )
+        
+        if not self.is_current(): self.rebuild()
+    
+    def close( self ):
+        self.db.close()
+    
+    def __enter__( self ):
+        return self
+    
+    def __exit__( self, *args ):
+        self.close()
+    
+    def stamp( self ):
+        ## What the index must match to be current.
+        import os, json
+        stat = os.stat( self.csv_path )
+        return json.dumps( [ stat.st_mtime_ns, stat.st_size, self.column_names ] )
+    
+    def is_current( self ):
+        row = self.db.execute( 'SELECT value FROM meta WHERE key = ?', ( 'stamp', ) ).fetchone()
+        return row is not None and row[0] == self.stamp()
+    
+    def rebuild( self ):
+        '''
+        Scans the CSV file and replaces the index.
+        '''
+        
+        import json
+        
+        stamp = self.stamp()
+        with open( self.csv_path, 'rb' ) as f:
+            records = iter_csv_records_with_offsets( f )
+            offset, header = next( records, ( 0, [] ) )
+            indexed = [ ( name, header.index( name ) ) for name in self.column_names if name in header ]
+            
+            def entries():
+                for offset, row in records:
+                    for name, i in indexed:
+                        if i < len( row ): yield ( name, row[i], offset )
+            
+            with self.db:
+                self.db.execute( 'DELETE FROM offsets' )
+                self.db.executemany( 'INSERT INTO offsets VALUES ( ?, ?, ? )', entries() )
+                self.db.execute( 'INSERT OR REPLACE INTO meta VALUES ( ?, ? )', ( 'header', json.dumps( header ) ) )
+                self.db.execute( 'INSERT OR REPLACE INTO meta VALUES ( ?, ? )', ( 'stamp', stamp ) )
+    
+    def header( self ):
+        import json
+        return json.loads( self.db.execute( 'SELECT value FROM meta WHERE key = ?', ( 'header', ) ).fetchone()[0] )
+    
+    def has_column( self, column_name ):
+        return column_name in self.column_names and column_name in self.header()
+    
+    def lines_with_value( self, column_name, value ):
+        '''
+        Returns, in file order, the rows whose 'column_name' is 'value',
+        as dictionaries like csv.DictReader's.
+        '''
+        
+        assert self.has_column( column_name )
+        if not self.is_current(): self.rebuild()
+        
+        header = self.header()
+        offsets = [ offset for ( offset, ) in self.db.execute( 'SELECT offset FROM offsets WHERE column_name = ? AND value = ? ORDER BY offset', ( column_name, value ) ) ]
+        
+        result = []
+        with open( self.csv_path, 'rb' ) as f:
+            for offset in offsets:
+                f.seek( offset )
+                offset, row = next( iter_csv_records_with_offsets( f ) )
+                result.append( dict( zip( header, row + [ None ] * ( len( header ) - len( row ) ) ) ) )
+        return result
+
+def get_lines_matching_column_values_from_csv_path( column_name2values, csv_path, index = False ):
     '''
     Given a dictionary 'column_name2values' mapping a set of column names to values and
     a path to a CSV file that has a header row,
@@ -55,45 +198,90 @@ def get_lines_matching_column_values_from_csv_path( column_name2values, csv_path
     values equaling the corresponding values in 'column_name2values'.
     The lines are returned in order and as dictionaries, as would be returned by
     csv.DictReader. In effect, this function filters csv.DictReader.
+    
+    If 'index' is True, or a CSVIndex for 'csv_path', and one of the columns
+    is indexed, the index is used to read only the rows with that value
+    instead of scanning the file.
     '''
     
-    return [
-        line for line in csv.DictReader( open( csv_path ) )
-        if all([
-            line[name] == value
-            for name, value in column_name2values.items()
-            ])
-        ]
+    if index:
+        if index is True:
+            with CSVIndex( csv_path ) as index:
+                return get_lines_matching_column_values_from_csv_path( column_name2values, csv_path, index = index )
+        
+        indexed = [ name for name in column_name2values if index.has_column( name ) ]
+        if len( indexed ) > 0:
+            return [
+                line for line in index.lines_with_value( indexed[0], column_name2values[ indexed[0] ] )
+                if all([
+                    line[name] == value
+                    for name, value in column_name2values.items()
+                    ])
+                ]
+    
+    with open( csv_path, newline = '' ) as f:
+        return [
+            line for line in csv.DictReader( f )
+            if all([
+                line[name] == value
+                for name, value in column_name2values.items()
+                ])
+            ]
+
+def get_columns_from_csv_paths( column_names, csv_paths, max_workers = None ):
+    '''
+    Given a sequence of column names 'column_names' and a sequence of paths
+    to CSV files, returns a list with the result of get_columns_from_csv_path()
+    for each path, in order.
+    The files are parsed in parallel by up to 'max_workers' processes
+    (by default, one per CPU).
+    '''
+    
+    import concurrent.futures, functools
+    
+    csv_paths = list( csv_paths )
+    if len( csv_paths ) <= 1 or max_workers == 1:
+        return [ get_columns_from_csv_path( column_names, csv_path ) for csv_path in csv_paths ]
+    
+    with concurrent.futures.ProcessPoolExecutor( max_workers = max_workers ) as executor:
+        return list( executor.map( functools.partial( get_columns_from_csv_path, column_names ), csv_paths ) )
 
 def main():
     import os, sys
     
     def usage():
-        print( 'Usage:', sys.argv[0], 'path/to/file.csv column_name [column_name2 ...]', file = sys.stderr )
+        print( 'Usage:', sys.argv[0], 'path/to/file.csv [path/to/file2.csv ...] column_name [column_name2 ...]', file = sys.stderr )
+        print( 'Note: With more than one CSV file, the files are read in parallel, and each output row starts with the path of its file.', file = sys.stderr )
         sys.exit(-1)
     
-    try:
-        csv_path, column_names = sys.argv[1], sys.argv[2:]
-    except:
-        usage()
+    ## The leading arguments ending in ".csv" (or "-" for stdin) are files.
+    argv = sys.argv[1:]
+    num_paths = 0
+    while num_paths < len( argv ) and ( argv[ num_paths ] == '-' or argv[ num_paths ].lower().endswith( '.csv' ) ):
+        num_paths += 1
+    ## The first argument is always a file.
+    num_paths = max( num_paths, 1 )
+    csv_paths, column_names = argv[ :num_paths ], argv[ num_paths: ]
     
-    ## In case the user thinks they can pass multiple CSV files instead of multiple column names.
-    if len( column_names ) > 1 and all([ name.lower().endswith('.csv') for name in column_names[:-1] ]):
+    if len( csv_paths ) == 0 or len( column_names ) == 0:
         usage()
     
-    if csv_path == '-':
-        columns = get_columns_from_csv_file_object( column_names, sys.stdin )
+    out = csv.writer( sys.stdout, lineterminator = '\n' )
     
-    else:
-        if not os.path.exists( csv_path ):
-            usage()
-        
-        columns = get_columns_from_csv_path( column_names, csv_path )
+    if csv_paths == [ '-' ]:
+        out.writerows( iter_columns_from_csv_file_object( column_names, sys.stdin ) )
+        return
+    
+    if not all([ os.path.exists( csv_path ) for csv_path in csv_paths ]):
+        usage()
     
-    ## Transpose the column into a row:
-    # print ','.join( column )
+    if len( csv_paths ) == 1:
+        ## Stream the rows.
+        with open( csv_paths[0], newline = '' ) as f:
+            out.writerows( iter_columns_from_csv_file_object( column_names, f ) )
+        return
     
-    # for el in columns: print el
-    csv.writer( sys.stdout, lineterminator = '\n' ).writerows( columns )
+    for csv_path, columns in zip( csv_paths, get_columns_from_csv_paths( column_names, csv_paths ) ):
+        out.writerows([ [ csv_path ] + row for row in columns ])
 
 if __name__ == '__main__': main()
@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+
+'''
+A local stand-in for the MTurk requester API, for measuring mturk.py
+without the sandbox's latency and rate limits.
+
+It speaks the same JSON-over-HTTP protocol as MTurk, so a boto3 client
+(and mturk.py) can use it by pointing its endpoint at it:
+    ./fake_mturk.py serve 8000 assignments_per_HIT=10 &
+    MTURK_PY_ENDPOINT_URL=http://127.0.0.1:8000 ../mturk.py submit job.json
+boto3 still needs (any) AWS credentials to sign requests.
+
+It can also record real MTurk responses and replay them:
+    ./fake_mturk.py record recording.jsonl [really] info HITId
+    ./fake_mturk.py serve 8000 replay=recording.jsonl
+
+Usage: ./fake_mturk.py serve [port] [option=value ...]
+Usage: ./fake_mturk.py record path/to/recording.jsonl [really] command [args ...]
+
+
+Author: Yotam Gingold <yotam@yotamgingold.com>
+Home: https://github.com/yig/mturk.py
+
+Any copyright is dedicated to the Public Domain.
+http://creativecommons.org/publicdomain/zero/1.0/
+'''
+
+import os, sys
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+import mturk
+
+class FakeMTurkError( Exception ):
+    '''
+    An error response, with MTurk's error code (e.g. 'RequestError')
+    and HTTP status.
+    '''
+    
+    def __init__( self, code, message, status = 400 ):
+        Exception.__init__( self, message )
+        self.code = code
+        self.message = message
+        self.status = status
+
+class FakeMTurk:
+    '''
+    An in-memory MTurk account, answering requests like MTurk would:
+    create_hit, create_hit_type, create_hit_with_hit_type, get_hit,
+    list_hits, list_reviewable_hits, list_assignments_for_hit,
+    get_assignment, approve_assignment, reject_assignment, send_bonus,
+    get_account_balance, update_expiration_for_hit,
+    create_additional_assignments_for_hit, and delete_hit.
+    
+    Each new HIT gets 'assignments_per_HIT' Submitted assignments
+    (up to its MaxAssignments) from a pool of 'num_workers' workers,
+    each answering 'num_questions' questions, so that there is something
+    to retrieve and review.
+    
+    To imitate the real service, each request waits 'latency' seconds,
+    requests beyond 'throttle' per second (if given) get a
+    ThrottlingException, and a fraction 'failure_rate' of requests
+    get a ServiceFault.
+    
+    If 'replay' is a path to a recording made by record_responses(),
+    a request with the same operation and parameters
+    (ignoring UniqueRequestToken) gets the recorded response,
+    in the order they were recorded, repeating the last one.
+    Other requests are answered by the in-memory account.
+    '''
+    
+    operations = ( 'CreateHIT', 'CreateHITType', 'CreateHITWithHITType', 'GetHIT', 'ListHITs', 'ListReviewableHITs', 'ListAssignmentsForHIT', 'GetAssignment', 'ApproveAssignment', 'RejectAssignment', 'SendBonus', 'GetAccountBalance', 'UpdateExpirationForHIT', 'CreateAdditionalAssignmentsForHIT', 'DeleteHIT' )
+    
+    def __init__( self, balance = 10000., assignments_per_HIT = 0, num_workers = 1000, num_questions = 3, latency = 0., throttle = None, failure_rate = 0., replay = None, seed = 0 ):
+        import random, threading, time
+        
+        self.balance = float( balance )
+        self.assignments_per_HIT = int( assignments_per_HIT )
+        self.num_questions = int( num_questions )
+        self.latency = float( latency )
+        self.throttle = None if throttle is None else float( throttle )
+        self.failure_rate = float( failure_rate )
+        
+        self.random = random.Random( seed )
+        self.lock = threading.Lock()
+        
+        self.workers = [ self.new_id( 14, 'A' ) for i in range( int( num_workers ) ) ]
+        ## By HITId, in creation order.
+        self.hits = {}
+        ## By AssignmentId, for the HITs whose assignments were listed.
+        self.assignments = {}
+        self.hit_types = {}
+        ## UniqueRequestToken to HITId or AssignmentId.
+        self.tokens = {}
+        
+        ## For 'throttle', a token bucket with a one-second burst.
+        self.allowance = self.throttle
+        self.last_request = time.monotonic()
+        
+        self.recorded = {}
+        if replay is not None:
+            self.recorded = load_recording( replay )
+    
+    def new_id( self, length = 30, prefix = '' ):
+        alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+        return prefix + ''.join([ self.random.choice( alphabet ) for i in range( length - len( prefix ) ) ])
+    
+    def request( self, operation, params ):
+        '''
+        Answers one request, given the operation name from the
+        X-Amz-Target header (e.g. 'CreateHIT') and the decoded JSON body.
+        Returns ( HTTP status, JSON body as bytes ).
+        '''
+        
+        import json, time
+        
+        if self.latency > 0: time.sleep( self.latency )
+        
+        with self.lock:
+            key = recording_key( operation, params )
+            if key in self.recorded:
+                responses = self.recorded[ key ]
+                status, body = responses.pop(0) if len( responses ) > 1 else responses[0]
+                return status, body.encode( 'utf-8' )
+            
+            try:
+                if self.throttle is not None:
+                    now = time.monotonic()
+                    self.allowance = min( self.throttle, self.allowance + ( now - self.last_request ) * self.throttle )
+                    self.last_request = now
+                    if self.allowance < 1.:
+                        raise FakeMTurkError( 'ThrottlingException', 'Rate exceeded' )
+                    self.allowance -= 1.
+                
+                if self.random.random() < self.failure_rate:
+                    raise FakeMTurkError( 'ServiceFault', 'The service is unavailable. (injected failure)', 500 )
+                
+                if operation not in self.operations:
+                    raise FakeMTurkError( 'UnknownOperationException', 'FakeMTurk does not support ' + operation )
+                
+                status, result = 200, getattr( self, operation )( params )
+            except FakeMTurkError as e:
+                status, result = e.status, { '__type': e.code, 'Message': e.message }
+        
+        return status, json.dumps( result ).encode( 'utf-8' )
+    
+    ## Helpers for the operations. They are called with the lock held.
+    
+    def hit( self, HITId ):
+        if HITId not in self.hits:
+            raise FakeMTurkError( 'RequestError', 'Hit %s does not exist.' % HITId )
+        return self.hits[ HITId ]
+    
+    def assignment( self, AssignmentId ):
+        if AssignmentId not in self.assignments:
+            raise FakeMTurkError( 'RequestError', 'Assignment %s does not exist.' % AssignmentId )
+        return self.assignments[ AssignmentId ]
+    
+    def charge( self, amount ):
+        if amount > self.balance:
+            raise FakeMTurkError( 'RequestError', 'You do not have enough funds to perform this operation.' )
+        self.balance -= amount
+    
+    def check_token( self, params ):
+        token = params.get( 'UniqueRequestToken' )
+        if token is not None and token in self.tokens:
+            raise FakeMTurkError( 'RequestError', 'The UniqueRequestToken "%s" was already used for %s.' % ( token, self.tokens[ token ] ) )
+    
+    def assignments_of( self, hit ):
+        '''
+        Returns the HIT's assignments, making up its Submitted ones
+        the first time.
+        '''
+        
+        if hit['Assignments'] is None:
+            hit['Assignments'] = []
+            num = min( self.assignments_per_HIT, hit['MaxAssignments'] )
+            if num <= len( self.workers ): workers = self.random.sample( self.workers, num )
+            else: workers = [ self.random.choice( self.workers ) for i in range( num ) ]
+            
+            for WorkerId in workers:
+                AcceptTime = hit['CreationTime'] + self.random.uniform( 1, 600 )
+                SubmitTime = AcceptTime + self.random.lognormvariate( 4, 1 )
+                answers = ''.join([ '<Answer><QuestionIdentifier>q%d</QuestionIdentifier><FreeText>%s</FreeText></Answer>' % ( i, self.random.choice( 'abc' ) ) for i in range( self.num_questions ) ])
+                a = {
+                    'AssignmentId': self.new_id(),
+                    'WorkerId': WorkerId,
+                    'HITId': hit['HITId'],
+                    'AssignmentStatus': 'Submitted',
+                    'AutoApprovalTime': SubmitTime + hit['AutoApprovalDelayInSeconds'],
+                    'AcceptTime': AcceptTime,
+                    'SubmitTime': SubmitTime,
+                    'Deadline': AcceptTime + hit['AssignmentDurationInSeconds'],
+                    'Answer': '<?xml version="1.0" encoding="ASCII"?><QuestionFormAnswers xmlns="http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2005-10-01/QuestionFormAnswers.xsd">' + answers + '</QuestionFormAnswers>'
+                    }
+                hit['Assignments'].append( a )
+                self.assignments[ a['AssignmentId'] ] = a
+        
+        return hit['Assignments']
+    
+    def num_assignments( self, hit ):
+        if hit['Assignments'] is None: return min( self.assignments_per_HIT, hit['MaxAssignments'] )
+        return len( hit['Assignments'] )
+    
+    def HIT_view( self, hit ):
+        ## The HIT as MTurk returns it. There are never assignments in progress.
+        import time
+        
+        completed = self.num_assignments( hit )
+        expired = hit['Expiration'] <= time.time()
+        available = 0 if expired else hit['MaxAssignments'] - completed
+        
+        view = dict([ ( key, value ) for key, value in hit.items() if key != 'Assignments' ])
+        view['HITStatus'] = 'Reviewable' if available == 0 else 'Assignable'
+        view['HITReviewStatus'] = 'NotReviewed'
+        view['NumberOfAssignmentsPending'] = 0
+        view['NumberOfAssignmentsAvailable'] = available
+        view['NumberOfAssignmentsCompleted'] = completed
+        return view
+    
+    def page( self, items, params ):
+        ## NextToken is the offset of the next page.
+        ## Like MTurk, the last page of results still has a NextToken,
+        ## and the end is an empty page.
+        start = int( params.get( 'NextToken', 0 ) )
+        end = start + int( params.get( 'MaxResults', 10 ) )
+        result = { 'NumResults': len( items[ start:end ] ) }
+        if start < len( items ): result['NextToken'] = str( end )
+        return items[ start:end ], result
+    
+    ## The operations.
+    
+    def CreateHITType( self, params ):
+        import json, hashlib, base64
+        
+        ## Like MTurk, the same arguments get the same HITTypeId.
+        digest = hashlib.sha1( json.dumps( params, sort_keys = True ).encode( 'utf-8' ) ).digest()
+        HITTypeId = base64.b32encode( digest ).decode( 'ascii' )[:30]
+        self.hit_types[ HITTypeId ] = dict( params )
+        return { 'HITTypeId': HITTypeId }
+    
+    def CreateHIT( self, params ):
+        HITTypeId = self.CreateHITType( dict([ ( key, params[ key ] ) for key in mturk.HIT_type_fields if key in params ]) )['HITTypeId']
+        return self.CreateHITWithHITType( dict( params, HITTypeId = HITTypeId ) )
+    
+    def CreateHITWithHITType( self, params ):
+        import time
+        
+        if params['HITTypeId'] not in self.hit_types:
+            raise FakeMTurkError( 'RequestError', 'HITType %s does not exist.' % params['HITTypeId'] )
+        self.check_token( params )
+        
+        hit_type = self.hit_types[ params['HITTypeId'] ]
+        self.charge( params['MaxAssignments'] * mturk.total_payment_from_worker_payment( float( hit_type['Reward'] ), params['MaxAssignments'] ) )
+        
+        now = time.time()
+        hit = {
+            'HITId': self.new_id(),
+            'HITTypeId': params['HITTypeId'],
+            'HITGroupId': params['HITTypeId'],
+            'CreationTime': now,
+            'Title': hit_type.get( 'Title' ),
+            'Description': hit_type.get( 'Description' ),
+            'Question': params.get( 'Question' ),
+            'Keywords': hit_type.get( 'Keywords', '' ),
+            'MaxAssignments': params['MaxAssignments'],
+            'Reward': hit_type['Reward'],
+            'AutoApprovalDelayInSeconds': hit_type.get( 'AutoApprovalDelayInSeconds', 2592000 ),
+            'Expiration': now + params['LifetimeInSeconds'],
+            'AssignmentDurationInSeconds': hit_type['AssignmentDurationInSeconds'],
+            'RequesterAnnotation': params.get( 'RequesterAnnotation', '' ),
+            'QualificationRequirements': hit_type.get( 'QualificationRequirements', [] ),
+            'Assignments': None
+            }
+        self.hits[ hit['HITId'] ] = hit
+        if 'UniqueRequestToken' in params: self.tokens[ params['UniqueRequestToken'] ] = hit['HITId']
+        
+        return { 'HIT': self.HIT_view( hit ) }
+    
+    def GetHIT( self, params ):
+        return { 'HIT': self.HIT_view( self.hit( params['HITId'] ) ) }
+    
+    def ListHITs( self, params ):
+        hits, result = self.page( list( self.hits.values() ), params )
+        result['HITs'] = [ self.HIT_view( hit ) for hit in hits ]
+        return result
+    
+    def ListReviewableHITs( self, params ):
+        ## There is no Reviewing status here, so that lists nothing.
+        views = [ self.HIT_view( hit ) for hit in self.hits.values() if params.get( 'HITTypeId' ) in ( None, hit['HITTypeId'] ) ]
+        views = [ view for view in views if view['HITStatus'] == params.get( 'Status', 'Reviewable' ) ]
+        hits, result = self.page( views, params )
+        result['HITs'] = hits
+        return result
+    
+    def ListAssignmentsForHIT( self, params ):
+        assignments = self.assignments_of( self.hit( params['HITId'] ) )
+        if 'AssignmentStatuses' in params:
+            assignments = [ a for a in assignments if a['AssignmentStatus'] in params['AssignmentStatuses'] ]
+        assignments, result = self.page( assignments, params )
+        result['Assignments'] = assignments
+        return result
+    
+    def GetAssignment( self, params ):
+        a = self.assignment( params['AssignmentId'] )
+        return { 'Assignment': a, 'HIT': self.HIT_view( self.hit( a['HITId'] ) ) }
+    
+    def ApproveAssignment( self, params ):
+        import time
+        
+        a = self.assignment( params['AssignmentId'] )
+        if not ( a['AssignmentStatus'] == 'Submitted' or ( a['AssignmentStatus'] == 'Rejected' and params.get( 'OverrideRejection' ) ) ):
+            raise FakeMTurkError( 'RequestError', 'This operation can be called with a status of: Submitted (%s)' % a['AssignmentId'] )
+        a['AssignmentStatus'] = 'Approved'
+        a['ApprovalTime'] = time.time()
+        if 'RequesterFeedback' in params: a['RequesterFeedback'] = params['RequesterFeedback']
+        return {}
+    
+    def RejectAssignment( self, params ):
+        import time
+        
+        a = self.assignment( params['AssignmentId'] )
+        if a['AssignmentStatus'] != 'Submitted':
+            raise FakeMTurkError( 'RequestError', 'This operation can be called with a status of: Submitted (%s)' % a['AssignmentId'] )
+        a['AssignmentStatus'] = 'Rejected'
+        a['RejectionTime'] = time.time()
+        a['RequesterFeedback'] = params['RequesterFeedback']
+        return {}
+    
+    def SendBonus( self, params ):
+        a = self.assignment( params['AssignmentId'] )
+        if a['WorkerId'] != params['WorkerId']:
+            raise FakeMTurkError( 'RequestError', 'Assignment %s was not done by worker %s.' % ( a['AssignmentId'], params['WorkerId'] ) )
+        self.check_token( params )
+        ## Amazon takes 20% of bonuses.
+        self.charge( 1.2 * float( params['BonusAmount'] ) )
+        if 'UniqueRequestToken' in params: self.tokens[ params['UniqueRequestToken'] ] = a['AssignmentId']
+        return {}
+    
+    def GetAccountBalance( self, params ):
+        return { 'AvailableBalance': '%.2f' % self.balance, 'OnHoldBalance': '0.00' }
+    
+    def UpdateExpirationForHIT( self, params ):
+        hit = self.hit( params['HITId'] )
+        available = self.HIT_view( hit )['NumberOfAssignmentsAvailable']
+        hit['Expiration'] = params['ExpireAt']
+        ## Expiring a HIT early refunds the assignments nobody did.
+        refunded = available - self.HIT_view( hit )['NumberOfAssignmentsAvailable']
+        self.balance += refunded * mturk.total_payment_from_worker_payment( float( hit['Reward'] ), hit['MaxAssignments'] )
+        return {}
+    
+    def CreateAdditionalAssignmentsForHIT( self, params ):
+        hit = self.hit( params['HITId'] )
+        self.check_token( params )
+        self.charge( params['NumberOfAdditionalAssignments'] * mturk.total_payment_from_worker_payment( float( hit['Reward'] ), hit['MaxAssignments'] ) )
+        hit['MaxAssignments'] += params['NumberOfAdditionalAssignments']
+        if 'UniqueRequestToken' in params: self.tokens[ params['UniqueRequestToken'] ] = hit['HITId']
+        return {}
+    
+    def DeleteHIT( self, params ):
+        hit = self.hit( params['HITId'] )
+        if self.HIT_view( hit )['HITStatus'] != 'Reviewable' or any([ a['AssignmentStatus'] == 'Submitted' for a in self.assignments_of( hit ) ]):
+            raise FakeMTurkError( 'RequestError', 'This HIT is currently in the state \'%s\'.  This operation can be called with a status of: Reviewable, with all assignments approved or rejected.' % self.HIT_view( hit )['HITStatus'] )
+        for a in hit['Assignments']: del self.assignments[ a['AssignmentId'] ]
+        del self.hits[ hit['HITId'] ]
+        return {}
+
+def recording_key( operation, params ):
+    ## Tokens differ from run to run.
+    import json
+    return json.dumps( [ operation, dict([ ( key, value ) for key, value in params.items() if key != 'UniqueRequestToken' ]) ], sort_keys = True )
+
+def load_recording( path ):
+    '''
+    Given a path to a recording made by record_responses(),
+    returns a dictionary mapping recording_key() to the list of
+    ( HTTP status, JSON body ) responses, in order.
+    '''
+    
+    import json
+    
+    recorded = {}
+    with open( path ) as f:
+        for line in f:
+            if line.strip() == '': continue
+            record = json.loads( line )
+            recorded.setdefault( recording_key( record['operation'], record['params'] ), [] ).append( ( record['status'], record['body'] ) )
+    return recorded
+
+def record_responses( client, path ):
+    '''
+    Appends every request the boto3 MTurk client 'client' makes,
+    and MTurk's raw response, to the JSON lines file 'path',
+    for FakeMTurk's 'replay'.
+    The requests are recorded as sent, after boto3 serializes them.
+    '''
+    
+    import json, threading
+    
+    lock = threading.Lock()
+    
+    def before_call( params, context, **kwargs ):
+        context['fake_mturk_params'] = json.loads( params['body'] or b'{}' )
+    
+    def after_call( http_response, model, context, **kwargs ):
+        record = { 'operation': model.name, 'params': context.get( 'fake_mturk_params', {} ), 'status': http_response.status_code, 'body': http_response.content.decode( 'utf-8' ) }
+        with lock:
+            with open( path, 'a' ) as f:
+                print( json.dumps( record ), file = f )
+    
+    client.meta.events.register( 'before-call.mturk', before_call )
+    client.meta.events.register( 'after-call.mturk', after_call )
+
+def serve_fake_mturk( fake, port = 0, host = '127.0.0.1' ):
+    '''
+    Returns an HTTP server answering MTurk requests with the FakeMTurk 'fake'
+    on 'host' and 'port' (by default, a free port).
+    Its endpoint URL is "http://host:port", with the port in
+    'server.server_address[1]'.
+    Call serve_forever() on it, perhaps in a thread.
+    '''
+    
+    import json, http.server
+    
+    class Handler( http.server.BaseHTTPRequestHandler ):
+        ## Keep connections open, like MTurk.
+        protocol_version = 'HTTP/1.1'
+        
+        def do_POST( self ):
+            body = self.rfile.read( int( self.headers.get( 'Content-Length', 0 ) ) )
+            operation = self.headers.get( 'X-Amz-Target', '' ).split( '.' )[-1]
+            status, response = fake.request( operation, json.loads( body or b'{}' ) )
+            
+            self.send_response( status )
+            self.send_header( 'Content-Type', 'application/x-amz-json-1.1' )
+            self.send_header( 'Content-Length', str( len( response ) ) )
+            self.end_headers()
+            self.wfile.write( response )
+        
+        def log_message( self, *args ):
+            pass
+    
+    server = http.server.ThreadingHTTPServer( ( host, port ), Handler )
+    server.daemon_threads = True
+    return server
+
+def main():
+    def usage():
+        print( 'Usage:', sys.argv[0], 'serve [port] [option=value ...]', file = sys.stderr )
+        print( 'Usage:', sys.argv[0], 'record path/to/recording.jsonl [really] command [args ...]', file = sys.stderr )
+        print( 'Note: The options for "serve" are balance, assignments_per_HIT, num_workers, num_questions, latency (seconds), throttle (requests per second), failure_rate (0 to 1), replay (path/to/recording.jsonl), and seed.  The port defaults to a free one.  The endpoint URL is printed on the first line.', file = sys.stderr )
+        print( 'Note: "record" runs an mturk.py command against MTurk and appends its requests and responses to path/to/recording.jsonl.', file = sys.stderr )
+        sys.exit(-1)
+    
+    argv = sys.argv[1:]
+    if len( argv ) == 0: usage()
+    
+    if argv[0] == 'serve':
+        argv = argv[1:]
+        port = 0
+        if len( argv ) > 0 and '=' not in argv[0]:
+            try: port = int( argv[0] )
+            except ValueError: usage()
+            argv = argv[1:]
+        
+        options = {}
+        for arg in argv:
+            if '=' not in arg: usage()
+            name, value = arg.split( '=', 1 )
+            if name not in ( 'balance', 'assignments_per_HIT', 'num_workers', 'num_questions', 'latency', 'throttle', 'failure_rate', 'replay', 'seed' ): usage()
+            options[ name ] = value
+        for name in ( 'assignments_per_HIT', 'num_workers', 'num_questions', 'seed' ):
+            if name in options: options[ name ] = int( options[ name ] )
+        
+        server = serve_fake_mturk( FakeMTurk( **options ), port = port )
+        print( 'http://%s:%d' % server.server_address[:2], flush = True )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    
+    elif argv[0] == 'record':
+        if len( argv ) < 3: usage()
+        path = argv[1]
+        
+        ## Record every client the command creates.
+        create_mturk = mturk.create_mturk
+        def create_recording_mturk( *args, **kwargs ):
+            client = create_mturk( *args, **kwargs )
+            record_responses( client, path )
+            return client
+        mturk.create_mturk = create_recording_mturk
+        
+        mturk.run_command( argv[2:] )
+    
+    else:
+        usage()
+
+if __name__ == '__main__': main()
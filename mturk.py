@@ -8,9 +8,9 @@ Any copyright is dedicated to the Public Domain.
 http://creativecommons.org/publicdomain/zero/1.0/
 '''
 
-import boto3
 from datetime import datetime
-import xml.dom.minidom
+import functools
+import contextlib
 
 ## From: https://stackoverflow.com/questions/54198700/how-to-delete-still-available-hits-using-boto3-client
 def expire_hit( mturk, HITId ):
@@ -37,11 +37,433 @@ class ExternalQuestion:
     def get_as_xml(self):
         return self.template % vars(self)
 
-def create_mturk( sandbox = True ):
+class Metrics:
+    '''
+    Counts and times MTurk API calls, via botocore's event hooks,
+    and local phases of work, via timer().
+    
+    For each operation (e.g. 'CreateHIT'), it records the number of calls,
+    errors, throttles, and retries, the bytes sent and received,
+    and a histogram of latencies.
+    For each phase (e.g. 'parse_answer_xml'), it records a histogram
+    of durations.
+    
+    Call install() on a boto3 client to record its calls.
+    Write the results with dump(), as JSON or in the Prometheus text format.
+    '''
+    
+    ## Upper bounds, in seconds, of the histogram buckets.
+    buckets = ( 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf') )
+    
+    def __init__( self ):
+        import threading
+        
+        self.operations = {}
+        self.phases = {}
+        self.lock = threading.Lock()
+        ## So that two dumps don't write the same file at once.
+        self.dump_lock = threading.Lock()
+    
+    def _histogram( self ):
+        return { 'count': 0, 'sum': 0., 'buckets': [0]*len( self.buckets ) }
+    
+    def _observe( self, histogram, seconds ):
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        for i, bound in enumerate( self.buckets ):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+                break
+    
+    def _operation( self, operation ):
+        ## Call with the lock held.
+        if operation not in self.operations:
+            self.operations[ operation ] = { 'calls': 0, 'errors': 0, 'throttles': 0, 'retries': 0, 'bytes_sent': 0, 'bytes_received': 0, 'latency': self._histogram() }
+        return self.operations[ operation ]
+    
+    def install( self, client ):
+        '''
+        Registers with the botocore events of the boto3 client 'client'.
+        '''
+        
+        import time
+        
+        def before_call( model, context, **kwargs ):
+            context['metrics_start'] = time.perf_counter()
+            context['metrics_operation'] = model.name
+        
+        def request_created( request, operation_name, **kwargs ):
+            body = request.body
+            if body is None: return
+            with self.lock:
+                self._operation( operation_name )['bytes_sent'] += len( body )
+        
+        def after_call( http_response, parsed, model, context, **kwargs ):
+            seconds = time.perf_counter() - context.pop( 'metrics_start', time.perf_counter() )
+            with self.lock:
+                stats = self._operation( model.name )
+                stats['calls'] += 1
+                stats['bytes_received'] += len( http_response.content or b'' )
+                if http_response.status_code >= 300: stats['errors'] += 1
+                self._observe( stats['latency'], seconds )
+        
+        def after_call_error( context, **kwargs ):
+            ## The request never got a response (e.g. a connection error).
+            if 'metrics_start' not in context: return
+            seconds = time.perf_counter() - context.pop( 'metrics_start' )
+            with self.lock:
+                stats = self._operation( context['metrics_operation'] )
+                stats['calls'] += 1
+                stats['errors'] += 1
+                self._observe( stats['latency'], seconds )
+        
+        client.meta.events.register( 'before-call.mturk', before_call )
+        client.meta.events.register( 'request-created.mturk', request_created )
+        client.meta.events.register( 'after-call.mturk', after_call )
+        client.meta.events.register( 'after-call-error.mturk', after_call_error )
+    
+    def count( self, operation, field ):
+        '''
+        Adds one to the 'throttles' or 'retries' of 'operation'.
+        Used by RateLimitedClient, which does the retrying.
+        '''
+        
+        with self.lock:
+            self._operation( operation )[ field ] += 1
+    
+    def timer( self, phase ):
+        '''
+        Returns a context manager that records the time spent inside it
+        as one observation of 'phase'.
+        '''
+        
+        import contextlib, time
+        
+        @contextlib.contextmanager
+        def timing():
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                seconds = time.perf_counter() - start
+                with self.lock:
+                    if phase not in self.phases: self.phases[ phase ] = self._histogram()
+                    self._observe( self.phases[ phase ], seconds )
+        
+        return timing()
+    
+    def to_dict( self ):
+        import copy
+        
+        with self.lock:
+            return { 'buckets': [ str( bound ) for bound in self.buckets ], 'operations': copy.deepcopy( self.operations ), 'phases': copy.deepcopy( self.phases ) }
+    
+    def to_prometheus( self ):
+        '''
+        Returns the metrics in the Prometheus text exposition format.
+        '''
+        
+        d = self.to_dict()
+        lines = []
+        
+        def histogram( name, label, histogram ):
+            cumulative = 0
+            for bound, count in zip( self.buckets, histogram['buckets'] ):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr( bound )
+                lines.append( '%s_bucket{%s,le="%s"} %d' % ( name, label, le, cumulative ) )
+            lines.append( '%s_sum{%s} %f' % ( name, label, histogram['sum'] ) )
+            lines.append( '%s_count{%s} %d' % ( name, label, histogram['count'] ) )
+        
+        for field in ( 'calls', 'errors', 'throttles', 'retries', 'bytes_sent', 'bytes_received' ):
+            lines.append( '# TYPE mturk_%s_total counter' % field )
+            for operation, stats in sorted( d['operations'].items() ):
+                lines.append( 'mturk_%s_total{operation="%s"} %d' % ( field, operation, stats[ field ] ) )
+        
+        lines.append( '# TYPE mturk_call_seconds histogram' )
+        for operation, stats in sorted( d['operations'].items() ):
+            histogram( 'mturk_call_seconds', 'operation="%s"' % operation, stats['latency'] )
+        
+        lines.append( '# TYPE mturk_phase_seconds histogram' )
+        for phase, stats in sorted( d['phases'].items() ):
+            histogram( 'mturk_phase_seconds', 'phase="%s"' % phase, stats )
+        
+        return '\n'.join( lines ) + '\n'
+    
+    def dump( self, path ):
+        '''
+        Writes the metrics to 'path', in the Prometheus text format if it
+        ends in ".prom" and as JSON otherwise.
+        The file is replaced atomically, so it can be read at any time.
+        '''
+        
+        import json, os, sys
+        
+        with self.dump_lock:
+            with open( path + '.partial', 'w' ) as f:
+                if path.endswith( '.prom' ):
+                    f.write( self.to_prometheus() )
+                else:
+                    json.dump( self.to_dict(), f, indent = 2 )
+            os.replace( path + '.partial', path )
+        print('[Metrics.dump( %s )]' % ( path, ), file=sys.stderr)
+    
+    def dump_in_background( self, path ):
+        '''
+        Calls dump() in a new thread.
+        This is safe to call from a signal handler, which may interrupt
+        the main thread while it holds 'self.lock'.
+        '''
+        
+        import threading
+        
+        threading.Thread( target = self.dump, args = ( path, ), daemon = True ).start()
+
+## The Metrics that timed() records to, if any.
+active_metrics = None
+
+def timed( phase ):
+    '''
+    Returns a context manager that times 'phase' in 'active_metrics',
+    or does nothing if metrics are off.
+    '''
+    
+    import contextlib
+    
+    if active_metrics is None: return contextlib.nullcontext()
+    return active_metrics.timer( phase )
+
+@contextlib.contextmanager
+def profiled( path, limit = 30 ):
+    '''
+    Returns a context manager that runs its body under cProfile and
+    tracemalloc and then writes a report to 'path': the peak memory,
+    the 'limit' lines holding the most memory at the end,
+    and the 'limit' functions with the most cumulative time.
+    The raw cProfile statistics are saved to 'path' + ".pstats",
+    for pstats or a viewer like snakeviz.
+    
+    NOTE: cProfile only sees the calling thread, so time spent
+          in worker threads shows up as waiting for them.
+          tracemalloc sees all threads.
+    '''
+    
+    import cProfile, pstats, tracemalloc, io, os, sys
+    
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing: tracemalloc.start()
+    tracemalloc.reset_peak()
+    
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces( ( tracemalloc.Filter( False, tracemalloc.__file__ ), ) )
+        if started_tracing: tracemalloc.stop()
+        
+        report = io.StringIO()
+        print('Peak traced memory: %d bytes' % ( peak, ), file=report)
+        print('Traced memory at the end: %d bytes' % ( current, ), file=report)
+        print(file=report)
+        print('Lines holding the most memory at the end:', file=report)
+        for stat in snapshot.statistics( 'lineno' )[:limit]:
+            print('    %s' % ( stat, ), file=report)
+        print(file=report)
+        pstats.Stats( profile, stream = report ).sort_stats( 'cumulative' ).print_stats( limit )
+        
+        with open( path + '.partial', 'w' ) as f: f.write( report.getvalue() )
+        os.replace( path + '.partial', path )
+        profile.dump_stats( path + '.pstats' )
+        print('[profiled( %s ): peak memory %d bytes]' % ( path, peak ), file=sys.stderr)
+
+class TokenBucket:
+    '''
+    A thread-safe token bucket allowing 'rate' calls per second on average,
+    with bursts of up to 'burst' calls.
+    
+    The rate adapts to the service: throttled() halves it (down to
+    'min_rate'), and each succeeded() raises it by 2% of the starting rate,
+    back up to the starting rate.
+    '''
+    
+    def __init__( self, rate, burst = None, min_rate = 0.5 ):
+        import threading, time
+        
+        self.max_rate = float( rate )
+        self.rate = float( rate )
+        self.min_rate = min( float( min_rate ), self.rate )
+        self.burst = float( burst if burst is not None else max( 1., rate ) )
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire( self ):
+        '''
+        Blocks until a call is allowed.
+        '''
+        
+        import time
+        
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min( self.burst, self.tokens + ( now - self.last ) * self.rate )
+                self.last = now
+                if self.tokens >= 1.:
+                    self.tokens -= 1.
+                    return
+                wait = ( 1. - self.tokens ) / self.rate
+            time.sleep( wait )
+    
+    def throttled( self ):
+        with self.lock:
+            self.rate = max( self.min_rate, self.rate / 2 )
+            self.tokens = min( self.tokens, 0. )
+    
+    def succeeded( self ):
+        with self.lock:
+            self.rate = min( self.max_rate, self.rate + 0.02 * self.max_rate )
+
+class RateLimitedClient:
+    '''
+    Wraps a boto3 MTurk client so that every API call goes through a
+    per-operation TokenBucket shared by all threads, and throttled calls
+    are retried with jittered exponential backoff.
+    
+    'rates' maps operation names (e.g. 'create_hit') to calls per second;
+    other operations get 'default_rate' each.
+    A call is retried up to 'max_retries' times if MTurk throttles it
+    or it couldn't connect.
+    A call that fails with a server error, a dropped connection, or
+    a read timeout (which MTurk may have acted on) is only retried if
+    repeating it is harmless: a get_ or list_ call, or one with
+    a UniqueRequestToken.
+    
+    Anything that isn't an API call (e.g. 'meta' or 'exceptions')
+    is passed through to the wrapped client.
+    
+    If a Metrics object 'metrics' is given, throttles and retries
+    are counted in it.
+    '''
+    
+    default_rates = { 'create_hit': 5, 'create_hit_with_hit_type': 5 }
+    throttle_codes = ( 'ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded' )
+    server_error_codes = ( 'ServiceFault', 'ServiceUnavailable', 'InternalError', 'InternalFailure' )
+    
+    def __init__( self, client, rates = None, default_rate = 10, max_retries = 8, base_delay = 0.5, max_delay = 30, metrics = None ):
+        import threading
+        
+        self.client = client
+        self.metrics = metrics
+        self.rates = dict( self.default_rates )
+        if rates is not None: self.rates.update( rates )
+        self.default_rate = default_rate
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        
+        self.buckets = {}
+        self.lock = threading.Lock()
+    
+    def bucket( self, operation ):
+        with self.lock:
+            if operation not in self.buckets:
+                self.buckets[ operation ] = TokenBucket( self.rates.get( operation, self.default_rate ) )
+            return self.buckets[ operation ]
+    
+    def __getattr__( self, name ):
+        attr = getattr( self.client, name )
+        ## Only wrap API operations.
+        if not callable( attr ) or name not in self.client.meta.method_to_api_mapping:
+            return attr
+        
+        def call( **kwargs ):
+            import random, time, sys
+            import botocore.exceptions
+            
+            bucket = self.bucket( name )
+            retry_server_errors = name.startswith( ( 'get_', 'list_' ) ) or 'UniqueRequestToken' in kwargs
+            attempt = 0
+            while True:
+                bucket.acquire()
+                try:
+                    result = attr( **kwargs )
+                    bucket.succeeded()
+                    return result
+                except botocore.exceptions.ClientError as e:
+                    error = e
+                    code = e.response.get( 'Error', {} ).get( 'Code' )
+                    message = e.response.get( 'Error', {} ).get( 'Message', '' )
+                    operation = self.client.meta.method_to_api_mapping[ name ]
+                    if code in self.throttle_codes or ( 'rate' in message.lower() and 'exceed' in message.lower() ):
+                        bucket.throttled()
+                        if self.metrics is not None: self.metrics.count( operation, 'throttles' )
+                    elif not ( retry_server_errors and code in self.server_error_codes ):
+                        raise
+                except ( botocore.exceptions.EndpointConnectionError, botocore.exceptions.ConnectTimeoutError ) as e:
+                    ## The request was never sent.
+                    error = e
+                    code = type( e ).__name__
+                except ( botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError ) as e:
+                    ## The request may have been sent.
+                    if not retry_server_errors: raise
+                    error = e
+                    code = type( e ).__name__
+                
+                attempt += 1
+                if attempt > self.max_retries: raise error
+                if self.metrics is not None: self.metrics.count( self.client.meta.method_to_api_mapping[ name ], 'retries' )
+                
+                ## "Full jitter" backoff.
+                delay = random.uniform( 0, min( self.max_delay, self.base_delay * 2**attempt ) )
+                print('[%s: %s; retrying in %.1f seconds]' % ( name, code, delay ), file=sys.stderr)
+                time.sleep( delay )
+        
+        call.__name__ = name
+        return call
+
+def create_mturk( sandbox = True, max_pool_connections = None, rate_limit = True, metrics = None, log = False, endpoint_url = None ):
+    '''
+    Returns a boto3 MTurk client for the sandbox (the default) or
+    the real marketplace.
+    If 'max_pool_connections' is given, the client's HTTPS connection pool
+    is sized to match, so that that many threads can share the client
+    without waiting on each other for a connection.
+    botocore's default is 10.
+    
+    If 'rate_limit' is True (the default), the client is wrapped in a
+    RateLimitedClient, which does its own retrying instead of botocore.
+    'rate_limit' may also be a dictionary of keyword arguments for
+    RateLimitedClient.
+    
+    If a Metrics object 'metrics' is given, the client's calls
+    are recorded in it.
+    If 'log' is True, botocore logs every request to stderr.
+    That is slow and verbose, so it is off by default.
+    
+    If 'endpoint_url' is given, or $MTURK_PY_ENDPOINT_URL is set,
+    the client talks to it instead of MTurk, regardless of 'sandbox'.
+    That is for a stand-in like extras/fake_mturk.py.
+    A warning is printed when that happens with 'sandbox' False,
+    since the caller asked for the real marketplace and is not getting it.
+    '''
+    
+    import sys
     
+    if endpoint_url is None: endpoint_url = custom_endpoint_url()
+    if endpoint_url is not None and not sandbox:
+        print( '!' * 72, file = sys.stderr )
+        print( 'WARNING: "really" was requested, but the custom endpoint %s is used instead of the real MTurk marketplace.' % ( endpoint_url, ), file = sys.stderr )
+        print( 'Unset $MTURK_PY_ENDPOINT_URL to talk to the real marketplace.', file = sys.stderr )
+        print( '!' * 72, file = sys.stderr )
     ## From: https://stackoverflow.com/questions/43013914/how-to-connect-to-mturk-sandbox-with-boto3
-    endpoint_url = ( 'https://mturk-requester-sandbox.us-east-1.amazonaws.com' if sandbox else 'https://mturk-requester.us-east-1.amazonaws.com' )
-    print('[MTurkConnection( %s )]' % (endpoint_url,))
+    if endpoint_url is None:
+        endpoint_url = ( 'https://mturk-requester-sandbox.us-east-1.amazonaws.com' if sandbox else 'https://mturk-requester.us-east-1.amazonaws.com' )
+    print('[MTurkConnection( %s )]' % (endpoint_url,), file=sys.stderr)
     
     ## Set the credentials with a config file in "~/.aws/credentials":
     '''
@@ -52,6 +474,20 @@ def create_mturk( sandbox = True ):
     ## or with environment variables.
     ## https://boto3.amazonaws.com/v1/documentation/api/latest/guide/quickstart.html#configuration
     
+    config_kwargs = {}
+    if max_pool_connections is not None:
+        config_kwargs[ 'max_pool_connections' ] = max_pool_connections
+    if rate_limit:
+        ## RateLimitedClient retries; botocore shouldn't retry as well.
+        config_kwargs[ 'retries' ] = { 'total_max_attempts': 1 }
+    
+    config = None
+    if len( config_kwargs ) > 0:
+        import botocore.config
+        config = botocore.config.Config( **config_kwargs )
+    
+    import boto3
+    
     mturk = boto3.client(
         'mturk',
         
@@ -61,7 +497,9 @@ def create_mturk( sandbox = True ):
         endpoint_url = endpoint_url,
         
         ## This shouldn't be necessary, because we specify a full endpoint_url, but it is.
-        region_name = 'us-east-1'
+        region_name = 'us-east-1',
+        
+        config = config
         )
     
     ## With debug set to 2, all requests are printed to stdout.
@@ -70,12 +508,30 @@ def create_mturk( sandbox = True ):
     # debug = 1
     ## UPDATE: boto3 doesn't use a debug parameter when opening the connection.
     ## From: https://stackoverflow.com/questions/29929540/how-to-view-boto3-https-request-string
-    boto3.set_stream_logger( name = 'botocore' )
-    import logging
-    logging.getLogger('botocore').setLevel( logging.INFO )
+    if log:
+        boto3.set_stream_logger( name = 'botocore' )
+        import logging
+        logging.getLogger('botocore').setLevel( logging.INFO )
+    
+    if metrics is not None:
+        metrics.install( mturk )
+    
+    if rate_limit:
+        rate_limit_kwargs = dict( rate_limit ) if isinstance( rate_limit, dict ) else {}
+        rate_limit_kwargs.setdefault( 'metrics', metrics )
+        mturk = RateLimitedClient( mturk, **rate_limit_kwargs )
     
     return mturk
 
+def custom_endpoint_url():
+    '''
+    Returns $MTURK_PY_ENDPOINT_URL, or None if it isn't set (or is empty).
+    '''
+    
+    import os
+    
+    return os.environ.get( 'MTURK_PY_ENDPOINT_URL' ) or None
+
 def total_payment_from_worker_payment( amount, max_assignments ):
     '''
     Given a floating-point amount to pay a worker for completing a HIT in US dollars,
@@ -86,6 +542,41 @@ def total_payment_from_worker_payment( amount, max_assignments ):
     ## The formula for Amazon's overhead is 10% or .005 per HIT, whichever is larger:
     return amount + max( .01, .2*amount if max_assignments < 10 else .4*amount )
 
+def imap_concurrently( func, items, max_workers = 1 ):
+    '''
+    Calls 'func( item )' for each item in the sequence 'items' using
+    at most 'max_workers' threads and yields ( item, result, exception )
+    tuples in the same order as 'items'.
+    Exactly one of 'result' and 'exception' is meaningful;
+    'exception' is None if 'func( item )' returned normally.
+    Exceptions raised by 'func' are caught and yielded rather than raised,
+    so that one failing item doesn't abort the rest.
+    
+    With 'max_workers' equal to 1, no threads are created.
+    Otherwise, each call runs in a copy of the caller's contextvars context,
+    so that context variables (such as where "batch" sends a command's
+    output) follow the work into the threads.
+    '''
+    
+    def call( item ):
+        try:
+            return ( item, func( item ), None )
+        except Exception as e:
+            return ( item, None, e )
+    
+    if max_workers <= 1:
+        for item in items:
+            yield call( item )
+        return
+    
+    import concurrent.futures, contextvars
+    with concurrent.futures.ThreadPoolExecutor( max_workers = max_workers ) as executor:
+        ## map() yields in input order, regardless of completion order.
+        ## A context can only be entered by one thread at a time,
+        ## so each call gets its own copy.
+        for item_result_exception in executor.map( lambda item_context: item_context[1].run( call, item_context[0] ), ( ( item, contextvars.copy_context() ) for item in items ) ):
+            yield item_result_exception
+
 
 def create_HITs_for_external_URLs( mturk, URLs, **kwargs ):
     '''
@@ -97,7 +588,42 @@ def create_HITs_for_external_URLs( mturk, URLs, **kwargs ):
     and the various other keyword arguments to
     boto3.client('mturk').create_hit(),
     creates one HIT per URL and returns the resulting HIT objects
-    (which have a .HITId field).
+    (which have a .HITId field) in the same order as 'URLs'.
+    
+    The optional keyword argument 'concurrency' (default 1) is the number
+    of create_hit() calls to have in flight at once.
+    'mturk' should have been created with at least that many
+    'max_pool_connections'.
+    
+    The optional keyword argument 'ledger', a BudgetLedger, is used to
+    check the balance instead of calling get_account_balance().
+    The cost of the HITs is reserved in it for the duration of the call.
+    
+    The optional keyword argument 'journal', a Journal, records each HIT
+    as soon as it is created, and each HIT is created with a
+    UniqueRequestToken derived from the job, the URL, and its position.
+    If the optional keyword argument 'resume' is True, the last job in
+    the journal is continued: URLs it already created HITs for are skipped
+    (and their HITs returned). So are URLs that list_hits() shows a HIT
+    for, created since the job started, in case the journal missed it.
+    The rest get the same tokens as before.
+    Otherwise, a new job is started in the journal.
+    
+    NOTE: MTurk only refuses a repeated UniqueRequestToken for 24 hours.
+          After that, the journal and list_hits() are all that stop
+          a resumed job from creating a HIT twice.
+    
+    The HIT type (title, reward, qualifications, etc.) is registered once
+    with create_hit_type(), or found in the cache of get_HIT_type()
+    (at the optional keyword argument 'HIT_type_cache_path'),
+    and each HIT is created with the smaller create_hit_with_hit_type().
+    If the optional keyword argument 'use_HIT_type' is False, or there are
+    keyword arguments that create_hit_with_hit_type() doesn't know which
+    part they belong to, each HIT is created with create_hit() instead.
+    
+    If creating the HIT for a URL fails, the remaining URLs are still
+    submitted. The failures are reported at the end, and the corresponding
+    element of the returned list is None.
     
     NOTE: The keyword argument 'RequesterAnnotation', if present will be used
           for every HIT.
@@ -114,6 +640,17 @@ def create_HITs_for_external_URLs( mturk, URLs, **kwargs ):
     frame_height = kwargs['frame_height']
     del kwargs['frame_height']
     
+    concurrency = int( kwargs.pop( 'concurrency', 1 ) )
+    assert concurrency >= 1
+    
+    ledger = kwargs.pop( 'ledger', None )
+    
+    use_HIT_type = kwargs.pop( 'use_HIT_type', True )
+    HIT_type_cache_path = kwargs.pop( 'HIT_type_cache_path', None )
+    
+    journal = kwargs.pop( 'journal', None )
+    resume = kwargs.pop( 'resume', False )
+    
     ## 'annotation' and 'annotations' cannot both be in kwargs.
     assert not ( 'RequesterAnnotation' in kwargs and 'RequesterAnnotations' in kwargs )
     if 'RequesterAnnotation' in kwargs:
@@ -129,15 +666,92 @@ def create_HITs_for_external_URLs( mturk, URLs, **kwargs ):
         print('create_HITs_for_external_URLs() called with zero URLs')
         return []
     
-    if not have_enough_balance_for_N_assignments_at_P_dollars_amount( mturk, len( URLs ) * kwargs['MaxAssignments'], kwargs['Reward'] ):
-        raise RuntimeError('Not enough balance!')
-    
-    
-    HITs = []
     assert len( URLs ) == len( RequesterAnnotations )
-    for URL, RequesterAnnotation in zip( URLs, RequesterAnnotations ):
+    
+    import sys, hashlib
+    
+    ## The HITs the job already created, by index into 'URLs'.
+    done = {}
+    job_started = None
+    if journal is not None:
+        job = None
+        if resume:
+            starts = [ record for record in journal.records if record.get( 'event' ) == 'start' ]
+            if len( starts ) > 0:
+                job = starts[-1]['job']
+                job_started = journal_time( starts[-1] )
+        if job is None:
+            import uuid
+            job = uuid.uuid4().hex
+            journal.append( event = 'start', job = job, num_URLs = len( URLs ) )
+        
+        for record in journal.records:
+            if record.get( 'job' ) != job or 'HITId' not in record: continue
+            index = record['index']
+            ## Only if the job file still has the same URL there.
+            if index < len( URLs ) and ( URLs[ index ], RequesterAnnotations[ index ] ) == ( record['URL'], record['RequesterAnnotation'] ):
+                done[ index ] = { 'HITId': record['HITId'] }
+    
+    def find_created_HIT( index, exclude ):
+        ## The HITId of a HIT for URL 'index' that list_hits() shows was
+        ## created since the job started and isn't in 'exclude', or None.
+        key = ( URLs[ index ], RequesterAnnotations[ index ] )
+        candidates = created_HITIds_by_URL( mturk, job_started ).get( key, [] )
+        candidates = [ HITId for HITId in candidates if HITId not in exclude ]
+        return candidates[0] if len( candidates ) > 0 else None
+    
+    def journal_found_HIT( index, HITId ):
+        print('[create_hit( %s ): already created]' % ( URLs[ index ], ), file=sys.stderr)
+        journal.append( job = job, index = index, URL = URLs[ index ], RequesterAnnotation = RequesterAnnotations[ index ], HITId = HITId, found = True )
+    
+    ## Look for HITs that a resumed job created but didn't journal.
+    if resume and journal is not None and job_started is not None and len( done ) < len( URLs ):
+        journaled = set([ record['HITId'] for record in journal.records if 'HITId' in record ])
+        for index in range( len( URLs ) ):
+            if index in done: continue
+            HITId = find_created_HIT( index, journaled )
+            if HITId is None: continue
+            journaled.add( HITId )
+            done[ index ] = { 'HITId': HITId }
+            journal_found_HIT( index, HITId )
+    
+    todo = [ index for index in range( len( URLs ) ) if index not in done ]
+    
+    def create_one( index ):
+        URL, RequesterAnnotation = URLs[ index ], RequesterAnnotations[ index ]
         Question = ExternalQuestion( URL, frame_height ).get_as_xml()
         
+        create_kwargs = dict( HIT_kwargs if HITTypeId is not None else kwargs )
+        if journal is not None:
+            create_kwargs['UniqueRequestToken'] = hashlib.sha1( '\0'.join([ job, str( index ), URL, RequesterAnnotation ]).encode( 'utf-8' ) ).hexdigest()
+        
+        try:
+            HIT = create_one_HIT( Question, RequesterAnnotation, create_kwargs )
+        except Exception as e:
+            ## MTurk refuses a repeated token. That means an earlier run
+            ## created this HIT, but neither the journal nor list_hits()
+            ## showed it when we looked. Look again.
+            if journal is None or job_started is None or not is_repeated_token_error( e ): raise
+            created_HITIds_by_URL.cache_clear()
+            HITId = find_created_HIT( index, set([ record['HITId'] for record in journal.records if 'HITId' in record ]) )
+            if HITId is None: raise
+            journal_found_HIT( index, HITId )
+            return { 'HITId': HITId }
+        
+        if journal is not None:
+            journal.append( job = job, index = index, URL = URL, RequesterAnnotation = RequesterAnnotation, HITId = HIT['HITId'], UniqueRequestToken = create_kwargs['UniqueRequestToken'] )
+        
+        return HIT
+    
+    def create_one_HIT( Question, RequesterAnnotation, create_kwargs ):
+        if HITTypeId is not None:
+            return mturk.create_hit_with_hit_type(
+                HITTypeId = HITTypeId,
+                Question = Question,
+                RequesterAnnotation = RequesterAnnotation,
+                **create_kwargs
+                )['HIT']
+        
         create_hit_result = mturk.create_hit(
             Question = Question,
             ## The default for create_hit() is Minimal;
@@ -149,16 +763,143 @@ def create_HITs_for_external_URLs( mturk, URLs, **kwargs ):
             ## The default is Minimal; also get HITDetail for CreationTime.
             # response_groups = ( 'Minimal', 'HITDetail' ),
             RequesterAnnotation = RequesterAnnotation,
-            **kwargs
+            **create_kwargs
             )
         
-        hit = create_hit_result['HIT']
-        HITs.append( hit )
+        return create_hit_result['HIT']
+    
+    cost_per_HIT = total_payment_for_HITs( kwargs['Reward'], kwargs['MaxAssignments'] )
+    if ledger is not None:
+        reservation = ledger.reserve( len( todo ) * cost_per_HIT )
+    elif not have_enough_balance_for_amount( mturk, len( todo ) * cost_per_HIT ):
+        raise RuntimeError('Not enough balance!')
+    
+    HITs = [ None ] * len( URLs )
+    failures = []
+    num_created = 0
+    try:
+        HITTypeId = None
+        if use_HIT_type and all([ key in HIT_type_fields or key in HIT_with_HIT_type_fields for key in kwargs ]):
+            HITTypeId = get_HIT_type( mturk, cache_path = HIT_type_cache_path, **dict([ ( key, value ) for key, value in kwargs.items() if key in HIT_type_fields ]) )
+            HIT_kwargs = dict([ ( key, value ) for key, value in kwargs.items() if key in HIT_with_HIT_type_fields ])
+        
+        ## Print the resumed HITs like new ones, so that the output
+        ## of a resumed job still lists all of its HITs.
+        for index in sorted( done ):
+            HITs[ index ] = done[ index ]
+            print('[create_hit( %s, $%s ): %s]' % ( URLs[ index ], kwargs['Reward'], done[ index ]['HITId'] ))
+        if len( done ) > 0:
+            print('[create_HITs_for_external_URLs(): resumed %d of %d URLs]' % ( len( done ), len( URLs ) ), file=sys.stderr)
         
-        print('[create_hit( %s, $%s ): %s]' % ( URL, kwargs['Reward'], hit['HITId'] ))
+        for index, hit, error in imap_concurrently( create_one, todo, max_workers = concurrency ):
+            URL = URLs[ index ]
+            HITs[ index ] = hit
+            
+            if error is not None:
+                failures.append( ( URL, error ) )
+                ## Print failures to stderr, so that they don't look like
+                ## created HITs to scripts scraping stdout.
+                print('[create_hit( %s, $%s ) failed: %s]' % ( URL, kwargs['Reward'], error ), file=sys.stderr)
+                continue
+            
+            num_created += 1
+            print('[create_hit( %s, $%s ): %s]' % ( URL, kwargs['Reward'], hit['HITId'] ))
+    finally:
+        ## Only the HITs that were created cost anything. The rest of the
+        ## reservation is released, even if something went wrong.
+        ## (If this was interrupted, HITs still being created aren't counted,
+        ## but the ledger's next reconcile() sees them.)
+        if ledger is not None: ledger.commit( reservation, num_created * cost_per_HIT )
+    
+    if len( failures ) > 0:
+        print('create_HITs_for_external_URLs(): %d of %d URLs failed:' % ( len( failures ), len( URLs ) ), file=sys.stderr)
+        for URL, error in failures:
+            print('    %s: %s' % ( URL, error ), file=sys.stderr)
     
     return HITs
 
+def journal_time( record ):
+    '''
+    Returns the time a Journal record was appended, as a UTC datetime.
+    '''
+    
+    from datetime import timezone
+    
+    time = datetime.fromisoformat( record['time'] )
+    ## Older records are in UTC without saying so.
+    if time.tzinfo is None: time = time.replace( tzinfo = timezone.utc )
+    return time
+
+@functools.lru_cache( maxsize = 1 )
+def created_HITIds_by_URL( mturk, created_after ):
+    '''
+    Returns a dictionary mapping ( ExternalURL, RequesterAnnotation ) to the
+    HITIds, oldest first, of the account's HITs created after the datetime
+    'created_after', as listed by list_hits().
+    To allow for clock skew, HITs created up to a minute before
+    'created_after' are included too, after the others.
+    
+    The result is cached for the same arguments. Call cache_clear()
+    to list the HITs again.
+    '''
+    
+    from datetime import timedelta
+    
+    hits = []
+    for hit in iter_all_HITs( mturk ):
+        if hit.get( 'CreationTime' ) is None or hit['CreationTime'] < created_after - timedelta( minutes = 1 ): continue
+        ExternalURL = parse_question_xml( hit['Question'] ).get( 'ExternalURL' ) if 'Question' in hit else None
+        hits.append( ( hit['CreationTime'] < created_after, hit['CreationTime'], hit['HITId'], ( ExternalURL, hit.get( 'RequesterAnnotation', '' ) ) ) )
+    
+    result = {}
+    for skewed, CreationTime, HITId, key in sorted( hits ):
+        result.setdefault( key, [] ).append( HITId )
+    return result
+
+## The create_hit() arguments that make up a HIT type.
+HIT_type_fields = ( 'AutoApprovalDelayInSeconds', 'AssignmentDurationInSeconds', 'Reward', 'Title', 'Keywords', 'Description', 'QualificationRequirements' )
+## The other create_hit() arguments, which create_hit_with_hit_type() also takes.
+HIT_with_HIT_type_fields = ( 'MaxAssignments', 'LifetimeInSeconds', 'UniqueRequestToken', 'AssignmentReviewPolicy', 'HITReviewPolicy', 'HITLayoutId', 'HITLayoutParameters' )
+
+def get_HIT_type( mturk, cache_path = None, **kwargs ):
+    '''
+    Given the create_hit_type() keyword arguments, returns the HITTypeId
+    for them, calling create_hit_type() only if it isn't in the
+    JSON cache at 'cache_path' (default "~/.mturk.py.hit_types.json").
+    
+    The cache is keyed by a hash of the arguments and the endpoint,
+    since the sandbox and the real marketplace have different HIT types.
+    It isn't keyed by AWS account, so use a different 'cache_path'
+    for each account.
+    If two processes race to add to the cache, one entry may be lost;
+    that only costs a create_hit_type() call, which returns the same
+    HITTypeId for the same arguments.
+    '''
+    
+    import os, json, hashlib
+    
+    if cache_path is None: cache_path = os.path.expanduser( '~/.mturk.py.hit_types.json' )
+    
+    key = hashlib.sha1( json.dumps( [ mturk.meta.endpoint_url, kwargs ], sort_keys = True, default = str ).encode( 'utf-8' ) ).hexdigest()
+    
+    cache = {}
+    if os.path.exists( cache_path ):
+        with open( cache_path ) as f: cache = json.load( f )
+    
+    if key in cache:
+        print('[get_HIT_type( %s ): cached %s]' % ( kwargs.get( 'Title' ), cache[ key ] ))
+        return cache[ key ]
+    
+    HITTypeId = mturk.create_hit_type( **kwargs )['HITTypeId']
+    ## Don't say "create_hit" on stdout; scripts grep for it to find HITIds.
+    print('[get_HIT_type( %s ): new %s]' % ( kwargs.get( 'Title' ), HITTypeId ))
+    
+    cache[ key ] = HITTypeId
+    with open( cache_path + '.partial', 'w' ) as f: json.dump( cache, f, indent = 2 )
+    os.replace( cache_path + '.partial', cache_path )
+    
+    return HITTypeId
+
 def create_HIT_for_external_URL( mturk, URL, **kwargs ):
     '''
     Given 'mturk', an object returned from create_mturk(),
@@ -188,13 +929,184 @@ def create_HIT_for_external_URL( mturk, URL, **kwargs ):
         )
     
     HIT = create_hit_result['HIT']
-    print('[create_hit( %s, $%s ): %s]' % ( URL, kwargs['Reward'], hit['HITId'] ))
+    print('[create_hit( %s, $%s ): %s]' % ( URL, kwargs['Reward'], HIT['HITId'] ))
     
     return HIT
 
 def have_enough_balance_for_N_assignments_at_P_dollars_amount( mturk, N, P ):
     P = float(P)
-    return float(mturk.get_account_balance()['AvailableBalance']) >= total_payment_from_worker_payment( P, N )
+    return have_enough_balance_for_amount( mturk, N * total_payment_from_worker_payment( P, N ) )
+
+def have_enough_balance_for_amount( mturk, amount ):
+    with timed( 'balance_check' ):
+        return float(mturk.get_account_balance()['AvailableBalance']) >= amount
+
+def total_payment_for_HITs( Reward, MaxAssignments, num_HITs = 1 ):
+    '''
+    Given the 'Reward' and 'MaxAssignments' arguments to create_hit(),
+    returns the total amount that 'num_HITs' such HITs can deduct from
+    the Amazon account, including Amazon's overhead.
+    '''
+    
+    return num_HITs * int( MaxAssignments ) * total_payment_from_worker_payment( float( Reward ), int( MaxAssignments ) )
+
+class BudgetLedger:
+    '''
+    A local record of the account balance, so that creating HITs doesn't
+    need a get_account_balance() call each time, and so that concurrent
+    submissions can't each spend the same money.
+    
+    The balance is fetched once and then kept up to date locally:
+    reserve() holds money for HITs about to be created,
+    commit() turns a reservation into money spent (releasing the rest),
+    release() gives a whole reservation back,
+    and credit() adds money back, e.g. for the unfilled assignments of
+    an expired HIT.
+    Every 'reconcile_interval' seconds, the live balance is fetched again.
+    The live balance already reflects the money spent and credited,
+    so only reservations still in flight are kept.
+    
+    If 'path' is given, the balance and reservations are kept in the
+    SQLite file there (such as the HITInventory's), so that every process
+    using it shares them: get_account_balance() is only called when no
+    process has called it for 'reconcile_interval' seconds, and no process
+    can reserve money that another has reserved.
+    The reservations of processes that exited without committing them
+    are dropped, and the balance is fetched again.
+    Otherwise, they are kept in memory for this process.
+    '''
+    
+    def __init__( self, mturk, reconcile_interval = 300, path = None ):
+        import sqlite3, threading
+        
+        self.mturk = mturk
+        self.reconcile_interval = reconcile_interval
+        self.lock = threading.Lock()
+        
+        ## Transactions are begun explicitly, so that checking for and
+        ## making a reservation happen together, even across processes.
+        self.db = sqlite3.connect( ':memory:' if path is None else path, check_same_thread = False, isolation_level = None, timeout = 60 )
+        with self.transaction():
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS ledger ( id INTEGER PRIMARY KEY CHECK ( id = 0 ), balance REAL, last_reconciled REAL )' )
+            ## Reservations that haven't been committed or released.
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS ledger_reservations ( reservation INTEGER PRIMARY KEY AUTOINCREMENT, amount REAL, host TEXT, pid INTEGER )' )
+        
+        self.available()
+    
+    def close( self ):
+        self.db.close()
+    
+    def __enter__( self ):
+        return self
+    
+    def __exit__( self, *args ):
+        self.close()
+    
+    @contextlib.contextmanager
+    def transaction( self ):
+        with self.lock:
+            self.db.execute( 'BEGIN IMMEDIATE' )
+            try:
+                yield
+            except BaseException:
+                self.db.execute( 'ROLLBACK' )
+                raise
+            self.db.execute( 'COMMIT' )
+    
+    def held( self ):
+        ## The total of the reservations, dropping those of exited processes.
+        ## Call inside transaction().
+        import os, socket
+        
+        host = socket.gethostname()
+        for reservation, pid in self.db.execute( 'SELECT reservation, pid FROM ledger_reservations WHERE host = ?', ( host, ) ).fetchall():
+            if pid == os.getpid(): continue
+            try:
+                os.kill( pid, 0 )
+            except ProcessLookupError:
+                ## Some of it may have been spent, so fetch the balance again.
+                self.db.execute( 'DELETE FROM ledger_reservations WHERE reservation = ?', ( reservation, ) )
+                self.db.execute( 'UPDATE ledger SET last_reconciled = 0' )
+            except PermissionError:
+                pass
+        
+        return self.db.execute( 'SELECT TOTAL( amount ) FROM ledger_reservations' ).fetchone()[0]
+    
+    def reconcile( self ):
+        '''
+        Fetches the live balance.
+        '''
+        
+        import time
+        
+        with timed( 'balance_check' ):
+            balance = float( self.mturk.get_account_balance()['AvailableBalance'] )
+        with self.transaction():
+            self.db.execute( 'INSERT OR REPLACE INTO ledger ( id, balance, last_reconciled ) VALUES ( 0, ?, ? )', ( balance, time.time() ) )
+            held = self.held()
+        print('[BudgetLedger.reconcile(): $%.2f available, $%.2f reserved]' % ( balance, held ))
+    
+    def is_stale( self ):
+        import time
+        
+        with self.transaction():
+            self.held()
+            row = self.db.execute( 'SELECT last_reconciled FROM ledger' ).fetchone()
+        return row is None or time.time() - row[0] >= self.reconcile_interval
+    
+    def available( self ):
+        '''
+        Returns the balance that isn't spent or reserved.
+        '''
+        
+        if self.is_stale(): self.reconcile()
+        
+        with self.transaction():
+            return self.db.execute( 'SELECT balance FROM ledger' ).fetchone()[0] - self.held()
+    
+    def reserve( self, amount ):
+        '''
+        Reserves 'amount' dollars and returns a reservation to pass to
+        commit() or release().
+        Raises a RuntimeError if there is not enough balance.
+        '''
+        
+        import os, socket
+        
+        ## Reconcile outside the transaction, if it's time.
+        if self.is_stale(): self.reconcile()
+        
+        with self.transaction():
+            if self.db.execute( 'SELECT balance FROM ledger' ).fetchone()[0] - self.held() < amount:
+                raise RuntimeError('Not enough balance!')
+            
+            return self.db.execute( 'INSERT INTO ledger_reservations ( amount, host, pid ) VALUES ( ?, ?, ? )', ( amount, socket.gethostname(), os.getpid() ) ).lastrowid
+    
+    def commit( self, reservation, amount = None ):
+        '''
+        Records that 'amount' dollars of 'reservation' were spent
+        (by default, all of it) and releases the rest.
+        '''
+        
+        with self.transaction():
+            held = self.db.execute( 'SELECT amount FROM ledger_reservations WHERE reservation = ?', ( reservation, ) ).fetchone()[0]
+            self.db.execute( 'DELETE FROM ledger_reservations WHERE reservation = ?', ( reservation, ) )
+            self.db.execute( 'UPDATE ledger SET balance = balance - ?', ( held if amount is None else amount, ) )
+    
+    def release( self, reservation ):
+        '''
+        Gives back all of 'reservation'.
+        '''
+        
+        self.commit( reservation, 0 )
+    
+    def credit( self, amount ):
+        '''
+        Records that 'amount' dollars came back to the account.
+        '''
+        
+        with self.transaction():
+            self.db.execute( 'UPDATE ledger SET balance = balance + ?', ( amount, ) )
 
 def get_assignments_for_HITId( mturk, HITId, max_assignments ):
     assignments = mturk.list_assignments_for_hit( HITId = HITId, MaxResults = max_assignments, AssignmentStatuses = [ 'Submitted', 'Approved', 'Rejected' ] )
@@ -206,222 +1118,1903 @@ def get_assignments_for_HITId( mturk, HITId, max_assignments ):
     print('[get_assignments_for_HITId( %s, %s ): %d assignments]' % ( HITId, max_assignments, len( assignments['Assignments'] ) ))
     return assignments['Assignments']
 
-def get_all_assignments_for_HITId( mturk, HITId ):
+def iter_all_assignments_for_HITId( mturk, HITId, AssignmentStatuses = None, compact = False ):
     '''
-    Returns all Assignment objects for the given HITId.
-    
-    tested
+    Yields all Assignment objects for the given HITId,
+    one page of results at a time, so that the caller
+    never needs to hold them all in memory.
+    If 'AssignmentStatuses' is given, only assignments with
+    those statuses are listed.
+    If 'compact' is True, yields AssignmentRecord objects instead
+    of boto3's dictionaries.
     '''
     
+    import sys
+    
     ## NOTE: This routine has been tested for N equal to 1, 10, and 100
     ##       for a HITId that had 10 assignments.
     N = 100
     NextToken = None
-    results = []
+    count = 0
     while True:
         kwargs = dict( HITId = HITId, MaxResults = N, NextToken = NextToken )
         if NextToken is None: del kwargs['NextToken']
+        if AssignmentStatuses is not None: kwargs['AssignmentStatuses'] = list( AssignmentStatuses )
         assignments = mturk.list_assignments_for_hit( **kwargs )
-        results.extend( assignments['Assignments'] )
         ## Make sure that NumResults and TotalNumResults agree; if they don't,
         ## we need to properly handle the 'page_number', and we're not right now.
         ## assignments.NumResults and assignments.TotalNumResults are given as strings.
         assert int( assignments['NumResults'] ) == len( assignments['Assignments'] )
         #assert int( assignments.NumResults ) == int( assignments.TotalNumResults )
+        count += len( assignments['Assignments'] )
+        for assignment in assignments['Assignments']:
+            yield AssignmentRecord( assignment ) if compact else assignment
         if len( assignments['Assignments'] ) == 0: break
         NextToken = assignments['NextToken']
-    print('[get_all_assignments_for_HITId( %s ): %d assignments]' % ( HITId, len( results ) ))
-    return results
+    print('[get_all_assignments_for_HITId( %s ): %d assignments]' % ( HITId, count ), file=sys.stderr)
 
-def remove_HITId( mturk, HITId ):
+def get_all_assignments_for_HITId( mturk, HITId, store = None, compact = False ):
     '''
-    Removes the given HITId, approving any pending reviewable assignments.
+    Returns all Assignment objects for the given HITId.
+    If an AssignmentStore 'store' is given, new or status-changed assignments
+    are also saved to it.
+    If 'compact' is True, returns AssignmentRecord objects.
+    
+    tested
     '''
     
-    HITobj = mturk.get_hit( HITId = HITId )['HIT']
-    print('Removing HITId %s with current status %s' % ( HITId, HITobj['HITStatus'] ))
+    import sys
     
-    if HITobj['HITStatus'] == 'Disposed':
-        return
-    elif HITobj['HITStatus'] == 'Reviewable':
-        assignments = get_all_assignments_for_HITId( mturk, HITId )
-        print('Approving reviewable assignments...')
-        num_approved = 0
-        for assignment in assignments:
-            if assignment.AssignmentStatus == 'Submitted':
-                mturk.approve_assignment( AssignmentId = assignment.AssignmentId )
-                num_approved += 1
-        print('Approved', num_approved, 'assignments.' if num_approved != 1 else 'assignment.')
-        
-        mturk.delete_hit( HITId = HITId )
-    else:
-        ## UPDATE: There is no more disable_hit()
-        # mturk.disable_hit( HITId )
-        expire_hit( mturk, HITId )
+    results = list( iter_all_assignments_for_HITId( mturk, HITId, compact = compact ) )
+    
+    if store is not None:
+        rows, changed = store.update( results )
+        print('[AssignmentStore.update( %s ): %d new or changed assignments]' % ( HITId, len( changed ) ), file=sys.stderr)
+    
+    return results
+
+## The number of HITs to retrieve in parallel by default.
+## This matches botocore's default 'max_pool_connections'.
+DEFAULT_CONCURRENCY = 10
 
-def HITIds2HITs( mturk, HITIds ):
+## Commands that select HITs from the HITInventory sync it first
+## if it is older than this many seconds.
+HIT_INVENTORY_MAX_AGE = 300
+
+def get_all_assignments_for_HITIds( mturk, HITIds, concurrency = DEFAULT_CONCURRENCY, compact = False ):
     '''
-    Given a sequence of HITIds, return corresponding
-    boto3.mturk.connection.HIT objects.
+    Given a sequence of HITIds, returns a list of lists of Assignment objects,
+    one list per HITId in the same order as 'HITIds'.
+    Up to 'concurrency' HITs are paged through at once.
+    If 'compact' is True, the assignments are AssignmentRecord objects,
+    which take a fraction of the memory.
+    
+    NOTE: The pages for a single HIT must still be fetched one after another,
+          since each page's NextToken comes from the previous page.
     '''
     
-    HITs = []
-    for HITId in HITIds:
-        get_hit_result = mturk.get_hit(
-            HITId = HITId
-            ## The default for get_hit() is HITDetail, HITQuestion and Minimal;
-            ## also add HITAssignmentSummary for NumberofAssignmentsPending,
-            ## NumberofAssignmentsAvailable, or NumberofAssignmentsCompleted.
-            # response_groups = ( 'Minimal', 'HITDetail', 'HITQuestion', 'HITAssignmentSummary' ),
-            )
-        
-        hit = get_hit_result['HIT']
-        # assert get_hit_result.status
-        HITs.append( hit )
+    results = []
+    errors = []
+    for HITId, assignments, error in imap_concurrently( lambda HITId: get_all_assignments_for_HITId( mturk, HITId, compact = compact ), HITIds, max_workers = concurrency ):
+        if error is not None: errors.append( error )
+        results.append( assignments )
     
-    return HITs
+    ## Don't return partial results.
+    if len( errors ) > 0: raise errors[0]
+    
+    return results
 
-def HITIds2CSV( mturk, HITIds ):
-    return HITs2CSV( HITIds2HITs( mturk, HITIds ) )
+## What a HITId looks like.
+HITId_pattern = r'[A-Z0-9]{30}'
 
-def HITs2CSV( HITs ):
+def HITIds_from_submit_log( path ):
+    '''
+    Given a path to the saved output of the "submit" command,
+    returns the list of HITIds that were created, in order.
     '''
-    Given a sequence of boto3.mturk.connection.HIT objects, as returned by
-    boto3.mturk.connection.MTurkConnection.create_hit() or
-    boto3.mturk.connection.MTurkConnection.get_hit(),
-    returns a string of CSV data representing the assignments.
-    
-    NOTE: In order to get the CreationTime field,
-          it is necessary to have passed 'HITDetail'
-          as an element of 'response_groups':
-              response_groups = ( 'Minimal', 'HITDetail' )
-          to create_hit() or get_hit().
     
-    NOTE: In order to get the NumberofAssignmentsPending,
-          NumberofAssignmentsAvailable, or NumberofAssignmentsCompleted
-          fields, it is necessary to have passed 'HITAssignmentSummary'
-          as an element of 'response_groups':
-              response_groups = ( 'Minimal', 'HITDetail', 'HITAssignmentSummary' )
-          to create_hit() or get_hit().
+    import re
     
-    NOTE: In order to get the ExternalURL and FrameHeight fields,
-          it is necessary to have passed 'HITQuestion'
-          as an element of 'response_groups':
-              response_groups = ( 'Minimal', 'HITDetail', 'HITQuestion', 'HITAssignmentSummary' )
-          to create_hit() or get_hit().
+    HITIds = []
+    with open( path ) as f:
+        for line in f:
+            match = re.match( r'\[create_hit\(.*\): (%s)\]$' % HITId_pattern, line.strip() )
+            if match is not None:
+                HITIds.append( match.group(1) )
+    return HITIds
+
+def HITIds_from_file( path ):
+    '''
+    Given a path to the saved output of the "submit" command or
+    to a file of whitespace-separated HITIds, returns the list of HITIds.
+    Raises a ValueError if the file is neither.
     '''
     
-    import sys, csv, io
+    import re
     
-    ## Column names:
-    primary_fields = [ 'HITId', 'HITTypeId', 'CreationTime', 'Title', 'Description', 'Keywords', 'HITStatus', 'Reward', 'LifetimeInSeconds', 'AssignmentDurationInSeconds', 'MaxAssignments', 'AutoApprovalDelayInSeconds', 'ExternalURL', 'FrameHeight', 'RequesterAnnotation', 'NumberOfSimilarHITs', 'HITReviewStatus', 'NumberofAssignmentsPending', 'NumberofAssignmentsAvailable', 'NumberofAssignmentsCompleted' ]
+    HITIds = HITIds_from_submit_log( path )
+    if len( HITIds ) > 0: return HITIds
     
-    ## A sequence of dictionaries mapping field names to values.
-    rows = []
-    for hit in HITs:
-        row = {}
-        
-        for field in primary_fields:
-            ## There are a few special cases:
-            if field == 'ExternalURL':
-                if 'Question' in hit:
-                    
-                    '''
-                    d = xml.dom.minidom.parseString( hit.Question )
-                    ExternalURL = d.getElementsByTagName( 'ExternalURL' )[0].firstChild.data
-                    row[ field ] = ExternalURL
-                    '''
-                    row[ field ] = xml.dom.minidom.parseString( hit['Question'] ).getElementsByTagName( 'ExternalURL' )[0].firstChild.data
-            elif field == 'FrameHeight':
-                if 'Question' in hit:
-                    
-                    '''
-                    d = xml.dom.minidom.parseString( hit.Question )
-                    FrameHeight = d.getElementsByTagName( 'FrameHeight' )[0].firstChild.data
-                    row[ field ] = FrameHeight
-                    '''
-                    row[ field ] = xml.dom.minidom.parseString( hit['Question'] ).getElementsByTagName( 'FrameHeight' )[0].firstChild.data
-            ## The general case:
-            elif field in hit:
-                row[ field ] = hit[ field ]
-        
-        rows.append( row )
+    with open( path ) as f: HITIds = f.read().split()
     
-    out = io.StringIO()
-    dw = csv.DictWriter( out, primary_fields, lineterminator = '\n' )
-    dw.writeheader()
-    dw.writerows( rows )
-    return out.getvalue()
+    not_HITIds = [ token for token in HITIds if re.fullmatch( HITId_pattern, token ) is None ]
+    if len( not_HITIds ) > 0:
+        raise ValueError( '%s is neither the output of "submit" nor a file of HITIds (e.g. %r is not a HITId)' % ( path, not_HITIds[0] ) )
+    
+    return HITIds
 
-def assignments2CSV( assignments ):
+def expire_HITId( mturk, HITId, ledger = None, HITobj = None ):
     '''
-    Given a sequence of boto3.mturk.connection.Assignment objects as returned by
-    boto3.mturk.connection.MTurkConnection.get_assignments(),
-    returns a string of CSV data representing the assignments.
+    Expires the given HITId, unless its Expiration has already passed.
+    If a BudgetLedger 'ledger' is given, the cost of the assignments
+    that expiring the HIT leaves unfilled is credited to it.
+    A HIT that was already expired is not credited again, so retrying
+    a HIT that is waiting to become Reviewable credits it only once.
+    'HITobj' is the HIT as get_hit() returns it, if the caller has it.
+    
+    Returns True if the HIT was expired now, and False if it already was.
     '''
     
-    import sys, csv, io, json
+    from datetime import timezone
     
-    ## Column names:
-    primary_fields = [ 'HITId', 'AssignmentId', 'WorkerId', 'AssignmentStatus', 'AutoApprovalTime', 'AcceptTime', 'SubmitTime', 'ApprovalTime', 'RejectionTime', 'Deadline', 'RequesterFeedback' ]
-    qid_fields = set()
+    if HITobj is None: HITobj = mturk.get_hit( HITId = HITId )['HIT']
+    if 'Expiration' in HITobj and HITobj['Expiration'] <= datetime.now( timezone.utc ): return False
     
-    ## A sequence of dictionaries mapping field names to values.
-    rows = []
-    for a in assignments:
-        row = {}
-        
-        for field in primary_fields:
-            if field in a:
-                row[ field ] = a[field]
-        
-        ### Now, question ids.
-        ## My older forked boto:
-        #answers = [ ( answer.QuestionIdentifier, answer.FreeText ) for answer in a.answers ]
-        ## My current forked boto:
-        # answers = [ ( answer.qid, answer.fields ) for answer in a.answers[0] ]
-        ## UPDATE: boto3 doesn't parse this for us.
-        answersdom = xml.dom.minidom.parseString( a['Answer'] )
-        # def getData( node ): return node.data if node.nodeType == node.TEXT_NODE else node.firstChild.data
-        ## ET.fromstring(answersdom.getElementsByTagName( 'Answer' )[0].toxml()))[0].text
-        answers = [ ( a.childNodes[0].firstChild.data, a.childNodes[1].firstChild.data ) for a in answersdom.getElementsByTagName( 'Answer' ) ]
-        
-        for qid, fields in answers:
-            qid_fields.add( qid )
-            
-            assert qid not in row
-            row[ qid ] = json.dumps( fields )
-        
-        rows.append( row )
+    expire_hit( mturk, HITId )
     
-    ## Combine the primary column names with the question ids:
-    qid_fields = list( qid_fields )
-    qid_fields.sort()
-    all_fields = primary_fields + qid_fields
+    if ledger is not None and 'NumberOfAssignmentsAvailable' in HITobj:
+        ledger.credit( total_payment_for_HITs( HITobj['Reward'], HITobj['MaxAssignments'] ) * HITobj['NumberOfAssignmentsAvailable'] / HITobj['MaxAssignments'] )
     
-    out = io.StringIO()
-    dw = csv.DictWriter( out, all_fields, lineterminator = '\n' )
-    dw.writeheader()
-    dw.writerows( rows )
-    return out.getvalue()
+    return True
 
-def upload_filepaths_to_server(
-    filepaths, remote_host = None, remote_dir = None
-    ):
+def remove_HITId( mturk, HITId, ledger = None ):
     '''
-    Given an iterable collection of distinct file paths 'filepaths' and
-    a remote host 'remote_host' and remote directory 'remote_dir'
-    in which to store the files on the server,
-    uploads the files intelligently (doesn't re-upload if the
-    identical file is already on the 'remote_host' at 'remote_dir').
+    Removes the given HITId, approving any pending reviewable assignments.
+    If a BudgetLedger 'ledger' is given, the cost of the assignments
+    that expiring the HIT leaves unfilled is credited to it,
+    as in expire_HITId().
+    
+    Returns 'removed' if the HIT is gone, or 'expired' if it was expired
+    but cannot be deleted until it becomes Reviewable.
     '''
     
-    import os, subprocess
+    HITobj = mturk.get_hit( HITId = HITId )['HIT']
+    print('Removing HITId %s with current status %s' % ( HITId, HITobj['HITStatus'] ))
     
-    filepaths = list( set( filepaths ) )
-    if len( filepaths ) == 0:
+    if HITobj['HITStatus'] == 'Disposed':
+        return 'removed'
+    elif HITobj['HITStatus'] == 'Reviewable':
+        print('Approving reviewable assignments...')
+        num_approved = 0
+        for assignment in list( iter_all_assignments_for_HITId( mturk, HITId, AssignmentStatuses = [ 'Submitted' ] ) ):
+            mturk.approve_assignment( AssignmentId = assignment['AssignmentId'] )
+            num_approved += 1
+        print('Approved', num_approved, 'assignments.' if num_approved != 1 else 'assignment.')
+        
+        mturk.delete_hit( HITId = HITId )
+        return 'removed'
+    else:
+        ## UPDATE: There is no more disable_hit()
+        # mturk.disable_hit( HITId )
+        expire_HITId( mturk, HITId, ledger = ledger, HITobj = HITobj )
+        
+        ## A HIT with no assignments in progress becomes Reviewable right away.
+        if mturk.get_hit( HITId = HITId )['HIT']['HITStatus'] == 'Reviewable':
+            return remove_HITId( mturk, HITId )
+        
+        return 'expired'
+
+def remove_HITIds( mturk, HITIds, concurrency = DEFAULT_CONCURRENCY, max_wait = 0, retry_interval = 60, ledger = None ):
+    '''
+    Removes the given sequence of HITIds like remove_HITId(),
+    up to 'concurrency' HITs at a time.
+    
+    An Assignable or Unassignable HIT is expired first, but cannot be deleted
+    until it becomes Reviewable (when the workers holding its assignments
+    submit or time out). Instead of blocking on it, the other HITs are
+    processed, and the waiting HITs are tried again every 'retry_interval'
+    seconds for up to 'max_wait' seconds.
+    
+    Returns a dictionary mapping each HITId to its final state:
+    'removed', 'expired' (still waiting to become Reviewable),
+    or the exception that stopped it.
+    '''
+    
+    import time, sys
+    
+    state = {}
+    pending = list( HITIds )
+    deadline = time.time() + max_wait
+    while True:
+        waiting = []
+        for HITId, result, error in imap_concurrently( lambda HITId: remove_HITId( mturk, HITId, ledger = ledger ), pending, max_workers = concurrency ):
+            if error is not None:
+                print('[remove_HITId( %s ) failed: %s]' % ( HITId, error ), file=sys.stderr)
+                state[ HITId ] = error
+            else:
+                state[ HITId ] = result
+                if result == 'expired': waiting.append( HITId )
+        
+        num_removed = len([ s for s in state.values() if s == 'removed' ])
+        print('[remove_HITIds(): %d removed, %d waiting to become Reviewable, %d failed]' % ( num_removed, len( waiting ), len( state ) - num_removed - len( waiting ) ))
+        
+        if len( waiting ) == 0 or time.time() + retry_interval > deadline: break
+        
+        time.sleep( retry_interval )
+        pending = waiting
+    
+    return state
+
+def iter_all_HITs( mturk ):
+    '''
+    Yields all of the account's HITs, as returned by list_hits(),
+    one page at a time.
+    '''
+    
+    NextToken = None
+    while True:
+        kwargs = dict( MaxResults = 100, NextToken = NextToken )
+        if NextToken is None: del kwargs['NextToken']
+        hits = mturk.list_hits( **kwargs )
+        for hit in hits['HITs']:
+            yield hit
+        if len( hits['HITs'] ) == 0 or 'NextToken' not in hits: break
+        NextToken = hits['NextToken']
+
+def iter_reviewable_HITs( mturk, HITTypeId = None ):
+    '''
+    Yields the account's Reviewable HITs (of the HIT type 'HITTypeId',
+    if given), as returned by list_reviewable_hits(), one page at a time.
+    '''
+    
+    NextToken = None
+    while True:
+        kwargs = dict( Status = 'Reviewable', MaxResults = 100, NextToken = NextToken, HITTypeId = HITTypeId )
+        if NextToken is None: del kwargs['NextToken']
+        if HITTypeId is None: del kwargs['HITTypeId']
+        hits = mturk.list_reviewable_hits( **kwargs )
+        for hit in hits['HITs']:
+            yield hit
+        if len( hits['HITs'] ) == 0 or 'NextToken' not in hits: break
+        NextToken = hits['NextToken']
+
+def is_not_submitted_error( e ):
+    '''
+    Returns whether the exception 'e' is MTurk refusing to approve or reject
+    an assignment because its status isn't Submitted.
+    '''
+    
+    import botocore.exceptions
+    
+    if not isinstance( e, botocore.exceptions.ClientError ): return False
+    
+    error = e.response.get( 'Error', {} )
+    return error.get( 'Code' ) == 'RequestError' and 'This operation can be called with a status of' in error.get( 'Message', '' )
+
+def is_repeated_token_error( e ):
+    '''
+    Returns whether the exception 'e' is MTurk refusing a call because
+    its UniqueRequestToken was already used, i.e. the call already happened.
+    '''
+    
+    import botocore.exceptions
+    
+    if not isinstance( e, botocore.exceptions.ClientError ): return False
+    
+    error = e.response.get( 'Error', {} )
+    return error.get( 'Code' ) in ( 'RequestError', 'ParameterValidationError' ) and 'UniqueRequestToken' in error.get( 'Message', '' )
+
+class Journal:
+    '''
+    An append-only file of JSON records, one per line.
+    Each record is flushed to disk as soon as it is appended,
+    so that a run that crashes can see what it already did.
+    '''
+    
+    def __init__( self, path ):
+        import json, os, threading
+        
+        self.path = path
+        self.lock = threading.Lock()
+        
+        ## Load the existing records.
+        self.records = []
+        if os.path.exists( path ):
+            with open( path ) as f:
+                for line in f:
+                    try:
+                        self.records.append( json.loads( line ) )
+                    except ValueError:
+                        ## A crash can leave a partial last line.
+                        pass
+        
+        self.file = open( path, 'a' )
+    
+    def append( self, **record ):
+        import json, os
+        from datetime import timezone
+        
+        record[ 'time' ] = datetime.now( timezone.utc ).isoformat()
+        with self.lock:
+            self.file.write( json.dumps( record ) + '\n' )
+            self.file.flush()
+            os.fsync( self.file.fileno() )
+            self.records.append( record )
+    
+    def close( self ):
+        self.file.close()
+    
+    def __enter__( self ):
+        return self
+    
+    def __exit__( self, *args ):
+        self.close()
+
+def review_assignments_from_CSV( mturk, csv_path, journal_path = None, concurrency = 1 ):
+    '''
+    Given 'mturk', an object returned from create_mturk(), and
+    a path to a CSV file in the shape assignments2CSV() produces with some
+    additional columns, approves, rejects, and pays bonuses for assignments.
+    The columns used are:
+        AssignmentId;
+        decision: "approve", "reject", or empty to do neither;
+        feedback: optional RequesterFeedback for the decision;
+        bonus: optional bonus amount in dollars, e.g. "0.50";
+        WorkerId: required for a bonus;
+        bonus_reason: the Reason for a bonus (defaults to 'feedback').
+    
+    Up to 'concurrency' calls are made at once.
+    
+    Each completed action is appended to the journal at 'journal_path'
+    (by default, 'csv_path' + ".journal"). Actions already in the journal
+    are skipped, so a crashed run can simply be run again.
+    Bonuses are sent with a UniqueRequestToken derived from the row,
+    so MTurk refuses to pay a bonus twice even if the journal missed it,
+    and are journaled by it, so one assignment can have several bonuses.
+    A decision the journal missed is found when MTurk refuses it because
+    the assignment is no longer Submitted but already has that decision.
+    
+    Returns a list of ( AssignmentId, action, exception ) for the actions
+    that failed.
+    '''
+    
+    import csv, hashlib, sys
+    
+    if journal_path is None: journal_path = csv_path + '.journal'
+    
+    with open( csv_path ) as f:
+        rows = list( csv.DictReader( f ) )
+    
+    ## Validate everything before doing anything.
+    decisions = []
+    bonuses = []
+    for row in rows:
+        decision = ( row.get( 'decision' ) or '' ).strip().lower()
+        if decision in ( 'approve', 'reject' ):
+            decisions.append( ( row, decision ) )
+        elif decision != '':
+            raise ValueError( 'Unknown decision for AssignmentId %s: %s' % ( row['AssignmentId'], row['decision'] ) )
+        
+        if ( row.get( 'bonus' ) or '' ).strip() != '':
+            if ( row.get( 'WorkerId' ) or '' ).strip() == '':
+                raise ValueError( 'A bonus needs a WorkerId for AssignmentId %s' % row['AssignmentId'] )
+            if ( row.get( 'bonus_reason' ) or row.get( 'feedback' ) or '' ).strip() == '':
+                raise ValueError( 'A bonus needs a bonus_reason or feedback for AssignmentId %s' % row['AssignmentId'] )
+            bonuses.append( ( row, 'bonus' ) )
+    
+    def bonus_token( row ):
+        BonusAmount = row['bonus'].strip()
+        Reason = row.get( 'bonus_reason' ) or row['feedback']
+        return hashlib.sha1( '\0'.join([ row['AssignmentId'], row['WorkerId'], BonusAmount, Reason ]).encode( 'utf-8' ) ).hexdigest()
+    
+    def key( row, action ):
+        ## Decisions are journaled by assignment, and bonuses by token.
+        return ( action, bonus_token( row ) if action == 'bonus' else row['AssignmentId'] )
+    
+    journal = Journal( journal_path )
+    done = set([ ( record['action'], record.get( 'UniqueRequestToken' ) if record['action'] == 'bonus' else record['AssignmentId'] ) for record in journal.records ])
+    
+    def decide( row_and_action ):
+        row, action = row_and_action
+        kwargs = dict( AssignmentId = row['AssignmentId'] )
+        if ( row.get( 'feedback' ) or '' ).strip() != '':
+            kwargs[ 'RequesterFeedback' ] = row['feedback']
+        
+        try:
+            if action == 'approve':
+                mturk.approve_assignment( **kwargs )
+            else:
+                mturk.reject_assignment( **kwargs )
+        except Exception as e:
+            ## MTurk refuses to decide an assignment that isn't Submitted.
+            ## If it already has this decision, an earlier run made it
+            ## but crashed before journaling it.
+            if not is_not_submitted_error( e ): raise
+            status = mturk.get_assignment( AssignmentId = row['AssignmentId'] )['Assignment']['AssignmentStatus']
+            if status != { 'approve': 'Approved', 'reject': 'Rejected' }[ action ]: raise
+            print('[%s( %s ): already %s]' % ( action, row['AssignmentId'], status ))
+        
+        journal.append( action = action, AssignmentId = row['AssignmentId'] )
+    
+    def pay( row_and_action ):
+        row, action = row_and_action
+        BonusAmount = row['bonus'].strip()
+        Reason = row.get( 'bonus_reason' ) or row['feedback']
+        UniqueRequestToken = bonus_token( row )
+        
+        try:
+            mturk.send_bonus( WorkerId = row['WorkerId'], BonusAmount = BonusAmount, AssignmentId = row['AssignmentId'], Reason = Reason, UniqueRequestToken = UniqueRequestToken )
+        except Exception as e:
+            ## MTurk rejects a repeated token. That means an earlier run
+            ## paid this bonus but crashed before journaling it.
+            if not is_repeated_token_error( e ): raise
+            print('[send_bonus( %s ): already paid]' % ( row['AssignmentId'], ))
+        
+        journal.append( action = action, AssignmentId = row['AssignmentId'], BonusAmount = BonusAmount, UniqueRequestToken = UniqueRequestToken )
+    
+    num_done = len([ row for row, action in decisions + bonuses if key( row, action ) in done ])
+    
+    failures = []
+    with journal:
+        ## Decide before paying bonuses.
+        for func, todo in [ ( decide, decisions ), ( pay, bonuses ) ]:
+            todo = [ ( row, action ) for row, action in todo if key( row, action ) not in done ]
+            for ( row, action ), result, error in imap_concurrently( func, todo, max_workers = concurrency ):
+                if error is None:
+                    print('[%s( %s )]' % ( action, row['AssignmentId'] ))
+                else:
+                    print('[%s( %s ) failed: %s]' % ( action, row['AssignmentId'], error ), file=sys.stderr)
+                    failures.append( ( row['AssignmentId'], action, error ) )
+    
+    print('[review_assignments_from_CSV( %s ): %d decisions, %d bonuses, %d already done, %d failed]' % ( csv_path, len( decisions ), len( bonuses ), num_done, len( failures ) ))
+    
+    return failures
+
+def iter_HITIds2HITs( mturk, HITIds, concurrency = DEFAULT_CONCURRENCY ):
+    '''
+    Given a sequence of HITIds, yields corresponding
+    boto3.mturk.connection.HIT objects in the same order,
+    fetching up to 'concurrency' of them at once.
+    'mturk' should have been created with at least that many
+    'max_pool_connections'.
+    '''
+    
+    def get_hit( HITId ):
+        get_hit_result = mturk.get_hit(
+            HITId = HITId
+            ## The default for get_hit() is HITDetail, HITQuestion and Minimal;
+            ## also add HITAssignmentSummary for NumberofAssignmentsPending,
+            ## NumberofAssignmentsAvailable, or NumberofAssignmentsCompleted.
+            # response_groups = ( 'Minimal', 'HITDetail', 'HITQuestion', 'HITAssignmentSummary' ),
+            )
+        
+        # assert get_hit_result.status
+        return get_hit_result['HIT']
+    
+    for HITId, hit, error in imap_concurrently( get_hit, HITIds, max_workers = concurrency ):
+        if error is not None: raise error
+        yield hit
+
+def HITIds2HITs( mturk, HITIds, concurrency = DEFAULT_CONCURRENCY ):
+    '''
+    Given a sequence of HITIds, return corresponding
+    boto3.mturk.connection.HIT objects.
+    See iter_HITIds2HITs().
+    '''
+    
+    return list( iter_HITIds2HITs( mturk, HITIds, concurrency = concurrency ) )
+
+def HITIds2CSV( mturk, HITIds, concurrency = DEFAULT_CONCURRENCY ):
+    return HITs2CSV( iter_HITIds2HITs( mturk, HITIds, concurrency = concurrency ) )
+
+def parse_question_xml( question_xml ):
+    '''
+    Given the XML string in a HIT's 'Question' field,
+    returns a dictionary with the fields found in it:
+        'QuestionType': the name of the root element, one of
+            'ExternalQuestion', 'HTMLQuestion', or 'QuestionForm';
+        'ExternalURL' and 'FrameHeight', for an ExternalQuestion;
+        'HTMLContent' and 'FrameHeight', for an HTMLQuestion;
+        'QuestionIdentifiers', the list of question ids, for a QuestionForm.
+    
+    Many HITs in a batch share the same Question,
+    so recent results are cached. Don't modify the returned dictionary.
+    '''
+    
+    return _parse_question_xml_cached( question_xml )
+
+@functools.lru_cache( maxsize = 1024 )
+def _parse_question_xml_cached( question_xml ):
+    import xml.parsers.expat
+    
+    result = {}
+    text = []
+    
+    def start( name, attrs ):
+        if 'QuestionType' not in result:
+            result['QuestionType'] = name.rpartition( ':' )[2]
+        del text[:]
+    
+    def end( name ):
+        ## Ignore any namespace prefix.
+        name = name.rpartition( ':' )[2]
+        data = ''.join( text )
+        del text[:]
+        
+        if name in ( 'ExternalURL', 'FrameHeight', 'HTMLContent' ):
+            ## Use the first occurrence, like getElementsByTagName(...)[0].
+            result.setdefault( name, data.strip() if name != 'HTMLContent' else data )
+        elif name == 'QuestionIdentifier':
+            result.setdefault( 'QuestionIdentifiers', [] ).append( data.strip() )
+    
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text.append
+    parser.Parse( question_xml, True )
+    
+    return result
+
+def HITs2CSV( HITs ):
+    '''
+    Given a sequence of boto3.mturk.connection.HIT objects, as returned by
+    boto3.mturk.connection.MTurkConnection.create_hit() or
+    boto3.mturk.connection.MTurkConnection.get_hit(),
+    returns a string of CSV data representing the assignments.
+    
+    NOTE: In order to get the CreationTime field,
+          it is necessary to have passed 'HITDetail'
+          as an element of 'response_groups':
+              response_groups = ( 'Minimal', 'HITDetail' )
+          to create_hit() or get_hit().
+    
+    NOTE: In order to get the NumberofAssignmentsPending,
+          NumberofAssignmentsAvailable, or NumberofAssignmentsCompleted
+          fields, it is necessary to have passed 'HITAssignmentSummary'
+          as an element of 'response_groups':
+              response_groups = ( 'Minimal', 'HITDetail', 'HITAssignmentSummary' )
+          to create_hit() or get_hit().
+    
+    NOTE: In order to get the ExternalURL and FrameHeight fields,
+          it is necessary to have passed 'HITQuestion'
+          as an element of 'response_groups':
+              response_groups = ( 'Minimal', 'HITDetail', 'HITQuestion', 'HITAssignmentSummary' )
+          to create_hit() or get_hit().
+    '''
+    
+    import io
+    
+    out = io.StringIO()
+    write_HITs_CSV( HITs, out )
+    return out.getvalue()
+
+## Column names for HITs:
+HIT_primary_fields = [ 'HITId', 'HITTypeId', 'CreationTime', 'Title', 'Description', 'Keywords', 'HITStatus', 'Reward', 'LifetimeInSeconds', 'AssignmentDurationInSeconds', 'MaxAssignments', 'AutoApprovalDelayInSeconds', 'ExternalURL', 'FrameHeight', 'RequesterAnnotation', 'NumberOfSimilarHITs', 'HITReviewStatus', 'NumberofAssignmentsPending', 'NumberofAssignmentsAvailable', 'NumberofAssignmentsCompleted' ]
+
+def HIT2row( hit ):
+    '''
+    Given a boto3 HIT dictionary,
+    returns a dictionary mapping CSV column names to values.
+    '''
+    
+    row = {}
+    
+    ## Parse the Question once for all the fields that come from it.
+    with timed( 'parse_question_xml' ):
+        question = parse_question_xml( hit['Question'] ) if 'Question' in hit else {}
+    
+    for field in HIT_primary_fields:
+        ## There are a few special cases:
+        if field in ( 'ExternalURL', 'FrameHeight' ):
+            if field in question:
+                row[ field ] = question[ field ]
+        ## The general case:
+        elif field in hit:
+            row[ field ] = hit[ field ]
+    
+    return row
+
+def write_HITs_CSV( HITs, out ):
+    '''
+    Given an iterable of HIT objects, such as the one returned by
+    iter_HITIds2HITs(), and a file-like object 'out',
+    writes the CSV data HITs2CSV() would return, one row at a time
+    as the HITs arrive.
+    Returns the number of rows written.
+    '''
+    
+    import csv
+    
+    dw = csv.DictWriter( out, HIT_primary_fields, lineterminator = '\n' )
+    dw.writeheader()
+    count = 0
+    for hit in HITs:
+        row = HIT2row( hit )
+        with timed( 'write_CSV_row' ):
+            dw.writerow( row )
+        count += 1
+    return count
+
+## Column names for assignments, before the question ids:
+assignment_primary_fields = [ 'HITId', 'AssignmentId', 'WorkerId', 'AssignmentStatus', 'AutoApprovalTime', 'AcceptTime', 'SubmitTime', 'ApprovalTime', 'RejectionTime', 'Deadline', 'RequesterFeedback' ]
+
+def parse_answer_xml( answer_xml ):
+    '''
+    Given the QuestionFormAnswers XML string in an Assignment's 'Answer' field,
+    returns a list of ( QuestionIdentifier, value ) pairs, in order.
+    
+    The value is:
+        the FreeText string, for a free-text answer;
+        the list of SelectionIdentifier strings (followed by the OtherSelectionText, if any),
+        for a selection answer;
+        the UploadedFileKey string, for a file-upload answer.
+    
+    This uses expat directly rather than building a DOM,
+    since it is called once per assignment.
+    '''
+    
+    import xml.parsers.expat
+    
+    answers = []
+    text = []
+    current = {}
+    
+    def start( name, attrs ):
+        del text[:]
+    
+    def end( name ):
+        ## Ignore any namespace prefix.
+        name = name.rpartition( ':' )[2]
+        data = ''.join( text )
+        del text[:]
+        
+        if name == 'QuestionIdentifier':
+            current['qid'] = data
+        elif name in ( 'FreeText', 'UploadedFileKey' ):
+            current['value'] = data
+        elif name in ( 'SelectionIdentifier', 'OtherSelectionText' ):
+            current.setdefault( 'value', [] ).append( data )
+        elif name == 'Answer':
+            answers.append( ( current['qid'], current.get( 'value' ) ) )
+            current.clear()
+    
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text.append
+    parser.Parse( answer_xml, True )
+    
+    return answers
+
+def assignment2row( a ):
+    '''
+    Given a boto3 Assignment dictionary,
+    returns a dictionary mapping CSV column names to values,
+    with one column per question id in the assignment's Answer.
+    '''
+    
+    import json
+    
+    row = {}
+    
+    for field in assignment_primary_fields:
+        if field in a:
+            row[ field ] = a[field]
+    
+    ### Now, question ids.
+    ## My older forked boto:
+    #answers = [ ( answer.QuestionIdentifier, answer.FreeText ) for answer in a.answers ]
+    ## My current forked boto:
+    # answers = [ ( answer.qid, answer.fields ) for answer in a.answers[0] ]
+    ## UPDATE: boto3 doesn't parse this for us.
+    # answersdom = xml.dom.minidom.parseString( a['Answer'] )
+    # answers = [ ( a.childNodes[0].firstChild.data, a.childNodes[1].firstChild.data ) for a in answersdom.getElementsByTagName( 'Answer' ) ]
+    ## UPDATE 2: Building a DOM for every assignment is slow; use expat.
+    with timed( 'parse_answer_xml' ):
+        answers = parse_answer_xml( a['Answer'] )
+    
+    for qid, fields in answers:
+        assert qid not in row
+        row[ qid ] = json.dumps( fields )
+    
+    return row
+
+class AssignmentRecord:
+    '''
+    A compact, read-only stand-in for a boto3 Assignment dictionary,
+    for holding many assignments in memory.
+    
+    It has a slot per field instead of a dictionary, and the strings that
+    repeat across assignments (HITId, WorkerId, AssignmentStatus, and
+    RequesterFeedback) are interned, so each distinct value is stored once.
+    The Answer XML is kept as is and only parsed when asked for,
+    by answers() or by assignment2row().
+    
+    It can be read like the dictionary (a['WorkerId'], 'ApprovalTime' in a,
+    a.get(), a.items()), so it can be passed to anything that takes
+    boto3 Assignment dictionaries, like write_assignments_CSV(),
+    export_assignments(), and AssignmentStore.update().
+    '''
+    
+    fields = tuple( assignment_primary_fields ) + ( 'Answer', )
+    interned_fields = ( 'HITId', 'WorkerId', 'AssignmentStatus', 'RequesterFeedback' )
+    __slots__ = fields
+    
+    def __init__( self, assignment ):
+        import sys
+        
+        ## A missing field is None.
+        for field in self.fields:
+            value = assignment.get( field )
+            if field in self.interned_fields and value is not None: value = sys.intern( value )
+            setattr( self, field, value )
+    
+    def __getitem__( self, field ):
+        value = getattr( self, field, None ) if field in self.fields else None
+        if value is None: raise KeyError( field )
+        return value
+    
+    def __contains__( self, field ):
+        return field in self.fields and getattr( self, field ) is not None
+    
+    def get( self, field, default = None ):
+        return self[ field ] if field in self else default
+    
+    def keys( self ):
+        return [ field for field in self.fields if getattr( self, field ) is not None ]
+    
+    def __iter__( self ):
+        return iter( self.keys() )
+    
+    def __len__( self ):
+        return len( self.keys() )
+    
+    def items( self ):
+        return [ ( field, getattr( self, field ) ) for field in self.keys() ]
+    
+    def to_dict( self ):
+        '''
+        Returns the boto3 Assignment dictionary, without the fields
+        MTurk didn't return.
+        '''
+        
+        return dict( self.items() )
+    
+    def answers( self ):
+        '''
+        Returns the parsed Answer, as parse_answer_xml() does.
+        '''
+        
+        with timed( 'parse_answer_xml' ):
+            return parse_answer_xml( self.Answer )
+    
+    def __repr__( self ):
+        return 'AssignmentRecord( %r )' % ( self.to_dict(), )
+
+def write_assignment_rows_CSV( rows, out, qids = None, sample_size = 1000 ):
+    '''
+    Given an iterable of dictionaries as returned by assignment2row()
+    and a file-like object 'out', writes CSV data with the primary columns
+    followed by the sorted question ids, one row at a time.
+    Returns the number of rows written.
+    
+    The question id columns must be known before the header is written.
+    If the sequence 'qids' is given, it is used as the question ids, and
+    a row with any other question id raises a ValueError.
+    Otherwise, the first 'sample_size' rows are held in memory.
+    If that is all of them, their question ids are used.
+    If there are more, all rows are spilled to a temporary file
+    while collecting question ids and then written in a second pass.
+    '''
+    
+    import csv
+    
+    with assignment_rows_with_qids( rows, qids = qids, sample_size = sample_size ) as ( fields, rows ):
+        dw = csv.DictWriter( out, assignment_primary_fields + fields, lineterminator = '\n' )
+        dw.writeheader()
+        count = 0
+        for row in rows:
+            with timed( 'write_CSV_row' ):
+                dw.writerow( row )
+            count += 1
+        return count
+
+@contextlib.contextmanager
+def assignment_rows_with_qids( rows, qids = None, sample_size = 1000 ):
+    '''
+    Given an iterable of dictionaries as returned by assignment2row(),
+    returns a context manager giving ( qid_fields, rows ), where
+    'qid_fields' is the sorted list of question ids and 'rows' iterates
+    over the same rows, for writers that need the columns up front.
+    
+    If the sequence 'qids' is given, it is used as the question ids, and
+    a row with any other question id raises a ValueError.
+    Otherwise, the first 'sample_size' rows are held in memory.
+    If that is all of them, their question ids are used.
+    If there are more, all rows are spilled to a temporary file
+    while collecting question ids, and read back from it.
+    '''
+    
+    import json, itertools, tempfile
+    
+    rows = iter( rows )
+    
+    if qids is not None:
+        qid_fields = sorted( qids )
+        def checked():
+            for row in rows:
+                extra = [ field for field in row if field not in assignment_primary_fields and field not in qids ]
+                if len( extra ) > 0: raise ValueError( 'unexpected question ids: %s' % extra )
+                yield row
+        yield ( qid_fields, checked() )
+        return
+    
+    qid_fields = set()
+    def collect_qids( row ):
+        qid_fields.update( field for field in row if field not in assignment_primary_fields )
+        return row
+    
+    sample = [ collect_qids( row ) for row in itertools.islice( rows, sample_size ) ]
+    
+    ## Peek to see if there are more rows.
+    nextrow = next( rows, None )
+    if nextrow is None:
+        yield ( sorted( qid_fields ), iter( sample ) )
+        return
+    
+    with tempfile.TemporaryFile( 'w+' ) as spill:
+        ## Dates are written as the strings they would be in the CSV.
+        for row in itertools.chain( sample, [ nextrow ], rows ):
+            spill.write( json.dumps( collect_qids( row ), default = str ) )
+            spill.write( '\n' )
+        del sample
+        
+        spill.seek( 0 )
+        yield ( sorted( qid_fields ), ( json.loads( line ) for line in spill ) )
+
+def assignment_rows2CSV( rows ):
+    '''
+    Given a sequence of dictionaries as returned by assignment2row(),
+    returns a string of CSV data with the primary columns followed by
+    the sorted question ids.
+    '''
+    
+    import io
+    
+    rows = list( rows )
+    out = io.StringIO()
+    write_assignment_rows_CSV( rows, out, sample_size = len( rows ) )
+    return out.getvalue()
+
+def write_assignments_CSV( assignments, out, qids = None, sample_size = 1000, store = None ):
+    '''
+    Given an iterable of boto3 Assignment dictionaries, such as
+    the one returned by iter_all_assignments_for_HITId(), and
+    a file-like object 'out', writes CSV data representing the assignments
+    without holding them all in memory.
+    Returns the number of rows written.
+    
+    See write_assignment_rows_CSV() for 'qids' and 'sample_size', and
+    assignments2CSV() for 'store'.
+    '''
+    
+    return write_assignment_rows_CSV( assignment_rows( assignments, store = store ), out, qids = qids, sample_size = sample_size )
+
+def assignment_rows( assignments, store = None ):
+    '''
+    Given an iterable of boto3 Assignment dictionaries, yields
+    the row assignment2row() returns for each one.
+    If an AssignmentStore 'store' is given, the rows come from
+    AssignmentStore.update(), a page at a time.
+    '''
+    
+    import itertools
+    
+    if store is None:
+        for a in assignments:
+            yield assignment2row( a )
+        return
+    
+    assignments_iter = iter( assignments )
+    while True:
+        page = list( itertools.islice( assignments_iter, 100 ) )
+        if len( page ) == 0: break
+        rows, changed = store.update( page )
+        for row in rows: yield row
+
+def assignments2CSV( assignments, store = None ):
+    '''
+    Given a sequence of boto3.mturk.connection.Assignment objects as returned by
+    boto3.mturk.connection.MTurkConnection.get_assignments(),
+    returns a string of CSV data representing the assignments.
+    
+    If an AssignmentStore 'store' is given, only assignments that are new
+    or whose status changed are parsed (and saved to the store);
+    the rest are read back from the store.
+    
+    NOTE: For very large sets of assignments, use write_assignments_CSV()
+          to write directly to a file instead.
+    '''
+    
+    import io
+    
+    assignments = list( assignments )
+    out = io.StringIO()
+    write_assignments_CSV( assignments, out, sample_size = len( assignments ), store = store )
+    return out.getvalue()
+
+## The file formats export_assignments() and export_HITs() can write,
+## by file name extension.
+export_formats = ( 'csv', 'jsonl', 'parquet', 'arrow' )
+
+## Columns that hold times, for formats with typed columns.
+time_fields = ( 'CreationTime', 'Expiration', 'AutoApprovalTime', 'AcceptTime', 'SubmitTime', 'ApprovalTime', 'RejectionTime', 'Deadline' )
+## HIT columns that hold integers.
+HIT_integer_fields = ( 'LifetimeInSeconds', 'AssignmentDurationInSeconds', 'MaxAssignments', 'AutoApprovalDelayInSeconds', 'FrameHeight', 'NumberOfSimilarHITs', 'NumberofAssignmentsPending', 'NumberofAssignmentsAvailable', 'NumberofAssignmentsCompleted' )
+
+def export_format( path ):
+    '''
+    Returns the export format for 'path' from its extension,
+    or raises a ValueError.
+    '''
+    
+    import os
+    
+    extension = os.path.splitext( path )[1].lstrip( '.' ).lower()
+    if extension not in export_formats:
+        raise ValueError( 'Unknown export format "%s"; use one of: %s' % ( extension, ', '.join( export_formats ) ) )
+    return extension
+
+def parse_time( value ):
+    '''
+    Returns 'value', a datetime or a string as it appears in the CSV,
+    as a datetime (or None).
+    '''
+    
+    if value is None or value == '' or isinstance( value, datetime ): return value or None
+    return datetime.fromisoformat( value )
+
+def decoded_answer_row( row ):
+    '''
+    Given a row as returned by assignment2row(), returns a copy
+    with the question ids' answers decoded from JSON.
+    '''
+    
+    import json
+    
+    return dict([ ( field, value if field in assignment_primary_fields else json.loads( value ) ) for field, value in row.items() ])
+
+def write_JSONL( rows, out ):
+    '''
+    Writes the dictionaries in the iterable 'rows' to the file-like object
+    'out' as newline-delimited JSON, with times in ISO 8601.
+    Returns the number of rows written.
+    '''
+    
+    import json
+    
+    def encode( value ):
+        if isinstance( value, datetime ): return value.isoformat()
+        return str( value )
+    
+    count = 0
+    for row in rows:
+        out.write( json.dumps( row, default = encode ) )
+        out.write( '\n' )
+        count += 1
+    return count
+
+def import_pyarrow( format ):
+    '''
+    Returns the pyarrow module, or raises a RuntimeError
+    saying that writing 'format' requires it.
+    '''
+    
+    try:
+        import pyarrow
+    except ImportError:
+        raise RuntimeError( 'Writing %s requires pyarrow ("pip install pyarrow").' % format )
+    return pyarrow
+
+def write_arrow( rows, path, schema, format = 'parquet', batch_size = 10000 ):
+    '''
+    Writes the dictionaries in the iterable 'rows' to 'path' as Parquet
+    or as an Arrow IPC file (for 'format' "arrow"), with the
+    pyarrow.Schema 'schema'. Values for timestamp columns are converted
+    with parse_time().
+    Rows are written 'batch_size' at a time (one Parquet row group each),
+    so that only one batch is held in memory.
+    Returns the number of rows written.
+    
+    Requires pyarrow.
+    '''
+    
+    pyarrow = import_pyarrow( format )
+    import pyarrow.parquet, pyarrow.ipc, itertools
+    
+    time_columns = [ field.name for field in schema if pyarrow.types.is_timestamp( field.type ) ]
+    
+    def convert( row ):
+        row = dict( row )
+        for name in time_columns:
+            row[ name ] = parse_time( row.get( name ) )
+        return row
+    
+    if format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter( path, schema )
+    else:
+        writer = pyarrow.ipc.new_file( path, schema )
+    
+    count = 0
+    rows = iter( rows )
+    with writer:
+        while True:
+            batch = [ convert( row ) for row in itertools.islice( rows, batch_size ) ]
+            if len( batch ) == 0: break
+            with timed( 'write_arrow_batch' ):
+                writer.write_table( pyarrow.Table.from_pylist( batch, schema = schema ) )
+            count += len( batch )
+    return count
+
+def export_assignment_rows( rows, path, qids = None, sample_size = 1000, batch_size = 10000 ):
+    '''
+    Given an iterable of dictionaries as returned by assignment2row(),
+    writes them to 'path' in the format given by its extension
+    (see export_formats).
+    Returns the number of rows written.
+    
+    CSV is written as by write_assignment_rows_CSV(), with each answer
+    JSON-encoded.
+    JSONL has one object per assignment, with each answer decoded.
+    Parquet and Arrow have one column per question id, with times
+    as UTC timestamps. A question id column is a list of strings if any
+    answer in the first 'sample_size' rows is a list (a selection),
+    and a string otherwise.
+    
+    See write_assignment_rows_CSV() for 'qids' and 'sample_size',
+    and write_arrow() for 'batch_size'.
+    '''
+    
+    format = export_format( path )
+    
+    if format == 'csv':
+        with open( path, 'w' ) as f:
+            return write_assignment_rows_CSV( rows, f, qids = qids, sample_size = sample_size )
+    
+    if format == 'jsonl':
+        with open( path, 'w' ) as f:
+            return write_JSONL( ( decoded_answer_row( row ) for row in rows ), f )
+    
+    pyarrow = import_pyarrow( format )
+    import json, itertools
+    
+    rows = ( decoded_answer_row( row ) for row in rows )
+    ## Look at a sample to decide the type of each question id.
+    sample = list( itertools.islice( rows, sample_size ) )
+    list_qids = set([ field for row in sample for field, value in row.items() if isinstance( value, list ) ])
+    
+    with assignment_rows_with_qids( itertools.chain( sample, rows ), qids = qids, sample_size = sample_size ) as ( qid_fields, rows ):
+        columns = []
+        for field in assignment_primary_fields:
+            columns.append( ( field, pyarrow.timestamp( 'us', tz = 'UTC' ) if field in time_fields else pyarrow.string() ) )
+        for qid in qid_fields:
+            columns.append( ( qid, pyarrow.list_( pyarrow.string() ) if qid in list_qids else pyarrow.string() ) )
+        schema = pyarrow.schema( columns )
+        
+        def typed( row ):
+            ## Make each answer fit its column's type.
+            for qid in qid_fields:
+                value = row.get( qid )
+                if value is None: continue
+                if qid in list_qids and not isinstance( value, list ): row[ qid ] = [ value ]
+                elif qid not in list_qids and isinstance( value, list ): row[ qid ] = json.dumps( value )
+            return row
+        
+        return write_arrow( ( typed( row ) for row in rows ), path, schema, format = format, batch_size = batch_size )
+
+def export_assignments( assignments, path, store = None, **kwargs ):
+    '''
+    Given an iterable of boto3 Assignment dictionaries, such as
+    the one returned by iter_all_assignments_for_HITId(), writes them
+    to 'path' in the format given by its extension.
+    See export_assignment_rows() for the formats and keyword arguments,
+    and assignments2CSV() for 'store'.
+    '''
+    
+    return export_assignment_rows( assignment_rows( assignments, store = store ), path, **kwargs )
+
+def export_HITs( HITs, path, batch_size = 10000 ):
+    '''
+    Given an iterable of HIT objects, such as the one returned by
+    iter_HITIds2HITs(), writes them to 'path' in the format given by
+    its extension (see export_formats), with the columns of HITs2CSV().
+    Parquet and Arrow have typed times and integers.
+    Returns the number of rows written.
+    '''
+    
+    format = export_format( path )
+    
+    rows = ( HIT2row( hit ) for hit in HITs )
+    
+    if format == 'csv':
+        with open( path, 'w' ) as f:
+            return write_HITs_CSV( HITs, f )
+    
+    if format == 'jsonl':
+        with open( path, 'w' ) as f:
+            return write_JSONL( rows, f )
+    
+    pyarrow = import_pyarrow( format )
+    
+    columns = []
+    for field in HIT_primary_fields:
+        if field in time_fields: columns.append( ( field, pyarrow.timestamp( 'us', tz = 'UTC' ) ) )
+        elif field in HIT_integer_fields: columns.append( ( field, pyarrow.int64() ) )
+        else: columns.append( ( field, pyarrow.string() ) )
+    
+    def typed( row ):
+        for field in HIT_integer_fields:
+            if row.get( field ) not in ( None, '' ): row[ field ] = int( row[ field ] )
+        for field, value in row.items():
+            if field not in time_fields and field not in HIT_integer_fields and value is not None: row[ field ] = str( value )
+        return row
+    
+    return write_arrow( ( typed( row ) for row in rows ), path, pyarrow.schema( columns ), format = format, batch_size = batch_size )
+
+def import_numpy():
+    '''
+    Returns the numpy module, or raises a RuntimeError saying that
+    analyzing requires it.
+    '''
+    
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError( 'Analyzing assignments requires numpy ("pip install numpy").' )
+    return numpy
+
+def assignment_arrays( rows ):
+    '''
+    Given an iterable of rows as returned by assignment2row(), or as read
+    back with csv.DictReader from the CSV written by write_assignments_CSV(),
+    returns a dictionary of NumPy arrays with one element per assignment:
+        'AssignmentId' and 'AssignmentStatus' (strings);
+        'worker' and 'HIT', indices into the arrays 'WorkerIds' and 'HITIds';
+        'seconds', from AcceptTime to SubmitTime (NaN if either is missing);
+        'signature', the same number for assignments with identical answers;
+    and, with one element per answered question id:
+        'answer_assignment', the index of the assignment;
+        'answer_qid', an index into the array 'qids';
+        'answer', the same number for identical answers.
+    Strings are turned into numbers here, so everything after
+    this is vectorized.
+    '''
+    
+    np = import_numpy()
+    
+    def factorize( values ):
+        ## Returns the distinct values, in order of appearance,
+        ## and the array of each value's index among them.
+        distinct = list( dict.fromkeys( values ) )
+        index = dict( zip( distinct, range( len( distinct ) ) ) )
+        return distinct, np.array( [ index[ value ] for value in values ], dtype = np.int64 )
+    
+    import gc
+    
+    primary_fields = set( assignment_primary_fields )
+    
+    AssignmentIds = []
+    AssignmentStatuses = []
+    WorkerIds = []
+    HITIds = []
+    seconds = []
+    signatures = []
+    answer_assignment = []
+    answer_qids = []
+    answers = []
+    ## The millions of small objects made here would otherwise set off
+    ## one garbage collection after another, each slower than the last.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i, row in enumerate( rows ):
+            AssignmentIds.append( row['AssignmentId'] )
+            AssignmentStatuses.append( row.get( 'AssignmentStatus' ) )
+            WorkerIds.append( row['WorkerId'] )
+            HITIds.append( row['HITId'] )
+            
+            AcceptTime = parse_time( row.get( 'AcceptTime' ) )
+            SubmitTime = parse_time( row.get( 'SubmitTime' ) )
+            seconds.append( ( SubmitTime - AcceptTime ).total_seconds() if AcceptTime is not None and SubmitTime is not None else np.nan )
+            
+            ## A CSV row has every question id, with empty values for
+            ## the ones this assignment didn't answer.
+            items = sorted([ item for item in row.items() if item[0] not in primary_fields and item[1] not in ( None, '' ) ])
+            answer_assignment.extend( [ i ] * len( items ) )
+            answer_qids.extend( [ qid for qid, value in items ] )
+            answers.extend( [ value for qid, value in items ] )
+            signatures.append( tuple( items ) )
+        
+        WorkerIds, worker = factorize( WorkerIds )
+        HITIds, HIT = factorize( HITIds )
+        qids, answer_qid = factorize( answer_qids )
+        signature = factorize( signatures )[1]
+        answer = factorize( answers )[1]
+    finally:
+        if gc_was_enabled: gc.enable()
+    
+    return {
+        'AssignmentId': np.array( AssignmentIds, dtype = object ),
+        'AssignmentStatus': np.array( AssignmentStatuses, dtype = object ),
+        'worker': worker,
+        'HIT': HIT,
+        'WorkerIds': np.array( WorkerIds, dtype = object ),
+        'HITIds': np.array( HITIds, dtype = object ),
+        'qids': np.array( qids, dtype = object ),
+        'seconds': np.array( seconds, dtype = float ),
+        'signature': signature,
+        'answer_assignment': np.array( answer_assignment, dtype = np.int64 ),
+        'answer_qid': answer_qid,
+        'answer': answer
+        }
+
+def assignment_statistics( arrays ):
+    '''
+    Given the dictionary returned by assignment_arrays(), returns
+    a dictionary of arrays with one element per assignment:
+        'agreement': for each question id, the fraction of the other
+            assignments of the same HIT with the same answer, averaged over
+            the question ids (NaN if no other assignment answered them);
+        'duplicate': True if the same worker gave identical answers
+            in another assignment.
+    '''
+    
+    np = import_numpy()
+    
+    n = len( arrays['AssignmentId'] )
+    a = arrays['answer_assignment']
+    
+    ## Group the answers by ( HIT, qid ) and by ( HIT, qid, answer ).
+    HIT_qid = arrays['HIT'][ a ] * len( arrays['qids'] ) + arrays['answer_qid']
+    HIT_qid_answer = HIT_qid * ( arrays['answer'].max() + 1 if len( a ) > 0 else 1 ) + arrays['answer']
+    others = np.unique( HIT_qid, return_inverse = True, return_counts = True )
+    others = others[2][ others[1] ] - 1
+    agreeing = np.unique( HIT_qid_answer, return_inverse = True, return_counts = True )
+    agreeing = agreeing[2][ agreeing[1] ] - 1
+    
+    compared = others > 0
+    with np.errstate( invalid = 'ignore' ):
+        agreement = np.bincount( a[ compared ], weights = agreeing[ compared ] / others[ compared ], minlength = n ) / np.bincount( a[ compared ], minlength = n )
+    
+    ## Assignments without answers aren't duplicates of each other.
+    worker_signature = arrays['worker'] * ( arrays['signature'].max() + 1 if n > 0 else 1 ) + arrays['signature']
+    repeated = np.unique( worker_signature, return_inverse = True, return_counts = True )
+    duplicate = ( repeated[2][ repeated[1] ] > 1 ) & ( np.bincount( a, minlength = n ) > 0 )
+    
+    return { 'agreement': agreement, 'duplicate': duplicate }
+
+def worker_statistics( arrays, statistics ):
+    '''
+    Given the dictionaries returned by assignment_arrays() and
+    assignment_statistics(), returns a dictionary of arrays with
+    one element per worker (in the order of arrays['WorkerIds']):
+        'assignments', 'submitted', 'approved', 'rejected': counts;
+        'approval_rate': approved / ( approved + rejected ), or NaN;
+        'seconds_min', 'seconds_median', 'seconds_mean': time on task;
+        'agreement': the mean of the assignments' agreement;
+        'duplicate_fraction': the fraction of the worker's assignments
+            that duplicate another of theirs.
+    '''
+    
+    np = import_numpy()
+    
+    num_workers = len( arrays['WorkerIds'] )
+    worker = arrays['worker']
+    status = arrays['AssignmentStatus']
+    
+    def count( mask = None ):
+        return np.bincount( worker if mask is None else worker[ mask ], minlength = num_workers )
+    
+    def mean( values ):
+        valid = ~np.isnan( values )
+        with np.errstate( invalid = 'ignore' ):
+            return np.bincount( worker[ valid ], weights = values[ valid ], minlength = num_workers ) / count( valid )
+    
+    result = {
+        'assignments': count(),
+        'submitted': count( status == 'Submitted' ),
+        'approved': count( status == 'Approved' ),
+        'rejected': count( status == 'Rejected' )
+        }
+    with np.errstate( invalid = 'ignore' ):
+        result['approval_rate'] = result['approved'] / ( result['approved'] + result['rejected'] )
+    
+    ## Sort by worker, then time, to find each worker's minimum and median.
+    seconds = arrays['seconds']
+    valid = ~np.isnan( seconds )
+    order = np.lexsort( ( seconds[ valid ], worker[ valid ] ) )
+    sorted_seconds = seconds[ valid ][ order ]
+    num_timed = count( valid )
+    ## (Not a shifted cumsum, which would have one element with no workers.)
+    start = np.cumsum( num_timed ) - num_timed
+    timed_workers = num_timed > 0
+    result['seconds_min'] = np.full( num_workers, np.nan )
+    result['seconds_median'] = np.full( num_workers, np.nan )
+    result['seconds_min'][ timed_workers ] = sorted_seconds[ start[ timed_workers ] ]
+    result['seconds_median'][ timed_workers ] = ( sorted_seconds[ ( start + ( num_timed - 1 ) // 2 )[ timed_workers ] ] + sorted_seconds[ ( start + num_timed // 2 )[ timed_workers ] ] ) / 2
+    result['seconds_mean'] = mean( seconds )
+    
+    result['agreement'] = mean( statistics['agreement'] )
+    result['duplicate_fraction'] = count( statistics['duplicate'] ) / np.maximum( result['assignments'], 1 )
+    
+    return result
+
+## Column names for the output of analyze_assignments():
+analysis_review_fields = [ 'AssignmentId', 'decision', 'feedback', 'WorkerId', 'bonus', 'bonus_reason', 'HITId', 'seconds', 'agreement', 'duplicate' ]
+analysis_worker_fields = [ 'WorkerId', 'assignments', 'submitted', 'approved', 'rejected', 'approval_rate', 'seconds_min', 'seconds_median', 'seconds_mean', 'agreement', 'duplicate_fraction', 'reject_candidates' ]
+
+def analyze_assignments( rows, min_seconds = None, min_agreement = 0., max_duplicate_fraction = 1., reject = False ):
+    '''
+    Given an iterable of rows as taken by assignment_arrays(),
+    decides which Submitted assignments to approve or reject, and returns
+    ( review_rows, worker_rows ), lists of dictionaries with the columns
+    'analysis_review_fields' and 'analysis_worker_fields'.
+    The review rows can be written to a CSV for review_assignments_from_CSV().
+    
+    A Submitted assignment is a reject candidate if:
+        it took fewer than 'min_seconds' (by default, a tenth of the
+        median time of all the assignments);
+        it agreed with less than 'min_agreement' of the other assignments
+        of its HIT (by default 0, so this never rejects);
+        or it repeats answers its worker gave in another assignment,
+        and more than 'max_duplicate_fraction' of that worker's
+        assignments do (by default 1, so this never rejects, since
+        honest workers repeat themselves on tasks with few possible answers).
+    The other Submitted assignments are approved.
+    
+    Reject candidates are written with an empty decision and their reasons
+    as the feedback, so that review_assignments_from_CSV() leaves them alone
+    until someone fills in the decision, unless 'reject' is True, in which
+    case their decision is "reject".
+    '''
+    
+    np = import_numpy()
+    
+    arrays = assignment_arrays( rows )
+    statistics = assignment_statistics( arrays )
+    workers = worker_statistics( arrays, statistics )
+    
+    seconds = arrays['seconds']
+    if min_seconds is None:
+        min_seconds = 0.1 * np.nanmedian( seconds ) if np.any( ~np.isnan( seconds ) ) else 0.
+    
+    ## Comparisons with NaN are False, so missing values never reject.
+    speeding = seconds < min_seconds
+    disagreeing = statistics['agreement'] < min_agreement
+    duplicate = statistics['duplicate'] & ( workers['duplicate_fraction'][ arrays['worker'] ] > max_duplicate_fraction )
+    submitted = arrays['AssignmentStatus'] == 'Submitted'
+    reject_candidate = submitted & ( speeding | disagreeing | duplicate )
+    workers['reject_candidates'] = np.bincount( arrays['worker'][ reject_candidate ], minlength = len( arrays['WorkerIds'] ) )
+    
+    def text( values, format ):
+        ## Formats a whole array, with NaN as empty.
+        if values.dtype.kind == 'i': return values.astype( str ).tolist()
+        return np.where( np.isnan( values ), '', np.char.mod( format, values ) ).tolist()
+    
+    def column( values, indices ):
+        return values[ indices ].tolist()
+    
+    review_rows = []
+    indices = np.flatnonzero( submitted )
+    columns = [
+        column( arrays['AssignmentId'], indices ),
+        column( np.where( reject_candidate, 'reject' if reject else '', 'approve' ), indices ),
+        column( arrays['WorkerIds'][ arrays['worker'] ], indices ),
+        column( arrays['HITIds'][ arrays['HIT'] ], indices ),
+        text( seconds[ indices ], '%.1f' ),
+        text( statistics['agreement'][ indices ], '%.3f' ),
+        column( np.where( statistics['duplicate'], 'yes', '' ), indices )
+        ]
+    for i, AssignmentId, decision, WorkerId, HITId, seconds_text, agreement_text, duplicate_text in zip( indices, *columns ):
+        reasons = []
+        if reject_candidate[i]:
+            if speeding[i]: reasons.append( 'Submitted in %d seconds.' % seconds[i] )
+            if disagreeing[i]: reasons.append( 'Answers agreed with %d%% of other workers.' % ( 100 * statistics['agreement'][i] ) )
+            if duplicate[i]: reasons.append( 'Answers are identical to those of another HIT.' )
+        review_rows.append({
+            'AssignmentId': AssignmentId,
+            'decision': decision,
+            'feedback': ' '.join( reasons ),
+            'WorkerId': WorkerId,
+            'bonus': '',
+            'bonus_reason': '',
+            'HITId': HITId,
+            'seconds': seconds_text,
+            'agreement': agreement_text,
+            'duplicate': duplicate_text
+            })
+    
+    worker_columns = [ arrays['WorkerIds'].tolist() ] + [ text( workers[ field ], '%.3f' ) for field in analysis_worker_fields[1:] ]
+    worker_rows = [ dict( zip( analysis_worker_fields, values ) ) for values in zip( *worker_columns ) ]
+    
+    return review_rows, worker_rows
+
+class AssignmentStore:
+    '''
+    A local SQLite database of parsed assignments, keyed by AssignmentId.
+    
+    Each assignment is stored as the row assignment2row() returns for it.
+    An assignment is only parsed again when it is new or
+    its AssignmentStatus has changed since it was stored.
+    
+    NOTE: MTurk has no way to list only the assignments that changed,
+          so every retrieval still downloads all of them.
+          The store saves parsing them and rewriting them.
+    '''
+    
+    def __init__( self, path ):
+        import sqlite3, threading
+        
+        ## The connection is shared by the threads of imap_concurrently(),
+        ## so serialize access with our own lock.
+        self.db = sqlite3.connect( path, check_same_thread = False )
+        self.lock = threading.Lock()
+        
+        with self.lock, self.db:
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS assignments ( AssignmentId TEXT PRIMARY KEY, HITId TEXT, AssignmentStatus TEXT, row TEXT )' )
+            self.db.execute( 'CREATE INDEX IF NOT EXISTS assignments_HITId ON assignments ( HITId )' )
+    
+    def close( self ):
+        self.db.close()
+    
+    def __enter__( self ):
+        return self
+    
+    def __exit__( self, *args ):
+        self.close()
+    
+    def update( self, assignments ):
+        '''
+        Given a sequence of boto3 Assignment dictionaries,
+        saves the new or status-changed ones and
+        returns a tuple ( rows, changed ), where 'rows' are the rows for all
+        of them, in order, and 'changed' is the set of AssignmentIds of
+        the new or changed ones.
+        '''
+        
+        import json
+        
+        assignments = list( assignments )
+        
+        ## Load what we know about these assignments,
+        ## in chunks below SQLite's limit on query parameters.
+        known = {}
+        AssignmentIds = [ a['AssignmentId'] for a in assignments ]
+        with self.lock:
+            for start in range( 0, len( AssignmentIds ), 500 ):
+                chunk = AssignmentIds[ start : start + 500 ]
+                for AssignmentId, AssignmentStatus, row in self.db.execute( 'SELECT AssignmentId, AssignmentStatus, row FROM assignments WHERE AssignmentId IN ( %s )' % ','.join( '?' * len( chunk ) ), chunk ):
+                    known[ AssignmentId ] = ( AssignmentStatus, row )
+        
+        rows = []
+        changed = []
+        for a in assignments:
+            AssignmentStatus, row = known.get( a['AssignmentId'], ( None, None ) )
+            if AssignmentStatus == a['AssignmentStatus']:
+                rows.append( json.loads( row ) )
+            else:
+                row = assignment2row( a )
+                rows.append( row )
+                ## Dates are stored as the strings they would be in the CSV.
+                changed.append( ( a['AssignmentId'], a['HITId'], a['AssignmentStatus'], json.dumps( row, default = str ) ) )
+        
+        changed_AssignmentIds = set([ AssignmentId for AssignmentId, HITId, AssignmentStatus, row in changed ])
+        with self.lock, self.db:
+            self.db.executemany( 'INSERT OR REPLACE INTO assignments ( AssignmentId, HITId, AssignmentStatus, row ) VALUES ( ?, ?, ?, ? )', changed )
+        
+        return rows, changed_AssignmentIds
+    
+    def rows( self, HITIds = None ):
+        '''
+        Returns the stored rows for the given sequence of HITIds,
+        or for all HITs if 'HITIds' is None.
+        '''
+        
+        import json
+        
+        with self.lock:
+            if HITIds is None:
+                return [ json.loads( row ) for ( row, ) in self.db.execute( 'SELECT row FROM assignments ORDER BY rowid' ) ]
+            
+            result = []
+            for HITId in HITIds:
+                result.extend([ json.loads( row ) for ( row, ) in self.db.execute( 'SELECT row FROM assignments WHERE HITId = ? ORDER BY rowid', ( HITId, ) ) ])
+            return result
+    
+    def CSV( self, HITIds = None ):
+        '''
+        Returns a string of CSV data for the stored assignments of the
+        given sequence of HITIds, or of all HITs if 'HITIds' is None.
+        '''
+        return assignment_rows2CSV( self.rows( HITIds ) )
+
+def HIT_inventory_path( sandbox = True ):
+    '''
+    Returns the default path of the HITInventory for the sandbox
+    or the real marketplace.
+    A custom endpoint (see create_mturk()) gets its own inventory.
+    '''
+    
+    import os, hashlib
+    
+    endpoint_url = custom_endpoint_url()
+    if endpoint_url is not None:
+        return os.path.expanduser( '~/.mturk.py.hits.%s.sqlite' % hashlib.sha1( endpoint_url.encode( 'utf-8' ) ).hexdigest()[:12] )
+    
+    return os.path.expanduser( '~/.mturk.py.hits.sandbox.sqlite' if sandbox else '~/.mturk.py.hits.sqlite' )
+
+class HITInventory:
+    '''
+    A local SQLite copy of the account's HITs, as returned by list_hits(),
+    indexed by HITId, HITTypeId, RequesterAnnotation, HITStatus,
+    and CreationTime, so that HITs can be selected and looked up
+    without a get_hit() call for each one.
+    
+    sync() brings it up to date with one paginated list_hits() scan,
+    only rewriting the HITs that changed, and forgetting deleted HITs.
+    add() records HITs as they are created.
+    
+    NOTE: list_hits() can't list only the HITs that changed since
+          the last sync, so each sync still lists all of them.
+    '''
+    
+    ## The conditions select() understands, and their SQL.
+    conditions = {
+        'HITTypeId': 'HITTypeId = ?',
+        'HITStatus': 'HITStatus = ?',
+        'RequesterAnnotation': 'RequesterAnnotation = ?',
+        'CreatedAfter': 'CreationTime >= ?',
+        'CreatedBefore': 'CreationTime < ?'
+        }
+    
+    def __init__( self, path ):
+        import sqlite3, threading
+        
+        self.db = sqlite3.connect( path, check_same_thread = False )
+        self.lock = threading.Lock()
+        
+        with self.lock, self.db:
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS hits ( HITId TEXT PRIMARY KEY, HITTypeId TEXT, RequesterAnnotation TEXT, HITStatus TEXT, CreationTime TEXT, summary TEXT, hit TEXT )' )
+            for column in ( 'HITTypeId', 'RequesterAnnotation', 'HITStatus', 'CreationTime' ):
+                self.db.execute( 'CREATE INDEX IF NOT EXISTS hits_%s ON hits ( %s )' % ( column, column ) )
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS meta ( key TEXT PRIMARY KEY, value TEXT )' )
+    
+    def close( self ):
+        self.db.close()
+    
+    def __enter__( self ):
+        return self
+    
+    def __exit__( self, *args ):
+        self.close()
+    
+    def _record( self, hit ):
+        import json, datetime
+        
+        CreationTime = hit.get( 'CreationTime' )
+        ## Store times in UTC, so that they compare as strings.
+        if isinstance( CreationTime, datetime.datetime ):
+            if CreationTime.tzinfo is not None: CreationTime = CreationTime.astimezone( datetime.timezone.utc ).replace( tzinfo = None )
+            CreationTime = CreationTime.isoformat()
+        
+        summary = json.dumps([ hit.get( field ) for field in ( 'HITStatus', 'HITReviewStatus', 'MaxAssignments', 'NumberOfAssignmentsPending', 'NumberOfAssignmentsAvailable', 'NumberOfAssignmentsCompleted', 'Expiration' ) ], default = str )
+        ## Dates are stored as the strings they would be in the CSV.
+        return ( hit['HITId'], hit.get( 'HITTypeId' ), hit.get( 'RequesterAnnotation', '' ), hit.get( 'HITStatus' ), CreationTime, summary, json.dumps( hit, default = str ) )
+    
+    def add( self, hits ):
+        '''
+        Records the given sequence of boto3 HIT dictionaries.
+        '''
+        
+        with self.lock, self.db:
+            self.db.executemany( 'INSERT OR REPLACE INTO hits VALUES ( ?, ?, ?, ?, ?, ?, ? )', [ self._record( hit ) for hit in hits ] )
+    
+    def sync( self, mturk ):
+        '''
+        Updates the inventory from list_hits().
+        '''
+        
+        import time, sys
+        
+        with self.lock:
+            known = dict( self.db.execute( 'SELECT HITId, summary FROM hits' ) )
+        
+        changed = []
+        seen = set()
+        for hit in iter_all_HITs( mturk ):
+            record = self._record( hit )
+            seen.add( hit['HITId'] )
+            if known.get( hit['HITId'] ) != record[5]: changed.append( record )
+        gone = [ ( HITId, ) for HITId in known if HITId not in seen ]
+        
+        with self.lock, self.db:
+            self.db.executemany( 'INSERT OR REPLACE INTO hits VALUES ( ?, ?, ?, ?, ?, ?, ? )', changed )
+            self.db.executemany( 'DELETE FROM hits WHERE HITId = ?', gone )
+            self.db.execute( 'INSERT OR REPLACE INTO meta VALUES ( ?, ? )', ( 'last_sync', repr( time.time() ) ) )
+        
+        print('[HITInventory.sync(): %d HITs, %d new or changed, %d gone]' % ( len( seen ), len( changed ), len( gone ) ), file=sys.stderr)
+    
+    def age( self ):
+        '''
+        Returns the number of seconds since the last sync(),
+        or infinity if there hasn't been one.
+        '''
+        
+        import time
+        
+        with self.lock:
+            row = self.db.execute( 'SELECT value FROM meta WHERE key = ?', ( 'last_sync', ) ).fetchone()
+        return float('inf') if row is None else time.time() - float( row[0] )
+    
+    def select( self, **conditions ):
+        '''
+        Returns the HITIds of the HITs matching all of the given conditions,
+        in order of creation.
+        The conditions are HITTypeId, HITStatus, RequesterAnnotation,
+        CreatedAfter, and CreatedBefore (UTC ISO 8601 times, e.g. "2024-05-01"
+        or "2024-05-01T12:00:00").
+        '''
+        
+        assert all([ key in self.conditions for key in conditions ])
+        
+        where = ' AND '.join([ self.conditions[ key ] for key in sorted( conditions ) ]) or '1'
+        with self.lock:
+            return [ HITId for ( HITId, ) in self.db.execute( 'SELECT HITId FROM hits WHERE %s ORDER BY CreationTime, HITId' % where, [ conditions[ key ] for key in sorted( conditions ) ] ) ]
+    
+    def hits( self, HITIds ):
+        '''
+        Returns a dictionary mapping each of the given HITIds that is in
+        the inventory to its HIT dictionary (with dates as strings).
+        '''
+        
+        import json
+        
+        HITIds = list( HITIds )
+        result = {}
+        with self.lock:
+            for start in range( 0, len( HITIds ), 500 ):
+                chunk = HITIds[ start : start + 500 ]
+                for HITId, hit in self.db.execute( 'SELECT HITId, hit FROM hits WHERE HITId IN ( %s )' % ','.join( '?' * len( chunk ) ), chunk ):
+                    result[ HITId ] = json.loads( hit )
+        return result
+
+def make_persist_stage( store ):
+    '''
+    Returns a watch_HITs() pipeline stage that saves assignments to the
+    AssignmentStore 'store' and passes on only the new or changed ones.
+    '''
+    
+    def persist( mturk, HITId, assignments ):
+        rows, changed = store.update( assignments )
+        print('[AssignmentStore.update( %s ): %d new or changed assignments]' % ( HITId, len( changed ) ))
+        return [ a for a in assignments if a['AssignmentId'] in changed ]
+    
+    return persist
+
+def make_auto_approve_stage( rule ):
+    '''
+    Returns a watch_HITs() pipeline stage that approves each Submitted
+    assignment for which 'rule( row )' is true, where 'row' is the
+    assignment as returned by assignment2row().
+    The approved assignments are marked Approved, so that stages after
+    this one see them that way.
+    '''
+    
+    from datetime import timezone
+    
+    def auto_approve( mturk, HITId, assignments ):
+        for a in assignments:
+            if a['AssignmentStatus'] == 'Submitted' and rule( assignment2row( a ) ):
+                print('[auto-approve( %s )]' % ( a['AssignmentId'], ))
+                mturk.approve_assignment( AssignmentId = a['AssignmentId'] )
+                a['AssignmentStatus'] = 'Approved'
+                a['ApprovalTime'] = datetime.now( timezone.utc )
+        return assignments
+    
+    return auto_approve
+
+def min_seconds_rule( min_seconds ):
+    '''
+    Returns a rule for make_auto_approve_stage() that is true for
+    assignments submitted at least 'min_seconds' after they were accepted.
+    '''
+    
+    def rule( row ):
+        return ( row['SubmitTime'] - row['AcceptTime'] ).total_seconds() >= min_seconds
+    
+    return rule
+
+def is_missing_HIT_error( e ):
+    '''
+    Returns whether the exception 'e' is MTurk saying that a HIT doesn't exist.
+    '''
+    
+    import botocore.exceptions
+    
+    if not isinstance( e, botocore.exceptions.ClientError ): return False
+    
+    error = e.response.get( 'Error', {} )
+    return error.get( 'Code' ) == 'RequestError' and 'does not exist' in error.get( 'Message', '' )
+
+def make_export_stage( store, output_dir ):
+    '''
+    Returns a watch_HITs() pipeline stage that rewrites the HIT's
+    "results-HITId.csv" in 'output_dir' from the AssignmentStore 'store',
+    like the "retrieve_each" command does.
+    '''
+    
+    import os
+    
+    def export( mturk, HITId, assignments ):
+        csv_path = os.path.join( output_dir, 'results-%s.csv' % HITId )
+        rows = store.rows( [ HITId ] )
+        with open( csv_path + '.partial', 'w' ) as f:
+            write_assignment_rows_CSV( rows, f )
+        os.replace( csv_path + '.partial', csv_path )
+        with open( csv_path + '.meta', 'w' ) as f:
+            print('[get_all_assignments_for_HITId( %s ): %d assignments]' % ( HITId, len( rows ) ), file=f)
+        return assignments
+    
+    return export
+
+def watch_HITs( mturk, HITIds, pipeline, min_interval = 30, max_interval = 600, backoff = 2, concurrency = DEFAULT_CONCURRENCY, until_done = True, partial = False, sweep_interval = 3600 ):
+    '''
+    Watches the given sequence of HITIds and runs their assignments through
+    'pipeline' whenever they change.
+    
+    'pipeline' is a sequence of stages, each a function
+    'stage( mturk, HITId, assignments )' that returns the assignments
+    to pass to the next stage, such as those returned by
+    make_persist_stage(), make_auto_approve_stage(), and make_export_stage().
+    
+    Each poll pages through list_reviewable_hits() (100 HITs per call,
+    for each HIT type of the watched HITs), and only fetches the
+    assignments of watched HITs that became Reviewable or whose assignment
+    counts changed. That costs a few calls per poll however many HITs are
+    watched, but a HIT's assignments are only seen once it is Reviewable,
+    that is, once all of them are submitted or the HIT expires.
+    If 'partial' is True, each poll also calls get_hit() for the watched
+    HITs that aren't Reviewable, so that their assignments go through the
+    pipeline as they are submitted, at the cost of one call per HIT.
+    Otherwise, those HITs are only checked with get_hit() on the first poll
+    and then every 'sweep_interval' seconds, to learn their HIT types
+    and to notice HITs that were deleted.
+    Polling starts every 'min_interval' seconds. Each poll that finds no
+    changes multiplies the interval by 'backoff', up to 'max_interval'.
+    A change resets it to 'min_interval'.
+    
+    If 'until_done' is True, returns once every HIT is Reviewable
+    (or gone) and has been through the pipeline.
+    '''
+    
+    import time, sys
+    
+    def summary( hit ):
+        return tuple([ hit.get( field ) for field in ( 'HITStatus', 'NumberOfAssignmentsPending', 'NumberOfAssignmentsAvailable', 'NumberOfAssignmentsCompleted' ) ])
+    
+    HITIds = list( dict.fromkeys( HITIds ) )
+    watched = set( HITIds )
+    ## The last status and assignment counts seen for each HIT.
+    last_seen = {}
+    ## The HITTypeId of each HIT, once get_hit() has been called for it.
+    HIT_types = {}
+    ## HITs that are gone, and HITs that are Reviewable and
+    ## have been through the pipeline.
+    gone = set()
+    done_HITIds = set()
+    interval = min_interval
+    last_sweep = None
+    while True:
+        changed = []
+        reviewable = set()
+        ## Without 'until_done', Reviewable HITs are still watched,
+        ## in case they are extended.
+        polled = [ HITId for HITId in HITIds if HITId not in gone and not ( until_done and HITId in done_HITIds ) ]
+        
+        ## List by HIT type when all of them are known, since the account
+        ## may have many more Reviewable HITs than are watched.
+        if all([ HITId in HIT_types for HITId in polled ]):
+            HITTypeIds = sorted( set([ HIT_types[ HITId ] for HITId in polled ]) )
+        else:
+            HITTypeIds = [ None ]
+        listed = {}
+        try:
+            for HITTypeId in HITTypeIds:
+                for hit in iter_reviewable_HITs( mturk, HITTypeId ):
+                    if hit['HITId'] in watched: listed[ hit['HITId'] ] = hit
+        except Exception as e:
+            print('[watch_HITs(): list_reviewable_hits() failed: %s]' % ( e, ), file=sys.stderr)
+            listed = None
+        
+        ## get_hit() the HITs that list_reviewable_hits() can't speak for.
+        sweep = partial or listed is None or last_sweep is None or time.time() - last_sweep >= sweep_interval
+        if sweep and not partial and listed is not None: last_sweep = time.time()
+        got = [ HITId for HITId in polled if listed is None or ( HITId not in listed and ( sweep or HITId not in HIT_types ) ) ]
+        hits = [ listed[ HITId ] for HITId in polled if listed is not None and HITId in listed ]
+        for HITId, hit, error in imap_concurrently( lambda HITId: mturk.get_hit( HITId = HITId )['HIT'], got, max_workers = concurrency ):
+            if error is not None:
+                if is_missing_HIT_error( error ):
+                    gone.add( HITId )
+                else:
+                    print('[watch_HITs( %s ): get_hit() failed: %s]' % ( HITId, error ), file=sys.stderr)
+                continue
+            hits.append( hit )
+        
+        for hit in hits:
+            HIT_types[ hit['HITId'] ] = hit['HITTypeId']
+            if last_seen.get( hit['HITId'] ) != summary( hit ):
+                changed.append( hit['HITId'] )
+                last_seen[ hit['HITId'] ] = summary( hit )
+            if hit['HITStatus'] == 'Reviewable': reviewable.add( hit['HITId'] )
+        
+        num_processed = 0
+        for HITId, assignments, error in imap_concurrently( lambda HITId: list( iter_all_assignments_for_HITId( mturk, HITId ) ), changed, max_workers = concurrency ):
+            try:
+                if error is not None: raise error
+                for stage in pipeline:
+                    assignments = stage( mturk, HITId, assignments )
+                num_processed += 1
+            except Exception as e:
+                print('[watch_HITs( %s ) failed: %s]' % ( HITId, e ), file=sys.stderr)
+                ## Try again next time.
+                del last_seen[ HITId ]
+        
+        done_HITIds.update([ HITId for HITId in reviewable if HITId in last_seen ])
+        if until_done and len( done_HITIds | gone ) == len( HITIds ):
+            print('[watch_HITs(): all %d HITs are done]' % ( len( HITIds ), ))
+            return
+        
+        ## A HIT that keeps failing shouldn't keep the polling fast.
+        interval = min_interval if num_processed > 0 else min( interval * backoff, max_interval )
+        print('[watch_HITs(): %d of %d HITs changed; next poll in %d seconds]' % ( num_processed, len( HITIds ), interval ))
+        time.sleep( interval )
+
+def upload_filepaths_to_server(
+    filepaths, remote_host = None, remote_dir = None,
+    manifest_path = None, streams = 1, dry_run = False
+    ):
+    '''
+    Given an iterable collection of distinct file paths 'filepaths' and
+    a remote host 'remote_host' and remote directory 'remote_dir'
+    in which to store the files on the server,
+    uploads the files intelligently (doesn't re-upload if the
+    identical file is already on the 'remote_host' at 'remote_dir').
+    
+    A manifest of what was uploaded to each ( 'remote_host', 'remote_dir' ),
+    a SQLite file at 'manifest_path' (default "~/.mturk.py.uploads.sqlite"),
+    records each file's size, modification time, and SHA-1.
+    Files whose content matches the manifest are skipped without contacting
+    the server. (A file whose size and modification time match isn't even
+    hashed again.) If nothing changed, no connection is made at all.
+    The remote directory is only created the first time.
+    
+    The changed files are split into 'streams' groups of about equal size,
+    each uploaded by its own rsync. All ssh connections share one
+    ControlMaster connection.
+    
+    If 'dry_run' is True, only prints (and returns) what would be uploaded.
+    
+    Returns the list of file paths uploaded (or that would be).
+    '''
+    
+    import os, subprocess, hashlib, sqlite3, tempfile
+    
+    filepaths = list( set( filepaths ) )
+    if len( filepaths ) == 0:
         print('upload_filepaths_to_server() called with zero filepaths.')
-        return
+        return []
     
     ## A filepath shouldn't appear twice in the input list.
     assert len( set( filepaths ) ) == len( filepaths )
@@ -434,12 +3027,69 @@ def upload_filepaths_to_server(
     assert str( remote_host ) == remote_host
     assert str( remote_dir ) == remote_dir
     
+    assert streams >= 1
+    
+    if manifest_path is None: manifest_path = os.path.expanduser( '~/.mturk.py.uploads.sqlite' )
+    manifest = sqlite3.connect( manifest_path )
+    with manifest:
+        manifest.execute( 'CREATE TABLE IF NOT EXISTS uploads ( remote_host TEXT, remote_dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, sha1 TEXT, PRIMARY KEY ( remote_host, remote_dir, name ) )' )
+    
+    ## The files are stored on the server by name.
+    uploaded = dict([ ( name, ( size, mtime_ns, sha1 ) ) for name, size, mtime_ns, sha1 in manifest.execute( 'SELECT name, size, mtime_ns, sha1 FROM uploads WHERE remote_host = ? AND remote_dir = ?', ( remote_host, remote_dir ) ) ])
+    
+    def check( filepath ):
+        ## Returns the manifest entry for 'filepath' if it must be uploaded,
+        ## or if only its modification time changed; None otherwise.
+        stat = os.stat( filepath )
+        known = uploaded.get( os.path.basename( filepath ) )
+        if known is not None and known[:2] == ( stat.st_size, stat.st_mtime_ns ): return None
+        
+        sha1 = hashlib.sha1()
+        with open( filepath, 'rb' ) as f:
+            for chunk in iter( lambda: f.read( 1 << 20 ), b'' ): sha1.update( chunk )
+        return ( stat.st_size, stat.st_mtime_ns, sha1.hexdigest() )
+    
+    changed = []
+    touched = []
+    for filepath, entry, error in imap_concurrently( check, filepaths, max_workers = DEFAULT_CONCURRENCY ):
+        if error is not None: raise error
+        if entry is None: continue
+        known = uploaded.get( os.path.basename( filepath ) )
+        if known is not None and known[2] == entry[2]:
+            touched.append( ( filepath, entry ) )
+        else:
+            changed.append( ( filepath, entry ) )
+    
+    def record( files ):
+        with manifest:
+            manifest.executemany( 'INSERT OR REPLACE INTO uploads VALUES ( ?, ?, ?, ?, ?, ? )', [ ( remote_host, remote_dir, os.path.basename( filepath ) ) + entry for filepath, entry in files ] )
+    
+    num_bytes = sum([ entry[0] for filepath, entry in changed ])
+    print('[upload_filepaths_to_server(): %d of %d files changed (%d bytes)%s]' % ( len( changed ), len( filepaths ), num_bytes, ' (dry run)' if dry_run else '' ))
+    
+    if dry_run:
+        manifest.close()
+        return [ filepath for filepath, entry in changed ]
+    
+    ## Files with a new modification time but the same content.
+    record( touched )
+    
+    if len( changed ) == 0:
+        manifest.close()
+        return []
+    
+    ## Share one ssh connection between the mkdir and all the rsyncs.
+    os.makedirs( os.path.expanduser( '~/.ssh' ), mode = 0o700, exist_ok = True )
+    ssh_options = [ '-o', 'ControlMaster=auto', '-o', 'ControlPath=' + os.path.expanduser( '~/.ssh/mturk-py-%r@%h:%p' ), '-o', 'ControlPersist=60' ]
+    
     ## Create 'remote_dir' if it doesn't exist.
     ## UPDATE: Calling this often can introduce unnecessary pauses,
     ##         because chances are the directory exists.
-    print('[ssh "%s" mkdir -p "%s"]' % ( remote_host, remote_dir ))
-    err = subprocess.Popen( [ 'ssh', remote_host, 'mkdir', '-p', remote_dir ] ).wait()
-    assert 0 == err
+    ## UPDATE 2: Only if nothing was ever uploaded there.
+    if len( uploaded ) == 0:
+        print('[ssh "%s" mkdir -p "%s"]' % ( remote_host, remote_dir ))
+        err = subprocess.Popen( [ 'ssh' ] + ssh_options + [ remote_host, 'mkdir', '-p', remote_dir ] ).wait()
+        assert 0 == err
     
     ## Upload all the files together in the foreground.
     ## NOTE: I think the trailing "/" will cause scp
@@ -447,24 +3097,297 @@ def upload_filepaths_to_server(
     #print '[scp "%s" "%s"]' % ( filepaths, remote_host + ':' + remote_dir + '/' )
     #err = os.spawnvp( os.P_WAIT, 'scp', [ 'scp' ] + filepaths + [ remote_host + ':' + remote_dir + '/' ] )
     ## UPDATE: Better yet, use rsync.
-    print('[rsync "%s" "%s"]' % ( filepaths, remote_host + ':' + remote_dir + '/' ))
-    err = os.spawnvp( os.P_WAIT, 'rsync', [ 'rsync', '--progress' ] + filepaths + [ remote_host + ':' + remote_dir + '/' ] )
-    assert 0 == err
+    ## UPDATE 2: Split the files between 'streams' rsyncs, largest first
+    ##           into the group with the fewest bytes.
+    ##           The file lists are passed with --files-from, since there
+    ##           can be too many to pass as arguments.
+    groups = [ [] for i in range( min( streams, len( changed ) ) ) ]
+    group_bytes = [ 0 ] * len( groups )
+    for filepath, entry in sorted( changed, key = lambda file: -file[1][0] ):
+        i = group_bytes.index( min( group_bytes ) )
+        groups[i].append( ( filepath, entry ) )
+        group_bytes[i] += entry[0]
+    
+    processes = []
+    for group in groups:
+        files_from = tempfile.NamedTemporaryFile( 'w', suffix = '.txt' )
+        for filepath, entry in group:
+            files_from.write( os.path.abspath( filepath ) + '\n' )
+        files_from.flush()
+        
+        print('[rsync %d files (%d bytes) "%s"]' % ( len( group ), sum([ entry[0] for filepath, entry in group ]), remote_host + ':' + remote_dir + '/' ))
+        command = [ 'rsync', '--progress', '--no-relative', '--files-from=' + files_from.name, '-e', ' '.join( [ 'ssh' ] + ssh_options ), '/', remote_host + ':' + remote_dir + '/' ]
+        processes.append( ( subprocess.Popen( command ), files_from, group ) )
+    
+    failed = 0
+    for process, files_from, group in processes:
+        err = process.wait()
+        files_from.close()
+        ## Remember the groups that made it, even if another failed.
+        if 0 == err: record( group )
+        else: failed += 1
+    
+    manifest.close()
+    assert 0 == failed
+    
+    return [ filepath for filepath, entry in changed ]
+
+def parse_batch_line( line ):
+    '''
+    Parses one line of input to the "batch" command.
+    A line is a JSON array [ "command", "arg", ... ],
+    a JSON object { "command": "command", "args": [ "arg", ... ], "id": ... }
+    (where "id" is optional and copied to the result),
+    or a shell-style line: command arg "arg with spaces" ...
+    Returns ( command, args, id ), or None for a blank or comment line.
+    '''
+    
+    import json, shlex
+    
+    line = line.strip()
+    if len( line ) == 0 or line.startswith( '#' ): return None
+    
+    if line.startswith( '[' ):
+        words = json.loads( line )
+        return ( words[0], [ str( arg ) for arg in words[1:] ], None )
+    elif line.startswith( '{' ):
+        obj = json.loads( line )
+        return ( obj['command'], [ str( arg ) for arg in obj.get( 'args', [] ) ], obj.get( 'id' ) )
+    else:
+        words = shlex.split( line )
+        return ( words[0], words[1:], None )
 
+## For each "batch" command, the positions of its arguments naming the
+## HIT or assignment it changes. Commands that share one of those run in order.
+## The other commands' arguments are all treated that way.
+batch_resource_args = { 'approve': [0], 'reject': [0], 'bonus': [1] }
 
-def main():
-    import sys, json
+## The commands a daemon runs: short ones that only read from MTurk.
+## Anything that spends money or runs for a long time runs in its own process.
+daemon_commands = ( 'info', 'retrieve', 'debug' )
+
+## The environment variables that choose the AWS account and settings.
+## A daemon only runs commands for callers whose values match its own.
+daemon_environment_variables = ( 'HOME', 'AWS_PROFILE', 'AWS_DEFAULT_PROFILE', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AWS_CONFIG_FILE', 'AWS_SHARED_CREDENTIALS_FILE', 'AWS_DEFAULT_REGION', 'AWS_REGION', 'MTURK_PY_ENDPOINT_URL' )
+
+def daemon_environment_fingerprint():
+    '''
+    Returns a hash of the environment variables that choose
+    the AWS account and settings, for comparing a caller's with a daemon's
+    without sending credentials over the socket.
+    '''
+    
+    import os, json, hashlib
+    
+    return hashlib.sha256( json.dumps([ os.environ.get( name ) for name in daemon_environment_variables ]).encode( 'utf-8' ) ).hexdigest()
+
+def daemon_command( argv ):
+    '''
+    Returns whether the command-line arguments 'argv' are a command that
+    a daemon may run: one of 'daemon_commands', optionally after "really",
+    with no other options.
+    '''
+    
+    argv = list( argv )
+    if len( argv ) > 0 and argv[0] == 'really': del argv[0]
+    return len( argv ) > 0 and argv[0] in daemon_commands and '-' not in argv
+
+def daemon_socket_path():
+    '''
+    Returns the path of the daemon's Unix socket: $MTURK_PY_SOCKET if set,
+    otherwise "~/.mturk.py.sock".
+    An empty path means not to use a daemon.
+    '''
+    
+    import os
+    
+    return os.environ.get( 'MTURK_PY_SOCKET', os.path.expanduser( '~/.mturk.py.sock' ) )
+
+class DaemonOutput:
+    '''
+    A file-like object that sends what is written to it over a daemon
+    connection as JSON lines { name: text }, via the function 'send'.
+    '''
+    
+    def __init__( self, send, name ):
+        self.send = send
+        self.name = name
+    
+    def write( self, text ):
+        if len( text ) > 0: self.send( **{ self.name: text } )
+        return len( text )
+    
+    def flush( self ):
+        pass
+
+def serve_daemon( socket_path ):
+    '''
+    Runs a daemon listening on the Unix socket 'socket_path' that
+    runs commands for forward_to_daemon(), so that each command
+    doesn't pay to import boto3 and create a client.
+    
+    The daemon keeps sandbox and real clients (and their HTTPS connections)
+    alive between commands.
+    Commands run one at a time, in the client's working directory,
+    with their output sent back as it is printed.
+    
+    Only the read-only commands in 'daemon_commands' are run.
+    The daemon uses its own AWS credentials, so it refuses callers whose
+    AWS environment variables (see daemon_environment_fingerprint())
+    differ from its own. A refused caller runs the command itself.
+    If the caller disconnects, the command finishes without its output.
+    '''
+    
+    import os, sys, json, socket, socketserver, threading, traceback, contextlib
+    
+    ## Clients for run_command(), shared by all commands.
+    clients = {}
+    for sandbox in ( True, False ):
+        clients[ ( sandbox, None, False ) ] = create_mturk( sandbox = sandbox )
+    
+    command_lock = threading.Lock()
+    environment = daemon_environment_fingerprint()
+    
+    class Handler( socketserver.StreamRequestHandler ):
+        def handle( self ):
+            request = json.loads( self.rfile.readline() )
+            
+            send_lock = threading.Lock()
+            disconnected = []
+            def send( **message ):
+                with send_lock:
+                    if len( disconnected ) > 0: return
+                    try:
+                        self.wfile.write( ( json.dumps( message ) + '\n' ).encode( 'utf-8' ) )
+                        self.wfile.flush()
+                    except OSError:
+                        ## Don't interrupt the command; just stop sending.
+                        disconnected.append( True )
+            
+            if request.get( 'environment' ) != environment:
+                send( refused = 'the daemon has a different AWS environment' )
+                return
+            if not daemon_command( request['argv'] ):
+                send( refused = 'the daemon only runs %s' % ', '.join( daemon_commands ) )
+                return
+            
+            ## Commands change process-wide state like sys.stdout and
+            ## the working directory, so run them one at a time.
+            with command_lock:
+                cwd = os.getcwd()
+                try:
+                    os.chdir( request['cwd'] )
+                    with contextlib.redirect_stdout( DaemonOutput( send, 'stdout' ) ), contextlib.redirect_stderr( DaemonOutput( send, 'stderr' ) ):
+                        try:
+                            run_command( request['argv'], clients = clients )
+                            exit_code = 0
+                        except SystemExit as e:
+                            exit_code = e.code if isinstance( e.code, int ) else ( 0 if e.code is None else 1 )
+                        except Exception:
+                            traceback.print_exc()
+                            exit_code = 1
+                finally:
+                    os.chdir( cwd )
+            
+            send( exit = exit_code )
+    
+    ## A socket left behind by a daemon that died is in the way.
+    if os.path.exists( socket_path ):
+        probe = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        try:
+            probe.connect( socket_path )
+            raise RuntimeError( 'A daemon is already listening on ' + socket_path )
+        except ( ConnectionRefusedError, FileNotFoundError ):
+            os.remove( socket_path )
+        finally:
+            probe.close()
+    
+    ## The daemon only runs the read-only daemon_commands, but it does so with
+    ## its own AWS credentials and returns account data, so only the user may connect.
+    old_umask = os.umask( 0o077 )
+    try:
+        server = socketserver.ThreadingUnixStreamServer( socket_path, Handler )
+    finally:
+        os.umask( old_umask )
+    
+    print('[serve_daemon( %s ): listening]' % ( socket_path, ))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove( socket_path )
+        print('[serve_daemon( %s ): stopped]' % ( socket_path, ))
+
+def forward_to_daemon( argv, socket_path ):
+    '''
+    Runs the command-line arguments 'argv' in the daemon listening on
+    'socket_path', if there is one, printing its output.
+    Returns the command's exit code, or None if no daemon is listening
+    or it refused the command (see serve_daemon()).
+    '''
+    
+    import os, sys, json, socket
+    
+    if len( socket_path ) == 0 or not os.path.exists( socket_path ): return None
+    
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    try:
+        sock.connect( socket_path )
+    except OSError:
+        sock.close()
+        return None
+    
+    with sock, sock.makefile( 'rwb' ) as f:
+        f.write( ( json.dumps( { 'argv': list( argv ), 'cwd': os.getcwd(), 'environment': daemon_environment_fingerprint() } ) + '\n' ).encode( 'utf-8' ) )
+        f.flush()
+        
+        for line in f:
+            message = json.loads( line )
+            if 'refused' in message:
+                print('[forward_to_daemon( %s ): refused: %s; running it here]' % ( socket_path, message['refused'] ), file=sys.stderr)
+                return None
+            elif 'stdout' in message:
+                sys.stdout.write( message['stdout'] )
+            elif 'stderr' in message:
+                sys.stderr.write( message['stderr'] )
+            elif 'exit' in message:
+                return message['exit']
+    
+    print('[forward_to_daemon( %s ): the daemon hung up]' % ( socket_path, ), file=sys.stderr)
+    return 1
+
+def run_command( argv, clients = None ):
+    '''
+    Runs the command described by the command-line arguments 'argv'
+    (not including the program name).
+    
+    If the dictionary 'clients' is given, clients are reused from it
+    and new ones added to it.
+    '''
+    
+    import sys, json, threading
     
     def usage():
-        print('Usage:', sys.argv[0], '[really] submit path/to/job.json', file=sys.stderr)
-        print('Usage:', sys.argv[0], '[really] info HITId', file=sys.stderr)
-        print('Usage:', sys.argv[0], '[really] retrieve HITId', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] submit path/to/job.json [concurrency] [resume]', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] info HITId|path/to/HITIds.txt|Field=value [...]', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] retrieve HITId|path/to/submit.txt [HITId|path/to/submit.txt ...]', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] retrieve_each path/to/output_dir HITId|path/to/submit.txt [HITId|path/to/submit.txt ...]', file=sys.stderr)
         print('Usage:', sys.argv[0], '[really] approve AssignmentId [feedback]', file=sys.stderr)
         print('Usage:', sys.argv[0], '[really] reject AssignmentId [feedback]', file=sys.stderr)
         print('Usage:', sys.argv[0], '[really] bonus WorkerId AssignmentId dollars feedback', file=sys.stderr)
-        print('Usage:', sys.argv[0], '[really] extend HITId number-of-additional-assignments', file=sys.stderr)
-        print('Usage:', sys.argv[0], '[really] expire HITId', file=sys.stderr)
-        print('Usage:', sys.argv[0], '[really] remove HITId', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] review path/to/reviewed.csv [concurrency]', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] analyze path/to/review.csv [min_seconds=S] [min_agreement=A] [max_duplicate_fraction=D] [reject=yes] HITId|path/to/HITIds.txt|Field=value|path/to/results.csv [...]', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] watch path/to/output_dir [auto_approve=S] [partial] HITId|path/to/HITIds.txt|Field=value [...]', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] extend HITId|path/to/HITIds.txt|Field=value [...] number-of-additional-assignments', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] expire HITId|path/to/HITIds.txt|Field=value [...]', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] sync', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] export assignments|HITs path/to/output.csv|.jsonl|.parquet|.arrow HITId|path/to/HITIds.txt|Field=value [...]', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] remove HITId|path/to/HITIds.txt|Field=value [...]', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] remove_wait minutes HITId|path/to/HITIds.txt|Field=value [...]', file=sys.stderr)
+        print('Usage:', sys.argv[0], '[really] batch path/to/commands.txt|- [concurrency] [stop_on_error]', file=sys.stderr)
+        print('Usage:', sys.argv[0], 'serve [path/to/socket]', file=sys.stderr)
         ## TODO:
         #print >> sys.stderr, 'Usage:', sys.argv[0], 'extend HITId additional_assignments ?additional_time?'
         
@@ -492,16 +3415,68 @@ def main():
         "lifetime": 604800,
         "approval_delay": 0
         },
-    "URLs": [ "http://example.com/page.html" ]
+    "URLs": [ "http://example.com/page.html" ],
+    "concurrency": 1
 }''', file=sys.stderr)
         
         print('Note: Commands run in the sandbox unless "really" is present.', file=sys.stderr)
+        print('Note: "info" and "retrieve" write CSV to stdout and their status lines to stderr, so "retrieve HITId > results.csv" saves just the CSV.  "retrieve" fetches a few HITs at a time.  Up to 1000 assignments are held in memory to learn the question columns; beyond that, they are spooled to a temporary file and the CSV is written once every HIT has been fetched.', file=sys.stderr)
+        print('Note: Commands that act on many HITs or assignments do %d at a time.  Put "concurrency=N" before the command (after "really") to change that.' % DEFAULT_CONCURRENCY, file=sys.stderr)
+        print('Note: Put "metrics=path/to/metrics.json" before the command to save per-call counts, bytes, and latency histograms when it finishes (or on SIGUSR1).  A path ending in ".prom" is written in the Prometheus text format.  Put "log" before the command to log every request to stderr.', file=sys.stderr)
+        print('Note: Put "profile=path/to/report.txt" before the command to run it under cProfile and tracemalloc and write where the time and memory went to path/to/report.txt (and the raw cProfile statistics to path/to/report.txt.pstats).  Only the main thread\'s time is profiled, so use "concurrency=1" for the whole picture.', file=sys.stderr)
         print('Note: The "qualifications" field is optional.  The default is to have no qualifications.  Any qualification type supported by boto3 is allowed.', file=sys.stderr)
+        print('Note: "submit" records each HIT it creates in path/to/job.json.journal.  If it is interrupted, run it again with "resume" to create only the remaining HITs.  HITs the journal missed are found with list_hits() by URL and RequesterAnnotation.  MTurk also refuses to create the same HIT twice in a resumed job, but only for 24 hours.', file=sys.stderr)
+        print('Note: "submit" checks the balance against a ledger shared by all submissions (kept with the inventory), which fetches the live balance at most every 5 minutes and holds the cost of HITs being created, so that concurrent submissions can\'t spend the same money.', file=sys.stderr)
+        print('Note: "review" reads the columns AssignmentId, decision (approve, reject, or empty), feedback, WorkerId, bonus (dollars), and bonus_reason.  Completed actions are recorded in path/to/reviewed.csv.journal and skipped if "review" is run again.', file=sys.stderr)
+        print('Note: "analyze" reads the assignments of the given HITs (or the output of "retrieve" in path/to/results.csv) and writes path/to/review.csv for "review".  Status lines before the CSV header in path/to/results.csv are skipped.  Submitted assignments are reject candidates if they took less than min_seconds (default: a tenth of the median), agreed with less than min_agreement of the other answers to the same HIT (default 0), or repeat their worker\'s answers to another HIT when more than max_duplicate_fraction of that worker\'s assignments do (default 1).  Reject candidates get an empty decision, which "review" skips, and their reasons as the feedback; fill in the decision by hand, or pass reject=yes to write "reject".  The rest are approved.  Per-worker time on task, approval rate, agreement, and duplicates are written to path/to/review.workers.csv.  It needs numpy.', file=sys.stderr)
+        print('Note: "watch" polls until all HITs are Reviewable, writing results-HITId.csv files like "retrieve_each" whenever a HIT changes.  It polls more often while assignments are arriving and less often when idle.  Each poll lists the Reviewable HITs of the watched HITs\' HIT types, 100 per call, so a HIT\'s assignments are written once it is Reviewable (all of them submitted, or the HIT expired); get_hit() is only called for each watched HIT at the start and once an hour.  With partial, each poll also calls get_hit() for every watched HIT that isn\'t Reviewable, so that assignments are written as they are submitted, at the cost of one call per HIT per poll.  With auto_approve=S, it approves each new Submitted assignment that took at least S seconds (0 approves them all).', file=sys.stderr)
+        print('Note: Commands that take HITIds can also select HITs from a local inventory with Field=value, where Field is RequesterAnnotation, HITTypeId, HITStatus, CreatedAfter, or CreatedBefore (UTC, e.g. 2024-05-01T12:00:00).  Adjacent Field=value arguments must all match.  The inventory is updated from list_hits() when it is more than %d seconds old, or by "sync".  "info" also reads the HITs it selects from it instead of calling get_hit(), and says how old that information is.' % HIT_INVENTORY_MAX_AGE, file=sys.stderr)
+        print('Note: "export" writes the assignments or HITs in the format given by the extension.  JSONL has one object per line with decoded answers.  Parquet and Arrow (which need pyarrow) have typed times and one column per question id, and are written in batches.', file=sys.stderr)
+        print('Note: A path/to/HITIds.txt can be the saved output of "submit" or a file of only HITIds.  "remove_wait" keeps trying to remove expired HITs that are not yet Reviewable, once a minute, for up to the given number of minutes.', file=sys.stderr)
+        print('Note: "batch" runs one command per line of path/to/commands.txt (or stdin, for "-") with one client, and prints one JSON result per command with its status, exit_code, stdout, and stderr.  A line is a shell-style command line without the program name, a JSON array of words, or a JSON object with "command", "args", and an optional "id".  With a concurrency, commands run in parallel, except that commands on the same HIT or assignment run in order.  With "stop_on_error", commands after the first failure are skipped.', file=sys.stderr)
+        print('Note: "serve" runs a daemon that keeps clients for the sandbox and the real marketplace ready.  While it is running, the read-only commands %s (with no options other than "really") are sent to it instead of starting their own, one at a time.  Every other command, including anything that spends money or runs for a long time, runs in its own process.  The daemon uses its own AWS credentials, so it refuses (and the command runs in its own process) unless the caller\'s HOME and AWS_* environment variables match the daemon\'s.  The socket is $MTURK_PY_SOCKET or ~/.mturk.py.sock.  Set MTURK_PY_SOCKET to an empty string to never use a daemon.' % ', '.join([ '"%s"' % command for command in daemon_commands ]), file=sys.stderr)
+        print('Note: If $MTURK_PY_ENDPOINT_URL is set, commands talk to it instead of MTurk (e.g. extras/fake_mturk.py for testing), and never to a daemon.', file=sys.stderr)
+        print('Note: The "concurrency" field is optional.  It is the number of HITs to create in parallel.  The default is 1.  A concurrency passed on the command line takes precedence.', file=sys.stderr)
         
         sys.exit(-1)
     
+    ## Opened by inventory().
+    opened_inventory = []
+    ## The jobs of a "batch" share the inventory, so only one opens or syncs it.
+    inventory_lock = threading.Lock()
+    def inventory( max_age = HIT_INVENTORY_MAX_AGE ):
+        ## The HITInventory for this marketplace, synced if it's older than 'max_age'.
+        with inventory_lock:
+            if len( opened_inventory ) == 0:
+                opened_inventory.append( HITInventory( HIT_inventory_path( sandbox ) ) )
+            if opened_inventory[0].age() > max_age:
+                opened_inventory[0].sync( mturk )
+            return opened_inventory[0]
+    
+    def new_client( max_pool_connections = None ):
+        ## Clients with metrics installed record to them forever, so only
+        ## clients without metrics are shared.
+        if clients is None or active_metrics is not None:
+            return create_mturk( sandbox = sandbox, max_pool_connections = max_pool_connections, metrics = active_metrics, log = log )
+        
+        key = ( sandbox, max_pool_connections, log )
+        if key not in clients:
+            clients[ key ] = create_mturk( sandbox = sandbox, max_pool_connections = max_pool_connections, log = log )
+        return clients[ key ]
+    
+    def client_for_concurrency( concurrency ):
+        ## Size the connection pool to match the number of threads.
+        if concurrency <= max( default_concurrency, DEFAULT_CONCURRENCY ): return mturk
+        return new_client( max_pool_connections = concurrency )
+    
     def submit( argv ):
-        if len( argv ) != 1: usage()
+        if len( argv ) not in (1,2,3): usage()
+        
+        resume = False
+        if argv[-1] == 'resume':
+            resume = True
+            argv = argv[:-1]
+        if len( argv ) not in (1,2): usage()
         
         params_path = argv[0]
         params = json.load( open( params_path ) )
@@ -512,38 +3487,180 @@ def main():
         URLs = params['URLs']
         del params['URLs']
         
+        concurrency = params.pop( 'concurrency', 1 )
+        if len( argv ) == 2: concurrency = argv[1]
+        try:
+            concurrency = int( concurrency )
+        except ValueError: usage()
+        if concurrency < 1: usage()
+        
         if len( params ) > 0: usage()
         
-        create_HITs_for_external_URLs( mturk, URLs, **create_hit_kwargs )
+        client = client_for_concurrency( concurrency )
+        ## The ledger lives with the inventory, so that submissions share it.
+        with Journal( params_path + '.journal' ) as journal, BudgetLedger( client, path = HIT_inventory_path( sandbox ) ) as ledger:
+            HITs = create_HITs_for_external_URLs( client, URLs, concurrency = concurrency, ledger = ledger, journal = journal, resume = resume, **create_hit_kwargs )
+        
+        ## So that the new HITs can be selected right away.
+        ## (Resumed HITs only have a HITId, and were added when created.)
+        with HITInventory( HIT_inventory_path( sandbox ) ) as new_HITs:
+            new_HITs.add([ hit for hit in HITs if hit is not None and 'HITTypeId' in hit ])
+        
+        if None in HITs: sys.exit(1)
     
     def info( argv ):
-        if len( argv ) != 1: usage()
+        if len( argv ) < 1: usage()
         
-        HITId = argv[0]
+        selected_from_inventory = set()
+        HITIds = HITIds_from_argv( argv, selected_from_inventory )
         
-        print(HITIds2CSV( mturk, [ HITId ] ), end=' ')
+        ## The HITs selected from the inventory with Field=value are read
+        ## from it, since it was just synced to select them.
+        ## Explicit HITIds get up-to-date information from get_hit().
+        known = {}
+        if len( selected_from_inventory ) > 0:
+            known = inventory().hits([ HITId for HITId in HITIds if HITId in selected_from_inventory ])
+            print('[info: %d HITs from the inventory, as of %d seconds ago]' % ( len( known ), inventory().age() ), file=sys.stderr)
+        fetched = iter_HITIds2HITs( mturk, [ HITId for HITId in HITIds if HITId not in known ], concurrency = default_concurrency )
+        def HITs():
+            for HITId in HITIds:
+                yield known[ HITId ] if HITId in known else next( fetched )
+        
+        ## Write each row as soon as its HIT arrives.
+        write_HITs_CSV( HITs(), sys.stdout )
+    
+    def HITIds_from_argv( argv, selected_from_inventory = None ):
+        ## Each argument is a HITId, the path to the saved output of "submit",
+        ## the path to a file of HITIds, or a "Field=value" condition
+        ## (e.g. "RequesterAnnotation=...") selecting HITs from the inventory.
+        ## Adjacent conditions select the HITs matching all of them.
+        ## Anything else is an error, rather than a guess.
+        ## The HITIds selected from the inventory are added to the set
+        ## 'selected_from_inventory', if given.
+        import os, re
+        HITIds = []
+        conditions = {}
+        for arg in list( argv ) + [ None ]:
+            field = None if arg is None else arg.split( '=', 1 )[0]
+            if field in HITInventory.conditions and '=' in arg:
+                conditions[ field ] = arg[ len( field ) + 1: ]
+                continue
+            
+            if len( conditions ) > 0:
+                selected = inventory().select( **conditions )
+                HITIds.extend( selected )
+                if selected_from_inventory is not None: selected_from_inventory.update( selected )
+                conditions = {}
+            
+            if arg is None:
+                pass
+            elif os.path.isfile( arg ):
+                try:
+                    HITIds.extend( HITIds_from_file( arg ) )
+                except ValueError as e:
+                    print('[%s]' % ( e, ), file=sys.stderr)
+                    sys.exit(1)
+            elif re.fullmatch( HITId_pattern, arg ) is not None:
+                HITIds.append( arg )
+            else:
+                print('[%r is not a HITId, a file, or a Field=value condition]' % ( arg, ), file=sys.stderr)
+                sys.exit(1)
+        return HITIds
     
     def retrieve( argv ):
-        if len( argv ) != 1: usage()
+        if len( argv ) < 1: usage()
+        
+        HITIds = HITIds_from_argv( argv )
+        
+        ## One CSV with the assignments for all HITs. The status lines go to stderr.
+        ## With concurrency, fetch 'default_concurrency' HITs at a time
+        ## like "export assignments", so that only their assignments
+        ## are in memory (compactly) at once.
+        def assignments():
+            if default_concurrency == 1:
+                for HITId in HITIds:
+                    for a in iter_all_assignments_for_HITId( mturk, HITId, compact = True ): yield a
+                return
+            
+            for start in range( 0, len( HITIds ), default_concurrency ):
+                for HIT_assignments in get_all_assignments_for_HITIds( mturk, HITIds[ start : start + default_concurrency ], concurrency = default_concurrency, compact = True ):
+                    for a in HIT_assignments: yield a
+        
+        write_assignments_CSV( assignments(), sys.stdout )
+    
+    def retrieve_each( argv ):
+        if len( argv ) < 2: usage()
         
-        HITId = argv[0]
+        import os
         
-        assignments = get_all_assignments_for_HITId( mturk, HITId )
-        print(assignments2CSV( assignments ), end=' ')
+        output_dir = argv[0]
+        HITIds = HITIds_from_argv( argv[1:] )
+        
+        if not os.path.isdir( output_dir ): usage()
+        
+        ## Keep parsed assignments in the output directory,
+        ## so that only new or changed assignments are parsed next time.
+        store = AssignmentStore( os.path.join( output_dir, 'assignments.sqlite' ) )
+        
+        ## One CSV per HIT, named like "run-many.HOW" names them.
+        ## Each HIT's assignments are streamed straight to its file.
+        def retrieve_one( HITId ):
+            csv_path = os.path.join( output_dir, 'results-%s.csv' % HITId )
+            with open( csv_path + '.partial', 'w' ) as f:
+                count = write_assignments_CSV( iter_all_assignments_for_HITId( mturk, HITId ), f, store = store )
+            os.replace( csv_path + '.partial', csv_path )
+            
+            with open( csv_path + '.meta', 'w' ) as f:
+                print('[get_all_assignments_for_HITId( %s ): %d assignments]' % ( HITId, count ), file=f)
+        
+        failed = []
+        for HITId, result, error in imap_concurrently( retrieve_one, HITIds, max_workers = default_concurrency ):
+            if error is not None:
+                print('[retrieve( %s ) failed: %s]' % ( HITId, error ), file=sys.stderr)
+                failed.append( HITId )
+        
+        store.close()
+        
+        if len( failed ) > 0: sys.exit(1)
     
     def expire( argv ):
-        if len( argv ) != 1: usage()
+        if len( argv ) < 1: usage()
+        
+        HITIds = HITIds_from_argv( argv )
         
-        HITId = argv[0]
+        failed = []
+        ## Credit the unfilled assignments to the ledger "submit" shares.
+        with BudgetLedger( mturk, path = HIT_inventory_path( sandbox ) ) as ledger:
+            for HITId, result, error in imap_concurrently( lambda HITId: expire_HITId( mturk, HITId, ledger = ledger ), HITIds, max_workers = default_concurrency ):
+                if error is not None:
+                    print('[expire_HITId( %s ) failed: %s]' % ( HITId, error ), file=sys.stderr)
+                    failed.append( HITId )
+                else:
+                    print('[expire_HITId( %s ): %s]' % ( HITId, 'expired' if result else 'already expired' ))
         
-        expire_hit( mturk, HITId )
+        if len( failed ) > 0: sys.exit(1)
     
     def remove( argv ):
-        if len( argv ) != 1: usage()
+        if len( argv ) < 1: usage()
         
-        HITId = argv[0]
+        HITIds = HITIds_from_argv( argv )
         
-        remove_HITId( mturk, HITId )
+        with BudgetLedger( mturk, path = HIT_inventory_path( sandbox ) ) as ledger:
+            state = remove_HITIds( mturk, HITIds, concurrency = default_concurrency, ledger = ledger )
+        if not all([ s in ( 'removed', 'expired' ) for s in state.values() ]): sys.exit(1)
+    
+    def remove_wait( argv ):
+        if len( argv ) < 2: usage()
+        
+        try:
+            minutes = float( argv[0] )
+        except ValueError: usage()
+        
+        HITIds = HITIds_from_argv( argv[1:] )
+        
+        with BudgetLedger( mturk, path = HIT_inventory_path( sandbox ) ) as ledger:
+            state = remove_HITIds( mturk, HITIds, concurrency = default_concurrency, max_wait = 60*minutes, retry_interval = 60, ledger = ledger )
+        if not all([ s == 'removed' for s in state.values() ]): sys.exit(1)
     
     def approve( argv ):
         if len( argv ) not in (1,2): usage()
@@ -564,17 +3681,58 @@ def main():
         mturk.reject_assignment( AssignmentId = AssignmentId, RequesterFeedback = feedback )
     
     def extend( argv ):
-        if len( argv ) != 2: usage()
+        if len( argv ) < 2: usage()
         
-        HITId, number_of_additional_assignments = argv
+        number_of_additional_assignments = argv[-1]
         
         try:
             number_of_additional_assignments = int( number_of_additional_assignments )
         except ValueError: usage()
         if number_of_additional_assignments < 0: usage()
         
-        print('[extend_hit( %s, %d additional assignments )]' % ( HITId, number_of_additional_assignments ))
-        mturk.create_additional_assignments_for_hit( HITId = HITId, NumberOfAdditionalAssignments = number_of_additional_assignments )
+        HITIds = HITIds_from_argv( argv[:-1] )
+        
+        def extend_one( HITId ):
+            print('[extend_hit( %s, %d additional assignments )]' % ( HITId, number_of_additional_assignments ))
+            mturk.create_additional_assignments_for_hit( HITId = HITId, NumberOfAdditionalAssignments = number_of_additional_assignments )
+        
+        failed = []
+        for HITId, result, error in imap_concurrently( extend_one, HITIds, max_workers = default_concurrency ):
+            if error is not None:
+                print('[extend_hit( %s ) failed: %s]' % ( HITId, error ), file=sys.stderr)
+                failed.append( HITId )
+        
+        if len( failed ) > 0: sys.exit(1)
+    
+    def export( argv ):
+        if len( argv ) < 3 or argv[0] not in ( 'assignments', 'HITs' ): usage()
+        
+        import itertools
+        
+        kind, path = argv[0], argv[1]
+        try:
+            export_format( path )
+        except ValueError: usage()
+        
+        HITIds = HITIds_from_argv( argv[2:] )
+        
+        if kind == 'HITs':
+            count = export_HITs( iter_HITIds2HITs( mturk, HITIds, concurrency = default_concurrency ), path )
+        else:
+            ## Fetch 'default_concurrency' HITs at a time, so that only
+            ## their assignments are in memory at once.
+            def assignments():
+                for start in range( 0, len( HITIds ), default_concurrency ):
+                    for HIT_assignments in get_all_assignments_for_HITIds( mturk, HITIds[ start : start + default_concurrency ], concurrency = default_concurrency ):
+                        for a in HIT_assignments: yield a
+            count = export_assignments( assignments(), path )
+        
+        print('[export( %s ): %d %s]' % ( path, count, kind ))
+    
+    def sync( argv ):
+        if len( argv ) != 0: usage()
+        
+        inventory( max_age = 0 )
     
     def bonus( argv ):
         if len( argv ) != 4: usage()
@@ -582,11 +3740,220 @@ def main():
         WorkerId, AssignmentId, BonusAmount, Reason = argv
         mturk.send_bonus( WorkerId = WorkerId, AssignmentId = AssignmentId, BonusAmount = BonusAmount, Reason = Reason )
     
+    def review( argv ):
+        if len( argv ) not in (1,2): usage()
+        
+        csv_path = argv[0]
+        
+        concurrency = default_concurrency
+        if len( argv ) == 2:
+            try:
+                concurrency = int( argv[1] )
+            except ValueError: usage()
+            if concurrency < 1: usage()
+        
+        failures = review_assignments_from_CSV( client_for_concurrency( concurrency ), csv_path, concurrency = concurrency )
+        if len( failures ) > 0: sys.exit(1)
+    
+    def analyze( argv ):
+        if len( argv ) < 2: usage()
+        
+        import os, csv
+        
+        output_path = argv[0]
+        
+        options = {}
+        sources = []
+        for arg in argv[1:]:
+            name, _, value = arg.partition( '=' )
+            if name in ( 'min_seconds', 'min_agreement', 'max_duplicate_fraction' ):
+                try:
+                    options[ name ] = float( value )
+                except ValueError: usage()
+            elif name == 'reject':
+                if value not in ( 'yes', 'no' ): usage()
+                options[ name ] = ( value == 'yes' )
+            else:
+                sources.append( arg )
+        if len( sources ) == 0: usage()
+        
+        if all([ source.lower().endswith( '.csv' ) for source in sources ]):
+            import itertools
+            
+            def rows():
+                for source in sources:
+                    with open( source, newline = '' ) as f:
+                        ## Skip any status lines a `retrieve > results.csv` captured before the header.
+                        for line in f:
+                            if line.startswith( 'HITId,AssignmentId' ): break
+                        else:
+                            print( 'No CSV header starting with HITId,AssignmentId in:', source, file = sys.stderr )
+                            sys.exit(1)
+                        for row in csv.DictReader( itertools.chain( [ line ], f ) ): yield row
+            rows = rows()
+        else:
+            HITIds = HITIds_from_argv( sources )
+            rows = assignment_rows( a for HIT_assignments in get_all_assignments_for_HITIds( mturk, HITIds, concurrency = default_concurrency, compact = True ) for a in HIT_assignments )
+        
+        review_rows, worker_rows = analyze_assignments( rows, **options )
+        
+        workers_path = os.path.splitext( output_path )[0] + '.workers.csv'
+        for path, fields, out_rows in [ ( output_path, analysis_review_fields, review_rows ), ( workers_path, analysis_worker_fields, worker_rows ) ]:
+            with open( path, 'w', newline = '' ) as f:
+                dw = csv.DictWriter( f, fields, lineterminator = '\n' )
+                dw.writeheader()
+                dw.writerows( out_rows )
+        
+        num_approves = len([ row for row in review_rows if row['decision'] == 'approve' ])
+        print('[analyze( %s ): %d Submitted assignments from %d workers: %d approve, %d reject candidates%s]' % ( output_path, len( review_rows ), len( worker_rows ), num_approves, len( review_rows ) - num_approves, '' if options.get( 'reject' ) else ' left undecided' ))
+    
+    def watch( argv ):
+        if len( argv ) < 2: usage()
+        
+        import os
+        
+        output_dir = argv[0]
+        
+        auto_approve = None
+        partial = False
+        while len( argv ) > 1 and ( argv[1].startswith( 'auto_approve=' ) or argv[1] == 'partial' ):
+            if argv[1] == 'partial':
+                partial = True
+            else:
+                try:
+                    auto_approve = float( argv[1][ len( 'auto_approve=' ): ] )
+                except ValueError: usage()
+            argv = argv[:1] + argv[2:]
+        
+        if len( argv ) < 2: usage()
+        HITIds = HITIds_from_argv( argv[1:] )
+        
+        if not os.path.isdir( output_dir ): usage()
+        
+        with AssignmentStore( os.path.join( output_dir, 'assignments.sqlite' ) ) as store:
+            ## Approve before saving, so that the store and the CSV files
+            ## have the new statuses.
+            pipeline = [ make_persist_stage( store ), make_export_stage( store, output_dir ) ]
+            if auto_approve is not None: pipeline.insert( 0, make_auto_approve_stage( min_seconds_rule( auto_approve ) ) )
+            watch_HITs( mturk, HITIds, pipeline, concurrency = default_concurrency, partial = partial )
+    
+    def batch( argv ):
+        if len( argv ) not in (1,2,3): usage()
+        
+        import io, time, contextvars, threading, traceback
+        
+        path = argv[0]
+        concurrency = 1
+        stop_on_error = False
+        for arg in argv[1:]:
+            if arg == 'stop_on_error':
+                stop_on_error = True
+                continue
+            try:
+                concurrency = int( arg )
+            except ValueError: usage()
+            if concurrency < 1: usage()
+        
+        if path == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open( path ) as f: lines = f.readlines()
+        
+        jobs = []
+        for line in lines:
+            try:
+                parsed = parse_batch_line( line )
+            except ( ValueError, KeyError, IndexError ) as e:
+                print('[batch: unparseable line %r: %s]' % ( line, e ), file=sys.stderr)
+                sys.exit(1)
+            if parsed is not None: jobs.append( parsed )
+        
+        for command, args, job_id in jobs:
+            if command not in name2func or command == 'batch':
+                print('[batch: unknown command %r]' % ( command, ), file=sys.stderr)
+                sys.exit(1)
+        
+        ## Each command's output goes to its own buffers.
+        ## Output from anything else (there shouldn't be any) goes to stderr.
+        captured = contextvars.ContextVar( 'captured', default = None )
+        class CapturedOutput:
+            def __init__( self, index, fallback ):
+                self.index = index
+                self.fallback = fallback
+            def write( self, text ):
+                buffers = captured.get()
+                return ( self.fallback if buffers is None else buffers[ self.index ] ).write( text )
+            def flush( self ):
+                pass
+        
+        ## Which job last used each HIT or assignment.
+        last_user = {}
+        depends_on = []
+        for index, ( command, args, job_id ) in enumerate( jobs ):
+            positions = batch_resource_args.get( command, range( len( args ) ) )
+            resources = set([ args[i] for i in positions if i < len( args ) ])
+            depends_on.append( set([ last_user[ r ] for r in resources if r in last_user ]) )
+            for r in resources: last_user[ r ] = index
+        
+        done = [ threading.Event() for job in jobs ]
+        failed = threading.Event()
+        
+        def run_job( index ):
+            command, args, job_id = jobs[ index ]
+            result = { 'index': index, 'command': command, 'args': args }
+            if job_id is not None: result['id'] = job_id
+            
+            try:
+                for earlier in depends_on[ index ]:
+                    done[ earlier ].wait()
+                
+                if stop_on_error and failed.is_set():
+                    result['status'] = 'skipped'
+                    return result
+                
+                buffers = ( io.StringIO(), io.StringIO() )
+                captured.set( buffers )
+                start = time.time()
+                try:
+                    name2func[ command ]( list( args ) )
+                    exit_code = 0
+                except SystemExit as e:
+                    exit_code = e.code if isinstance( e.code, int ) else ( 0 if e.code is None else 1 )
+                except Exception:
+                    traceback.print_exc( file = buffers[1] )
+                    exit_code = 1
+                finally:
+                    captured.set( None )
+                
+                result['status'] = 'ok' if exit_code == 0 else 'error'
+                result['exit_code'] = exit_code
+                result['seconds'] = round( time.time() - start, 3 )
+                result['stdout'] = buffers[0].getvalue()
+                result['stderr'] = buffers[1].getvalue()
+                if exit_code != 0: failed.set()
+                return result
+            finally:
+                done[ index ].set()
+        
+        out = sys.stdout
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = CapturedOutput( 0, old_stderr ), CapturedOutput( 1, old_stderr )
+        try:
+            num_failed = 0
+            for index, result, error in imap_concurrently( run_job, range( len( jobs ) ), max_workers = concurrency ):
+                if error is not None: result = { 'index': index, 'status': 'error', 'stderr': str( error ) }
+                if result['status'] == 'error': num_failed += 1
+                print(json.dumps( result, default = str ), file=out)
+        finally:
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+        
+        print('[batch: %d commands, %d failed]' % ( len( jobs ), num_failed ), file=sys.stderr)
+        if num_failed > 0: sys.exit(1)
+    
     def debug( argv ):
         print('sandbox:', sandbox)
     
-    argv = list( sys.argv )
-    del argv[0]
+    argv = list( argv )
     
     if len( argv ) == 0: usage()
     
@@ -594,11 +3961,48 @@ def main():
     if 'really' == argv[0]:
         sandbox = False
         del argv[0]
-    mturk = create_mturk( sandbox = sandbox )
+    
+    default_concurrency = DEFAULT_CONCURRENCY
+    metrics_path = None
+    profile_path = None
+    log = False
+    while len( argv ) > 0:
+        if argv[0].startswith( 'concurrency=' ):
+            try:
+                default_concurrency = int( argv[0][ len( 'concurrency=' ): ] )
+            except ValueError: usage()
+            if default_concurrency < 1: usage()
+        elif argv[0].startswith( 'metrics=' ):
+            metrics_path = argv[0][ len( 'metrics=' ): ]
+            if len( metrics_path ) == 0: usage()
+        elif argv[0].startswith( 'profile=' ):
+            profile_path = argv[0][ len( 'profile=' ): ]
+            if len( profile_path ) == 0: usage()
+        elif argv[0] == 'log':
+            log = True
+        else:
+            break
+        del argv[0]
+    
+    global active_metrics
+    active_metrics = None
+    if metrics_path is not None:
+        active_metrics = Metrics()
+        ## Long-running commands like "watch" dump on request.
+        ## Only the main thread can set signal handlers (not the daemon's).
+        import signal, threading
+        if hasattr( signal, 'SIGUSR1' ) and threading.current_thread() is threading.main_thread():
+            ## The handler runs in the main thread, which may be holding
+            ## the metrics' lock, so dump in another thread.
+            metrics = active_metrics
+            signal.signal( signal.SIGUSR1, lambda signum, frame: metrics.dump_in_background( metrics_path ) )
+    
+    ## Size the connection pool to match the number of threads.
+    mturk = new_client( max_pool_connections = default_concurrency if default_concurrency > DEFAULT_CONCURRENCY else None )
     
     if len( argv ) == 0: usage()
     
-    commands = [ submit, info, retrieve, approve, reject, bonus, extend, expire, remove, debug ]
+    commands = [ submit, info, retrieve, retrieve_each, approve, reject, bonus, review, analyze, extend, expire, remove, remove_wait, watch, batch, export, sync, debug ]
     name2func = dict([ ( f.__name__, f ) for f in commands ])
     
     try:
@@ -606,6 +4010,36 @@ def main():
     except KeyError:
         usage()
     
-    func( argv[1:] )
+    try:
+        if profile_path is None:
+            func( argv[1:] )
+        else:
+            with profiled( profile_path ):
+                func( argv[1:] )
+    finally:
+        for opened in opened_inventory: opened.close()
+        if active_metrics is not None: active_metrics.dump( metrics_path )
+
+def main():
+    import sys
+    
+    argv = sys.argv[1:]
+    
+    if len( argv ) > 0 and argv[0] == 'serve':
+        if len( argv ) > 2:
+            print('Usage:', sys.argv[0], 'serve [path/to/socket]', file=sys.stderr)
+            sys.exit(-1)
+        serve_daemon( argv[1] if len( argv ) == 2 else daemon_socket_path() )
+        return
+    
+    ## Let a running daemon do it, if there is one and it's a short,
+    ## read-only command.
+    ## The daemon can't read our stdin, so commands reading "-" run here.
+    ## The daemon's clients don't know about a custom endpoint.
+    if daemon_command( argv ) and custom_endpoint_url() is None:
+        exit_code = forward_to_daemon( argv, daemon_socket_path() )
+        if exit_code is not None: sys.exit( exit_code )
+    
+    run_command( argv )
 
 if __name__ == '__main__': main()
@@ -0,0 +1,46 @@
+## Fixtures for testing mturk.py against extras/fake_mturk.py.
+## They need boto3 (and the analyze tests need numpy), but not MTurk.
+
+import os, sys, threading
+
+import pytest
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'extras' ) )
+
+@pytest.fixture
+def fake( monkeypatch, tmp_path ):
+    '''
+    A FakeMTurk account with $100 and two Submitted assignments per HIT,
+    served on a free port that mturk.py's clients are pointed at.
+    HOME is a temporary directory, so the caches and the inventory are too.
+    '''
+    
+    pytest.importorskip( 'boto3' )
+    
+    import mturk, fake_mturk
+    
+    account = fake_mturk.FakeMTurk( balance = 100, assignments_per_HIT = 2 )
+    server = fake_mturk.serve_fake_mturk( account )
+    threading.Thread( target = server.serve_forever, daemon = True ).start()
+    
+    monkeypatch.setenv( 'MTURK_PY_ENDPOINT_URL', 'http://127.0.0.1:%d' % server.server_address[1] )
+    monkeypatch.setenv( 'MTURK_PY_SOCKET', '' )
+    monkeypatch.setenv( 'AWS_ACCESS_KEY_ID', 'test' )
+    monkeypatch.setenv( 'AWS_SECRET_ACCESS_KEY', 'test' )
+    monkeypatch.setenv( 'HOME', str( tmp_path ) )
+    mturk.created_HITIds_by_URL.cache_clear()
+    
+    yield account
+    
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client( fake ):
+    import mturk
+    return mturk.create_mturk()
+
+## The create_HITs_for_external_URLs() arguments for $6 HITs
+## (five assignments at $1.00 plus 20%).
+HIT_kwargs = dict( frame_height = 500, Reward = '1.00', MaxAssignments = 5, Title = 't', Description = 'd', Keywords = 'k', AssignmentDurationInSeconds = 600, LifetimeInSeconds = 3600 )
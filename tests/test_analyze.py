@@ -0,0 +1,72 @@
+import csv
+
+import pytest
+
+import mturk
+
+pytest.importorskip( 'numpy' )
+
+def row( AssignmentId, WorkerId, HITId, seconds, answer, AssignmentStatus = 'Submitted' ):
+    return {
+        'HITId': HITId,
+        'AssignmentId': AssignmentId,
+        'WorkerId': WorkerId,
+        'AssignmentStatus': AssignmentStatus,
+        'AcceptTime': '2024-05-01 12:00:00+00:00',
+        'SubmitTime': '2024-05-01 12:%02d:%02d+00:00' % divmod( seconds, 60 ),
+        'q': answer
+        }
+
+def test_empty():
+    review_rows, worker_rows = mturk.analyze_assignments( [] )
+    assert review_rows == []
+    assert worker_rows == []
+
+def test_one_assignment():
+    review_rows, worker_rows = mturk.analyze_assignments([ row( 'A1', 'W1', 'H1', 60, 'yes' ) ])
+    assert [ ( r['AssignmentId'], r['decision'] ) for r in review_rows ] == [ ( 'A1', 'approve' ) ]
+    assert worker_rows[0]['WorkerId'] == 'W1'
+    assert worker_rows[0]['seconds_median'] == '60.000'
+
+def test_speeder_is_left_undecided_unless_reject():
+    rows = [
+        row( 'A1', 'W1', 'H1', 600, 'yes' ),
+        row( 'A2', 'W2', 'H1', 540, 'yes' ),
+        row( 'A3', 'W3', 'H1', 5, 'no' ),
+        ## Not Submitted, so not reviewed.
+        row( 'A4', 'W1', 'H2', 600, 'yes', AssignmentStatus = 'Approved' )
+        ]
+    
+    review_rows, worker_rows = mturk.analyze_assignments( rows )
+    decisions = dict([ ( r['AssignmentId'], r['decision'] ) for r in review_rows ])
+    assert decisions == { 'A1': 'approve', 'A2': 'approve', 'A3': '' }
+    assert 'Submitted in 5 seconds.' in [ r['feedback'] for r in review_rows if r['AssignmentId'] == 'A3' ][0]
+    assert dict([ ( w['WorkerId'], w['reject_candidates'] ) for w in worker_rows ]) == { 'W1': '0', 'W2': '0', 'W3': '1' }
+    
+    review_rows, worker_rows = mturk.analyze_assignments( rows, reject = True )
+    assert dict([ ( r['AssignmentId'], r['decision'] ) for r in review_rows ])['A3'] == 'reject'
+
+def test_command_skips_status_lines( fake, tmp_path ):
+    results_path = str( tmp_path / 'results.csv' )
+    review_path = str( tmp_path / 'review.csv' )
+    
+    ## A results file from before "retrieve" sent its status lines to stderr.
+    with open( results_path, 'w', newline = '' ) as f:
+        f.write( '[MTurkConnection( https://example.com )]\n[get_all_assignments_for_HITId( H1 ): 1 assignments]\n' )
+        dw = csv.DictWriter( f, mturk.assignment_primary_fields + [ 'q' ], lineterminator = '\n' )
+        dw.writeheader()
+        dw.writerow( row( 'A1', 'W1', 'H1', 60, 'yes' ) )
+    
+    mturk.run_command([ 'analyze', review_path, results_path ])
+    with open( review_path, newline = '' ) as f:
+        assert [ ( r['AssignmentId'], r['decision'] ) for r in csv.DictReader( f ) ] == [ ( 'A1', 'approve' ) ]
+
+def test_command_on_header_only_results( fake, tmp_path ):
+    results_path = str( tmp_path / 'results.csv' )
+    review_path = str( tmp_path / 'review.csv' )
+    with open( results_path, 'w' ) as f:
+        f.write( ','.join( mturk.assignment_primary_fields ) + '\n' )
+    
+    mturk.run_command([ 'analyze', review_path, results_path ])
+    with open( review_path, newline = '' ) as f:
+        assert list( csv.DictReader( f ) ) == []
@@ -0,0 +1,62 @@
+import pytest
+
+import mturk
+from conftest import HIT_kwargs
+
+def test_reserve_commit_release( client ):
+    with mturk.BudgetLedger( client ) as ledger:
+        assert ledger.available() == pytest.approx( 100 )
+        
+        spent = ledger.reserve( 30 )
+        released = ledger.reserve( 20 )
+        assert ledger.available() == pytest.approx( 50 )
+        
+        ledger.commit( spent, 10 )
+        assert ledger.available() == pytest.approx( 70 )
+        ledger.release( released )
+        assert ledger.available() == pytest.approx( 90 )
+        
+        with pytest.raises( RuntimeError ):
+            ledger.reserve( 91 )
+
+def test_shared_reservations( client, tmp_path ):
+    path = str( tmp_path / 'ledger.sqlite' )
+    with mturk.BudgetLedger( client, path = path ) as first, mturk.BudgetLedger( client, path = path ) as second:
+        first.reserve( 60 )
+        assert second.available() == pytest.approx( 40 )
+        with pytest.raises( RuntimeError ):
+            second.reserve( 50 )
+
+def test_create_HITs_commits_cost( fake, client ):
+    with mturk.BudgetLedger( client ) as ledger:
+        HITs = mturk.create_HITs_for_external_URLs( client, [ 'https://example.com/1', 'https://example.com/2' ], ledger = ledger, **HIT_kwargs )
+        assert None not in HITs
+        assert ledger.available() == pytest.approx( 88 )
+        assert fake.balance == pytest.approx( 88 )
+
+def test_create_HITs_without_ledger_checks_the_total( fake, client ):
+    ## 20 $6 HITs cost more than $100, though one does not.
+    with pytest.raises( RuntimeError ):
+        mturk.create_HITs_for_external_URLs( client, [ 'https://example.com/%d' % i for i in range( 20 ) ], **HIT_kwargs )
+    assert len( fake.hits ) == 0
+
+def test_failed_creation_releases_reservation( client, monkeypatch ):
+    def fail( **kwargs ): raise RuntimeError( 'create_hit_with_hit_type failed' )
+    monkeypatch.setattr( client, 'create_hit_with_hit_type', fail, raising = False )
+    
+    with mturk.BudgetLedger( client ) as ledger:
+        HITs = mturk.create_HITs_for_external_URLs( client, [ 'https://example.com/1' ], ledger = ledger, **HIT_kwargs )
+        assert HITs == [ None ]
+        assert ledger.available() == pytest.approx( 100 )
+
+def test_expire_credits_once( fake, client ):
+    with mturk.BudgetLedger( client ) as ledger:
+        HITId = mturk.create_HITs_for_external_URLs( client, [ 'https://example.com/1' ], ledger = ledger, **HIT_kwargs )[0]['HITId']
+        assert ledger.available() == pytest.approx( 94 )
+        
+        ## The fake's two Submitted assignments aren't refunded.
+        assert mturk.expire_HITId( client, HITId, ledger = ledger )
+        assert ledger.available() == pytest.approx( 94 + 3 * 1.2 )
+        assert not mturk.expire_HITId( client, HITId, ledger = ledger )
+        assert ledger.available() == pytest.approx( 94 + 3 * 1.2 )
+        assert fake.balance == pytest.approx( ledger.available() )
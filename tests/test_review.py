@@ -0,0 +1,45 @@
+import csv, os
+
+import mturk
+from conftest import HIT_kwargs
+
+def write_review_CSV( path, rows ):
+    with open( path, 'w', newline = '' ) as f:
+        dw = csv.DictWriter( f, [ 'AssignmentId', 'WorkerId', 'decision', 'feedback', 'bonus', 'bonus_reason' ], lineterminator = '\n' )
+        dw.writeheader()
+        dw.writerows( rows )
+
+def test_rerun_without_journal( fake, client, tmp_path ):
+    HITId = mturk.create_HITs_for_external_URLs( client, [ 'https://example.com/1' ], **HIT_kwargs )[0]['HITId']
+    first, second = list( mturk.iter_all_assignments_for_HITId( client, HITId ) )
+    
+    csv_path = str( tmp_path / 'review.csv' )
+    write_review_CSV( csv_path, [
+        dict( AssignmentId = first['AssignmentId'], WorkerId = first['WorkerId'], decision = 'approve', feedback = 'Thanks', bonus = '0.10', bonus_reason = 'Good' ),
+        ## A second bonus for the same assignment.
+        dict( AssignmentId = first['AssignmentId'], WorkerId = first['WorkerId'], decision = '', feedback = '', bonus = '0.20', bonus_reason = 'Very good' ),
+        dict( AssignmentId = second['AssignmentId'], WorkerId = second['WorkerId'], decision = 'reject', feedback = 'Blank', bonus = '', bonus_reason = '' )
+        ])
+    
+    assert mturk.review_assignments_from_CSV( client, csv_path ) == []
+    balance = fake.balance
+    
+    ## As if every action succeeded but the run crashed before journaling.
+    os.remove( csv_path + '.journal' )
+    assert mturk.review_assignments_from_CSV( client, csv_path ) == []
+    assert fake.balance == balance
+    
+    ## Now everything is journaled.
+    assert mturk.review_assignments_from_CSV( client, csv_path ) == []
+    with open( csv_path + '.journal' ) as f:
+        assert len( f.readlines() ) == 4
+
+def test_conflicting_decision_fails( fake, client, tmp_path ):
+    HITId = mturk.create_HITs_for_external_URLs( client, [ 'https://example.com/1' ], **HIT_kwargs )[0]['HITId']
+    assignment = list( mturk.iter_all_assignments_for_HITId( client, HITId ) )[0]
+    client.approve_assignment( AssignmentId = assignment['AssignmentId'] )
+    
+    csv_path = str( tmp_path / 'review.csv' )
+    write_review_CSV( csv_path, [ dict( AssignmentId = assignment['AssignmentId'], WorkerId = assignment['WorkerId'], decision = 'reject', feedback = 'Blank', bonus = '', bonus_reason = '' ) ] )
+    failures = mturk.review_assignments_from_CSV( client, csv_path )
+    assert [ ( AssignmentId, action ) for AssignmentId, action, error in failures ] == [ ( assignment['AssignmentId'], 'reject' ) ]
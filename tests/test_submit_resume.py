@@ -0,0 +1,57 @@
+import json
+
+import mturk
+from conftest import HIT_kwargs
+
+URLs = [ 'https://example.com/%d' % i for i in range( 3 ) ]
+
+def submit( client, journal_path, resume ):
+    with mturk.Journal( journal_path ) as journal:
+        return [ None if HIT is None else HIT['HITId'] for HIT in mturk.create_HITs_for_external_URLs( client, URLs, journal = journal, resume = resume, **HIT_kwargs ) ]
+
+def test_resume_creates_only_the_rest( fake, client, tmp_path, monkeypatch ):
+    journal_path = str( tmp_path / 'job.json.journal' )
+    
+    ## The first run only creates the first HIT.
+    create = client.create_hit_with_hit_type
+    def create_first( **kwargs ):
+        if URLs[0] not in kwargs['Question']: raise RuntimeError( 'interrupted' )
+        return create( **kwargs )
+    monkeypatch.setattr( client, 'create_hit_with_hit_type', create_first, raising = False )
+    first = submit( client, journal_path, resume = False )
+    assert first[0] is not None and first[1:] == [ None, None ]
+    monkeypatch.undo()
+    
+    resumed = submit( client, journal_path, resume = True )
+    assert resumed[0] == first[0]
+    assert None not in resumed
+    assert len( fake.hits ) == 3
+
+def test_resume_finds_unjournaled_HITs( fake, client, tmp_path ):
+    journal_path = str( tmp_path / 'job.json.journal' )
+    first = submit( client, journal_path, resume = False )
+    
+    ## Lose the journal records of the last two HITs, as if the run
+    ## crashed between creating them and journaling them.
+    with open( journal_path ) as f: records = [ json.loads( line ) for line in f ]
+    with open( journal_path, 'w' ) as f:
+        for record in records:
+            if record.get( 'HITId' ) in first[1:]: continue
+            f.write( json.dumps( record ) + '\n' )
+    
+    resumed = submit( client, journal_path, resume = True )
+    assert resumed == first
+    assert len( fake.hits ) == 3
+    with open( journal_path ) as f: found = [ json.loads( line ) for line in f ]
+    assert sorted([ record['HITId'] for record in found if record.get( 'found' ) ]) == sorted( first[1:] )
+    
+    ## Resuming again has nothing left to do.
+    assert submit( client, journal_path, resume = True ) == first
+    assert len( fake.hits ) == 3
+
+def test_without_resume_starts_a_new_job( fake, client, tmp_path ):
+    journal_path = str( tmp_path / 'job.json.journal' )
+    first = submit( client, journal_path, resume = False )
+    second = submit( client, journal_path, resume = False )
+    assert set( first ).isdisjoint( second )
+    assert len( fake.hits ) == 6